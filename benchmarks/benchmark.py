@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+""" Benchmark of PyPML on synthetic scenarios, using the in-process fake TraCI.
+
+    PyPML must be installed, or in PYTHONPATH: PYTHONPATH=. python3 benchmarks/benchmark.py
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy
+
+from pypml import ParkingMonitor
+from pypml.fake import VCLASSES, FakeTraCI
+from pypml.traveltime import TravelTimeMatrix
+
+def _args():
+    """
+    Argument Parser
+    ret: parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        prog='{}'.format(sys.argv[0]),
+        usage='%(prog)s [options]',
+        description='PyPML Benchmark')
+    parser.add_argument(
+        '--scenario', dest='scenarios', action='append', metavar='PARKINGS,VEHICLES[,REROUTERS]',
+        help='Scenario size, it can be repeated. Default: 100,1000 and 1000,10000.')
+    parser.add_argument(
+        '--steps', type=int, default=None,
+        help='Maximum number of simulation steps (default: until all the vehicles arrived).')
+    parser.add_argument(
+        '--horizon', type=int, default=600,
+        help='The vehicles depart in the first half of the horizon (seconds).')
+    parser.add_argument(
+        '--queries', type=int, default=10000,
+        help='Number of queries for the throughput of get_free_places and '
+             'get_closest_parkings.')
+    parser.add_argument(
+        '--routing-limit', type=int, default=500,
+        help='Up to this number of parkings, the travel time matrix is computed with '
+             'compute_parking_travel_time (fake findRoute), above it is synthesized with the '
+             'closest --neighbours parkings.')
+    parser.add_argument(
+        '--neighbours', type=int, default=100,
+        help='Destinations by parking in the synthesized travel time matrix.')
+    parser.add_argument(
+        '--options', default='{}',
+        help='JSON dictionary merged in the ParkingMonitor options.')
+    parser.add_argument(
+        '--tracemalloc', dest='tracemalloc', action='store_true',
+        help='Measure the Python memory allocated by the monitor (slower).')
+    parser.add_argument(
+        '--output', default=None,
+        help='JSON file for the results (default: stdout only).')
+    parser.add_argument(
+        '--compare', default=None,
+        help='JSON file with previous results, the ratios are printed.')
+    return parser.parse_args()
+
+def _merge(options, update):
+    """ Recursively merge update in options. """
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(options.get(key), dict):
+            _merge(options[key], value)
+        else:
+            options[key] = value
+
+def _synthesize_travel_time(fake, monitor, neighbours):
+    """ Set the travel time matrix using the closest parkings (by index) of each parking. """
+    rows = dict()
+    pids = fake.pids
+    for pos, from_pid in enumerate(pids):
+        row = []
+        for to_pos in range(max(0, pos - neighbours // 2), min(len(pids), pos + neighbours // 2)):
+            if to_pos == pos:
+                continue
+            cost = fake.travel_time(fake.get_lane(from_pid).split('_')[0],
+                                    fake.get_lane(pids[to_pos]).split('_')[0])
+            if cost:
+                row.append((cost, pids[to_pos]))
+        rows[from_pid] = row
+    monitor.set_parking_travel_time(TravelTimeMatrix.from_rows(pids, rows))
+
+def _max_rss_mb():
+    """ Return the peak resident set size of the process in MB. """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def _run_scenario(args, parkings, vehicles, rerouters):
+    """ Run a scenario and return its results. """
+    result = {'parkings': parkings, 'vehicles': vehicles, 'rerouters': rerouters}
+    with tempfile.TemporaryDirectory() as directory:
+        fake = FakeTraCI(directory, parkings=parkings, vehicles=vehicles, rerouters=rerouters,
+                         horizon=args.horizon)
+        options = {
+            'seed': 42,
+            'addStepListener': False,
+            'logging': {'stdout': False, 'filename': None, 'level': logging.WARNING},
+            'sumo_parking_file': fake.filename,
+            'blacklist': [],
+            'vclasses': set(VCLASSES),
+            'generic_conf': [{
+                'cond': ['>', 'total_capacity', 3],
+                'set_to': [['uncertainty', {'mu': 0.0, 'sigma': ['*', 'total_capacity', 0.2]}]],
+            }],
+            'specific_conf': {},
+            'subscriptions': {'only_parkings': True},
+        }
+        _merge(options, json.loads(args.options))
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        rss = _max_rss_mb()
+
+        ## Initialization
+        start = timeit.default_timer()
+        monitor = ParkingMonitor(fake, options)
+        result['init_time'] = timeit.default_timer() - start
+
+        start = timeit.default_timer()
+        if parkings <= args.routing_limit:
+            monitor.compute_parking_travel_time()
+            result['travel_time_mode'] = 'routing'
+        else:
+            _synthesize_travel_time(fake, monitor, args.neighbours)
+            result['travel_time_mode'] = 'synthesized'
+        result['travel_time_init'] = timeit.default_timer() - start
+
+        ## Simulation
+        latencies = []
+        while fake.simulation.getMinExpectedNumber() > 0:
+            if args.steps is not None and len(latencies) >= args.steps:
+                break
+            fake.simulationStep()
+            start = timeit.default_timer()
+            monitor.step()
+            latencies.append(timeit.default_timer() - start)
+        latencies = numpy.array(latencies)
+        result['steps'] = len(latencies)
+        result['step_time_total'] = float(latencies.sum())
+        for percentile in (50, 90, 99):
+            result['step_time_p{}'.format(percentile)] = float(
+                numpy.percentile(latencies, percentile)) if len(latencies) else 0.0
+        result['step_time_max'] = float(latencies.max()) if len(latencies) else 0.0
+        result['traci_calls'] = fake.calls
+
+        ## Memory
+        result['max_rss_mb'] = _max_rss_mb()
+        result['max_rss_increase_mb'] = result['max_rss_mb'] - rss
+        if args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['traced_memory_mb'] = current / 2**20
+            result['traced_memory_peak_mb'] = peak / 2**20
+
+        ## Query throughput
+        rnd = numpy.random.RandomState(42)
+        pids = [fake.pids[pos] for pos in rnd.randint(0, parkings, args.queries)]
+        start = timeit.default_timer()
+        for pid in pids:
+            monitor.get_free_places(pid, with_uncertainty=True, with_projections=True)
+        result['get_free_places_per_sec'] = args.queries / (timeit.default_timer() - start)
+        start = timeit.default_timer()
+        for pid in pids:
+            monitor.get_closest_parkings(pid, num=10)
+        result['get_closest_parkings_per_sec'] = args.queries / (timeit.default_timer() - start)
+
+        monitor.close()
+    return result
+
+def _git_revision():
+    """ Return the current git revision, or None. """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _compare(results, filename):
+    """ Print the ratio between the results and the previous ones, by scenario. """
+    with open(filename) as fread:
+        previous = json.load(fread)
+    by_size = {(res['parkings'], res['vehicles'], res['rerouters']): res
+               for res in previous['results']}
+    for res in results:
+        old = by_size.get((res['parkings'], res['vehicles'], res['rerouters']))
+        if old is None:
+            continue
+        print('Scenario {parkings} parkings, {vehicles} vehicles, {rerouters} rerouters '
+              '(new / old):'.format(**res))
+        for key, value in sorted(res.items()):
+            if isinstance(value, float) and old.get(key):
+                print('    {:32} {:12.4g} {:8.3f}'.format(key, value, value / old[key]))
+
+def _main():
+    """ Run the benchmark. """
+    args = _args()
+    scenarios = args.scenarios or ['100,1000', '1000,10000']
+
+    results = []
+    for scenario in scenarios:
+        values = [int(value) for value in scenario.split(',')]
+        parkings, vehicles = values[:2]
+        rerouters = values[2] if len(values) > 2 else (parkings + 4) // 5
+        ## each scenario in a new process, for an independent memory peak
+        with multiprocessing.Pool(processes=1) as pool:
+            result = pool.apply(_run_scenario, (args, parkings, vehicles, rerouters))
+        results.append(result)
+        print(json.dumps(result, sort_keys=True))
+
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'arguments': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fwrite:
+            json.dump(report, fwrite, indent=2, sort_keys=True)
+    if args.compare:
+        _compare(results, args.compare)
+
+if __name__ == '__main__':
+    _main()
@@ -14,8 +14,6 @@
 import argparse
 import logging
 import os
-import pprint
-import random
 import sys
 import traceback
 
@@ -122,69 +120,12 @@ def _main():
                             continue
 
         ## CENTRALIZED PARKING OPTIMIZATION
-        for parking in monitor.get_parking_iterator():
-
-            availability = monitor.get_free_places(
-                parking['sumo']['id'], with_subscriptions=True, with_projections=True,
-                with_uncertainty=False)
-
-            for v_type, free_spaces in availability.items():
-                if free_spaces >= 0:
-                    continue
-
-                projections = parking['projections_by_class'][v_type]
-                _, subscriptions = parking['subscriptions_by_class'][v_type]
-                candidates = projections - subscriptions
-
-                ## redistribute the problem
-                to_reroute = random.sample(candidates, min(abs(free_spaces), len(candidates)))
-
-                for vid in to_reroute:
-                    is_rerouted = False
-
-                    vehicle = monitor.get_vehicle(vid)
-                    if not vehicle['edge'] or ':' in vehicle['edge']:
-                        ## the vehicle is on an intersection and the change would not be safe.
-                        continue
-                    if vehicle['stopped']:
-                        ## the vehicle is stopped and it does not require additional
-                        ## parking changes at least for the moment
-                        continue
-                    _, _, stopping_place, stop_flags, _, _ = vehicle['stops'][0]
-                    if not monitor.is_parking_area(stop_flags):
-                        ## the next stop is not associated to a parking area
-                        continue
-
-                    alternatives = monitor.get_closest_parkings(stopping_place, num=25)
-                    for trtime, alt in alternatives:
-                        alt_availability = monitor.get_free_places(
-                            alt, vclass=vehicle['vClass'],
-                            with_subscriptions=True, with_uncertainty=True)
-                        if alt_availability > 0:
-                            ## reroute vehicle
-                            route = None
-                            try:
-                                edge = monitor.get_parking_access(alt).split('_')[0]
-                                route = traci.simulation.findRoute(
-                                    vehicle['edge'], edge, vType=vehicle['vClass'])
-                            except traci.exceptions.TraCIException:
-                                route = None
-
-                            if route and len(route.edges) >= 2:
-                                try:
-                                    traci.vehicle.rerouteParkingArea(vehicle['id'], alt)
-                                    is_rerouted = True
-                                    print("""Vehicle {} is going to be rerouted from {} """
-                                          """to {} [{}].""".format(vehicle['id'], stopping_place,
-                                                                   alt, alt_availability))
-                                except traci.exceptions.TraCIException:
-                                    pprint.pprint([vehicle,
-                                                   monitor.get_parking_access(alt),
-                                                   route])
-                                    raise
-                                break
-                    if not is_rerouted:
-                        print("Vehicle {} failed to reroute".format(vehicle['id']))
+        ## the vehicles heading to overbooked parkings are redistributed to the closest
+        ## parkings with free places they can reach, at most 25 reroutes for each simulation step
+        for vehicle, parking, alternative, travel_time in monitor.resolve_overbooking(
+                max_reroutes=25, num=25, verify_routes=True):
+            print("""Vehicle {} is going to be rerouted from {} to {} [{:.1f}s].""".format(
+                vehicle, parking, alternative, travel_time))
 
 
 if __name__ == '__main__':
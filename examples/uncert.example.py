@@ -113,13 +113,10 @@ def _main():
                             print(trtime, alt, alt_availability)
                             if alt_availability > 1:
                                 ## reroute vehicle
-                                route = None
-                                try:
-                                    edge = monitor.get_parking_access(alt).split('_')[0]
-                                    route = traci.simulation.findRoute(
-                                        vehicle['edge'], edge, vType=vehicle['vClass'])
-                                except traci.exceptions.TraCIException:
-                                    route = None
+                                ## cached, None if there is no route
+                                edge = monitor.get_parking_access(alt).split('_')[0]
+                                route = monitor.find_route(
+                                    vehicle['edge'], edge, vclass=vehicle['vClass'])
 
                                 if route and len(route.edges) >= 2:
                                     try:
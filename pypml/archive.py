@@ -0,0 +1,71 @@
+""" Archive of the vehicles that left the simulation.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import pickle
+import sqlite3
+import zlib
+
+class VehicleArchive():
+    """ Append-only archive of vehicle records backed by SQLite, in memory or on disk.
+
+        Each vehicle is stored with its ID, vClass, departure and arrival time as columns, and
+        the complete record as a compressed pickle.
+    """
+
+    def __init__(self, filename=None):
+        """ Open the archive. With filename=None the archive is kept in memory. """
+        self._connection = sqlite3.connect(filename or ':memory:', check_same_thread=False)
+        self._connection.execute('PRAGMA synchronous = OFF')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS vehicles ('
+            'id TEXT PRIMARY KEY, vClass TEXT, departure REAL, arrived REAL, data BLOB)')
+        self._connection.commit()
+        self._size = self._connection.execute('SELECT COUNT(*) FROM vehicles').fetchone()[0]
+
+    def add(self, vehicles):
+        """ Archive the given vehicle records (dicts as in ParkingMonitor), replacing the ones
+            with the same ID. """
+        rows = [(vehicle['id'], vehicle['vClass'], vehicle['departure'], vehicle['arrived'],
+                 zlib.compress(pickle.dumps(vehicle, protocol=pickle.HIGHEST_PROTOCOL)))
+                for vehicle in vehicles]
+        before = self._connection.total_changes
+        self._connection.executemany('INSERT OR IGNORE INTO vehicles VALUES (?, ?, ?, ?, ?)', rows)
+        inserted = self._connection.total_changes - before
+        self._size += inserted
+        if inserted < len(rows):
+            ## some IDs were already archived (or repeated): the last record wins
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO vehicles VALUES (?, ?, ?, ?, ?)', rows)
+        self._connection.commit()
+
+    def get(self, vehicle):
+        """ Return the record of the given vehicle ID, or None if not archived. """
+        row = self._connection.execute(
+            'SELECT data FROM vehicles WHERE id = ?', (vehicle,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def __contains__(self, vehicle):
+        return self._connection.execute(
+            'SELECT 1 FROM vehicles WHERE id = ?', (vehicle,)).fetchone() is not None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        """ Yield the archived records in order of arrival. """
+        for (data,) in self._connection.execute('SELECT data FROM vehicles ORDER BY arrived'):
+            yield pickle.loads(zlib.decompress(data))
+
+    def close(self):
+        """ Close the archive. """
+        self._connection.close()
@@ -0,0 +1,157 @@
+""" TraCI backends of the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import importlib
+import os
+import sys
+
+# """ SUMO tools, where SUMO installs the TraCI library """
+if 'SUMO_TOOLS' in os.environ:
+    if os.environ['SUMO_TOOLS'] not in sys.path:
+        sys.path.append(os.environ['SUMO_TOOLS'])
+elif 'SUMO_HOME' in os.environ:
+    if os.path.join(os.environ['SUMO_HOME'], 'tools') not in sys.path:
+        sys.path.append(os.path.join(os.environ['SUMO_HOME'], 'tools'))
+
+try:
+    import traci.constants as tc
+    import traci.exceptions as exceptions
+    from traci import StepListener
+except ImportError:
+    ## Without the TraCI library only the backends that do not need SUMO are available
+    ## (e.g. 'fake' and 'replay'), with the subset of traci used by PyPML.
+
+    class tc(): # pylint: disable=invalid-name
+        """ TraCI constants used by PyPML (traci.constants). """
+        LAST_STEP_PERSON_ID_LIST = 0x1a
+        VAR_ROAD_ID = 0x50
+        VAR_STOP_STARTING_VEHICLES_NUMBER = 0x68
+        VAR_PARKING_STARTING_VEHICLES_IDS = 0x6d
+        VAR_PARKING_ENDING_VEHICLES_IDS = 0x6f
+        VAR_NEXT_STOPS = 0x73
+
+    class exceptions(): # pylint: disable=invalid-name
+        """ TraCI exceptions (traci.exceptions). """
+
+        class TraCIException(Exception):
+            """ Error of a TraCI command. """
+
+        class FatalTraCIError(Exception):
+            """ Error of the TraCI connection. """
+
+    class StepListener():
+        """ SUMO step listener (traci.StepListener). """
+
+        _id = None
+
+        def step(self, t=0):
+            """ Called after each simulation step, return False to be removed. """
+            raise NotImplementedError
+
+        def cleanUp(self): # pylint: disable=invalid-name
+            """ Called when the listener is removed. """
+
+        def setID(self, ID): # pylint: disable=invalid-name
+            """ Set the ID of the listener. """
+            self._id = ID
+
+        def getID(self): # pylint: disable=invalid-name
+            """ Return the ID of the listener. """
+            return self._id
+
+class BackendError(Exception):
+    """ The TraCI backend cannot be created. """
+
+def _import(module):
+    """ Import the module of a backend, raise a BackendError if it is not installed. """
+    try:
+        return importlib.import_module(module)
+    except ImportError as excpt:
+        raise BackendError('The {} library is not available: {}. Install SUMO and declare the '
+                           'environment variable SUMO_TOOLS.'.format(module, excpt))
+
+def _traci_backend(sumo_cmd=None, port=None, label=None):
+    """ TraCI over a socket: start SUMO with sumo_cmd, if given, and return the connection with
+        the given label, or the module-level API. """
+    traci = _import('traci')
+    if sumo_cmd is not None:
+        traci.start(sumo_cmd, port=port, label=label or 'default')
+    if label is not None:
+        return traci.getConnection(label)
+    return traci
+
+def _libsumo_backend(sumo_cmd=None):
+    """ SUMO in-process: start it with sumo_cmd, if given, and return libsumo. """
+    libsumo = _import('libsumo')
+    if sumo_cmd is not None:
+        libsumo.start(sumo_cmd)
+    return libsumo
+
+def _fake_backend(**kwargs):
+    """ Synthetic scenario without SUMO, see FakeTraCI. """
+    from .fake import FakeTraCI
+    return FakeTraCI(**kwargs)
+
+def _replay_backend(filename):
+    """ Replay of a recording, see ReplayTraCI. """
+    from .replay import ReplayTraCI
+    return ReplayTraCI(filename)
+
+## Factories of the TraCI handlers, by backend name
+BACKENDS = {
+    'traci': _traci_backend,
+    'libsumo': _libsumo_backend,
+    'fake': _fake_backend,
+    'replay': _replay_backend,
+}
+
+def register_backend(name, factory):
+    """ Register (or replace) a backend.
+
+        name:    String. Name of the backend, as used in get_backend.
+        factory: Callable returning the TraCI handler, called with the options of get_backend.
+    """
+    BACKENDS[name] = factory
+
+def get_backend(name, **kwargs):
+    """ Create and return the TraCI handler of the given backend.
+        Raises a BackendError if the backend does not exist or is not available.
+
+        name:   String. One of BACKENDS: 'traci' (options 'sumo_cmd', 'port', 'label'),
+                'libsumo' (option 'sumo_cmd'), 'fake' (options of FakeTraCI) and 'replay'
+                (option 'filename').
+        kwargs: Options of the backend.
+    """
+    if name not in BACKENDS:
+        raise BackendError('Backend {} does not exist, available: {}.'.format(
+            name, sorted(BACKENDS)))
+    return BACKENDS[name](**kwargs)
+
+def _normalize_stop(stop):
+    """ Return the stop of vehicle.getNextStops as the tuple (lane, endPos, stoppingPlaceID,
+        stopFlags, duration, until) of the TraCI socket, also for the TraCINextStopData
+        objects returned by libsumo. """
+    if isinstance(stop, tuple):
+        return stop
+    return (stop.lane, stop.endPos, stop.stoppingPlaceID, stop.stopFlags, stop.duration,
+            stop.until)
+
+def is_libsumo(handler):
+    """ Return True if the handler runs SUMO in-process (libsumo semantics), using its
+        isLibsumo() when available. """
+    function = getattr(handler, 'isLibsumo', None)
+    if function is None:
+        return False
+    try:
+        return bool(function())
+    except Exception: # pylint: disable=broad-except
+        ## e.g. a replay of a recording made without it
+        return False
@@ -0,0 +1,98 @@
+""" Compiler for the prefix-notation expressions used in the parking monitor configuration.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import operator
+
+import numpy
+
+def _power(base, exponent):
+    """ base ** exponent, as a float for integer arrays with negative exponents (as Python
+        does for int ** -1), instead of NumPy's ValueError. """
+    try:
+        return operator.pow(base, exponent)
+    except ValueError:
+        return numpy.float_power(base, exponent)
+
+OPERATORS = {
+    'and': operator.and_,
+    'or': operator.or_,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '<=': operator.le,
+    '<': operator.lt,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '**': _power,
+}
+
+def compile_expression(expr):
+    """ Compile an expression (prefix notation) into a function of the environment.
+
+        E.g.: ['>', 'total_capacity', 50] or ['*', 'total_capacity', 0.20]
+        Operands found in the environment are replaced by their value, the others are constants.
+        The environment values can be scalars, or NumPy arrays to evaluate the expression for
+        all the parkings at once. With the environment of build_environment, the SUMO
+        attributes of the parking areas are operands too: a string such as 'id' or 'lane' is
+        the attribute, not a constant, unlike the previous interpreter that only knew the
+        top-level keys of the parking (e.g. 'total_capacity').
+    """
+    if isinstance(expr, list):
+        oper, operand_1, operand_2 = expr
+        function = OPERATORS[oper]
+        first = compile_expression(operand_1)
+        second = compile_expression(operand_2)
+        return lambda environment: function(first(environment), second(environment))
+
+    if isinstance(expr, str):
+        return lambda environment: environment[expr] if expr in environment else expr
+    return lambda environment: expr
+
+def build_environment(parkings):
+    """ Return the environment (name -> NumPy array) for the vectorized evaluation.
+
+        The environment contains 'total_capacity', 'total_occupancy', and all the attributes
+        defined in SUMO for the parking areas, converted to float when possible. The attributes
+        missing in some parking areas are None (and the column is not converted).
+
+        parkings: List of the parking dictionaries, as in ParkingMonitor.
+    """
+    environment = {
+        'total_capacity': numpy.array([parking['total_capacity'] for parking in parkings],
+                                      dtype=numpy.int64),
+        'total_occupancy': numpy.array([parking['total_occupancy'] for parking in parkings],
+                                       dtype=numpy.int64),
+    }
+
+    names = set()
+    for parking in parkings:
+        names.update(parking['sumo'].keys())
+    for name in names - set(environment.keys()):
+        values = [parking['sumo'].get(name) for parking in parkings]
+        try:
+            environment[name] = numpy.array([float(value) for value in values],
+                                            dtype=numpy.float64)
+        except (TypeError, ValueError):
+            environment[name] = numpy.array(values, dtype=object)
+    return environment
+
+def get_row_environment(environment, row):
+    """ Return the scalar environment of a single parking. """
+    return {name: values[row].item() if values.dtype != object else values[row]
+            for name, values in environment.items()}
+
+def get_row_value(value, row):
+    """ Return the value of the expression result for a single parking. """
+    if isinstance(value, numpy.ndarray):
+        return value[row].item() if value.dtype != object else value[row]
+    return value
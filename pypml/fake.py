@@ -0,0 +1,345 @@
+""" In-process fake of the TraCI API used by the parking monitor, for tests and benchmarks.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+import os
+import random
+
+from .backend import exceptions, tc
+
+## stopFlags of a stop in a parking area (parking + parkingarea) and of the stopped vehicle
+_PARKING_FLAGS = 128 + 2
+_STOPPED_FLAG = 1
+
+VCLASSES = ('passenger', 'truck', 'motorcycle')
+
+class _Route():
+    """ Result of simulation.findRoute. """
+
+    def __init__(self, edges, travel_time):
+        self.edges = edges
+        self.travelTime = travel_time
+
+class _StopData():
+    """ Stop of vehicle.getNextStops with libsumo (TraCINextStopData). """
+
+    def __init__(self, lane, end_pos, stopping_place, stop_flags, duration, until):
+        self.lane = lane
+        self.endPos = end_pos
+        self.stoppingPlaceID = stopping_place
+        self.stopFlags = stop_flags
+        self.duration = duration
+        self.until = until
+
+class _TraCIResult():
+    """ Subscription result that libsumo does not convert (e.g. VAR_NEXT_STOPS). """
+
+    def getString(self):
+        return 'TraCINextStopDataVectorWrapped[]'
+
+class _Simulation():
+    """ Fake simulation domain. """
+
+    def __init__(self, world):
+        self._world = world
+
+    def getTime(self):
+        self._world.calls += 1
+        return self._world.time
+
+    def getParameter(self, objid, key):
+        self._world.calls += 1
+        if key == 'parkingArea.capacity':
+            return str(self._world.capacity[objid])
+        if key == 'parkingArea.occupancy':
+            return str(len(self._world.parked[objid]))
+        raise exceptions.TraCIException('Unknown parameter {}.'.format(key))
+
+    def subscribe(self, varIDs=()):
+        self._world.calls += 1
+
+    def getAllSubscriptionResults(self):
+        self._world.calls += 1
+        return {'': {tc.VAR_PARKING_STARTING_VEHICLES_IDS: tuple(self._world.starting),
+                     tc.VAR_PARKING_ENDING_VEHICLES_IDS: tuple(self._world.ending)}}
+
+    def getDepartedIDList(self):
+        self._world.calls += 1
+        return tuple(self._world.departed)
+
+    def getArrivedIDList(self):
+        self._world.calls += 1
+        return tuple(self._world.arrived)
+
+    def findRoute(self, fromEdge, toEdge, vType=''):
+        self._world.calls += 1
+        cost = self._world.travel_time(fromEdge, toEdge)
+        if cost is None:
+            raise exceptions.TraCIException('No route between {} and {}.'.format(
+                fromEdge, toEdge))
+        return _Route([fromEdge, toEdge], cost)
+
+    def getMinExpectedNumber(self):
+        return len(self._world.pending) + len(self._world.active)
+
+class _Vehicle():
+    """ Fake vehicle domain. """
+
+    def __init__(self, world):
+        self._world = world
+
+    def getVehicleClass(self, vehID):
+        self._world.calls += 1
+        return self._world.vehicles[vehID]['vclass']
+
+    def getNextStops(self, vehID):
+        self._world.calls += 1
+        return self._world.get_stops(vehID)
+
+    def getPersonIDList(self, vehID):
+        self._world.calls += 1
+        return ()
+
+    def subscribe(self, objectID, varIDs=()):
+        self._world.calls += 1
+        self._world.subscribed.add(objectID)
+
+    def unsubscribe(self, objectID):
+        self._world.calls += 1
+        self._world.subscribed.discard(objectID)
+
+    def getAllSubscriptionResults(self):
+        self._world.calls += 1
+        results = dict()
+        for vehicle in self._world.subscribed:
+            results[vehicle] = {
+                tc.VAR_ROAD_ID: self._world.vehicles[vehicle]['edge'],
+                tc.VAR_NEXT_STOPS: (_TraCIResult() if self._world.libsumo
+                                    else self._world.get_stops(vehicle)),
+                tc.LAST_STEP_PERSON_ID_LIST: (),
+            }
+        return results
+
+    def rerouteParkingArea(self, vehID, parkingAreaID):
+        self._world.calls += 1
+        vehicle = self._world.vehicles[vehID]
+        if vehicle['state'] != 'driving':
+            raise exceptions.TraCIException(
+                'Vehicle {} is not driving.'.format(vehID))
+        vehicle['target'] = parkingAreaID
+
+class _Edge():
+    """ Fake edge domain. """
+
+    def __init__(self, world):
+        self._world = world
+
+    def getTraveltime(self, edgeID):
+        self._world.calls += 1
+        return 10.0 + self._world.delays[edgeID]
+
+class _ParkingArea():
+    """ Fake parkingarea domain. """
+
+    def __init__(self, world):
+        self._world = world
+        self._subscribed = set()
+
+    def subscribe(self, objectID, varIDs=()):
+        self._world.calls += 1
+        self._subscribed.add(objectID)
+
+    def getAllSubscriptionResults(self):
+        self._world.calls += 1
+        return {pid: {tc.VAR_STOP_STARTING_VEHICLES_NUMBER: len(self._world.parked[pid])}
+                for pid in self._subscribed}
+
+class FakeTraCI():
+    """ Synthetic scenario exposing the subset of the TraCI API used by the ParkingMonitor.
+
+        The parking areas 'pa<N>' lie on the edges 'e<N>' and all have the same capacity. Each
+        vehicle departs at a random time with a stop in a random parking area, drives, parks
+        (or, if the parking area is full, picks another one), leaves the parking area and
+        arrives. The travel time between two edges depends on the distance between their
+        indexes, and some edge pairs have no route. The additional file with the parking areas
+        and the rerouters is written in 'directory'.
+
+        The 'calls' attribute counts the TraCI calls, and the travel time of an edge can be
+        increased with the 'delays' dictionary { edge: seconds }.
+    """
+
+    def __init__(self, directory, parkings=20, vehicles=200, rerouters=None, capacity=5,
+                 seed=7, horizon=600, libsumo=False):
+        """ Build the scenario.
+
+            directory: String. Directory for the additional file (see 'filename').
+            parkings:  Integer. Number of parking areas.
+            vehicles:  Integer. Number of vehicles.
+            rerouters: Integer. Number of rerouters, each with 5 parking areas and 3
+                       intervals. Default: one every 5 parking areas.
+            capacity:  Integer. Capacity of each parking area.
+            seed:      Integer. Seed of the scenario.
+            horizon:   Integer. The vehicles depart in the first half of the horizon.
+            libsumo:   Boolean. If True, it behaves as libsumo: isLibsumo() is True, the
+                       VAR_NEXT_STOPS subscription results are not converted and getNextStops
+                       returns TraCINextStopData-like objects.
+        """
+        self.libsumo = libsumo
+        self.calls = 0
+        self.time = 0.0
+        self.exceptions = exceptions
+        self._random = random.Random(seed)
+        self._listeners = []
+
+        self.simulation = _Simulation(self)
+        self.vehicle = _Vehicle(self)
+        self.edge = _Edge(self)
+        self.parkingarea = _ParkingArea(self)
+
+        self.pids = ['pa{}'.format(pos) for pos in range(parkings)]
+        self.pid_index = {pid: pos for pos, pid in enumerate(self.pids)}
+        self.capacity = {pid: capacity for pid in self.pids}
+        self.parked = {pid: set() for pid in self.pids}
+        self.delays = collections.defaultdict(float)
+
+        self.vehicles = dict()
+        self.active = set()
+        self.subscribed = set()
+        self.departed, self.arrived, self.starting, self.ending = [], [], [], []
+        ## (time, vehicle) of the next event of the active vehicles
+        self._events = collections.defaultdict(list)
+
+        departures = []
+        for pos in range(vehicles):
+            vehicle = 'veh{}'.format(pos)
+            self.vehicles[vehicle] = {
+                'vclass': VCLASSES[pos % len(VCLASSES)],
+                'depart': float(self._random.randint(1, max(1, horizon // 2))),
+                'target': self._random.choice(self.pids),
+                'drive': self._random.randint(5, 60),
+                'park': self._random.randint(10, 120),
+                'leave': self._random.randint(5, 30),
+                'state': 'pending',
+                'edge': '',
+            }
+            departures.append((self.vehicles[vehicle]['depart'], pos, vehicle))
+        self.pending = collections.deque(vehicle for _, _, vehicle in sorted(departures))
+
+        if rerouters is None:
+            rerouters = (parkings + 4) // 5
+        self.filename = os.path.join(directory, 'parkings.add.xml')
+        self._write_additional(rerouters)
+
+    def _write_additional(self, rerouters):
+        """ Write the SUMO additional file with parking areas and rerouters. """
+        with open(self.filename, 'w') as fwrite:
+            fwrite.write('<additional>\n')
+            for pos, pid in enumerate(self.pids):
+                fwrite.write(
+                    '    <parkingArea id="{}" lane="e{}_0" startPos="5" endPos="{}" '
+                    'roadsideCapacity="{}"/>\n'.format(pid, pos, 20 + pos % 3,
+                                                       self.capacity[pid]))
+            for num in range(rerouters):
+                first = (num * 5) % max(1, len(self.pids))
+                fwrite.write('    <rerouter id="rr{}" edges="e{} e{}">\n'.format(
+                    num, first, first + 1))
+                for end in (300, 600, 900):
+                    fwrite.write('        <interval begin="0" end="{}">\n'.format(end))
+                    for pid in self.pids[first:first + 5]:
+                        fwrite.write(
+                            '            <parkingAreaReroute id="{}" visible="{}"/>\n'.format(
+                                pid, 'true' if end == 300 else 'false'))
+                    fwrite.write('        </interval>\n')
+                fwrite.write('    </rerouter>\n')
+            fwrite.write('</additional>\n')
+
+    @staticmethod
+    def _edge_index(edge):
+        """ Return the index of the edge 'e<N>' (0 for the others). """
+        return int(edge[1:]) if edge[1:].isdigit() else 0
+
+    def travel_time(self, from_edge, to_edge):
+        """ Return the travel time between the edges, or None if there is no route. """
+        from_pos = self._edge_index(from_edge)
+        to_pos = self._edge_index(to_edge)
+        if (from_pos + to_pos) % 17 == 3 and from_pos != to_pos:
+            return None
+        return 10.0 + abs(from_pos - to_pos) * 7.5 + self.delays.get(to_edge, 0.0)
+
+    def get_lane(self, pid):
+        """ Return the lane of the parking area. """
+        return 'e{}_0'.format(self.pid_index[pid])
+
+    def get_stops(self, vehicle):
+        """ Return the next stops of the vehicle, as vehicle.getNextStops. """
+        info = self.vehicles[vehicle]
+        if info['state'] == 'driving':
+            flags = _PARKING_FLAGS
+        elif info['state'] == 'parked':
+            flags = _PARKING_FLAGS + _STOPPED_FLAG
+        else:
+            return ()
+        pid = info['target']
+        if self.libsumo:
+            return (_StopData(self.get_lane(pid), 20.0, pid, flags, 60.0, -1.0),)
+        return ((self.get_lane(pid), 20.0, pid, flags, 60.0, -1.0),)
+
+    def isLibsumo(self):
+        """ Return True if it behaves as libsumo. """
+        return self.libsumo
+
+    def addStepListener(self, listener):
+        """ Register the listener, called at the end of every simulationStep. """
+        self._listeners.append(listener)
+        return len(self._listeners) - 1
+
+    def simulationStep(self, step=0.0):
+        """ Advance the scenario of one second. """
+        self.time += 1.0
+        self.departed, self.arrived, self.starting, self.ending = [], [], [], []
+        while self.pending and self.vehicles[self.pending[0]]['depart'] <= self.time:
+            vehicle = self.pending.popleft()
+            info = self.vehicles[vehicle]
+            info['state'], info['edge'] = 'driving', 'e{}'.format(len(self.pids) + 1)
+            self.active.add(vehicle)
+            self.departed.append(vehicle)
+            self._events[self.time + info['drive']].append(vehicle)
+
+        for vehicle in sorted(self._events.pop(self.time, [])):
+            info = self.vehicles[vehicle]
+            if info['state'] == 'driving':
+                pid = info['target']
+                if len(self.parked[pid]) >= self.capacity[pid]:
+                    info['target'] = self._random.choice(self.pids)
+                    self._events[self.time + 10].append(vehicle)
+                    continue
+                info['edge'] = 'e{}'.format(self.pid_index[pid])
+                info['state'] = 'parked'
+                self.parked[pid].add(vehicle)
+                self.starting.append(vehicle)
+                self._events[self.time + info['park']].append(vehicle)
+            elif info['state'] == 'parked':
+                self.parked[info['target']].discard(vehicle)
+                info['state'] = 'leaving'
+                self.ending.append(vehicle)
+                self._events[self.time + info['leave']].append(vehicle)
+            elif info['state'] == 'leaving':
+                info['state'] = 'arrived'
+                self.arrived.append(vehicle)
+
+        for vehicle in self.arrived:
+            self.active.discard(vehicle)
+            self.subscribed.discard(vehicle)
+        for listener in self._listeners:
+            listener.step(self.time)
+
+    def close(self):
+        """ Nothing to close. """
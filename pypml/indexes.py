@@ -0,0 +1,138 @@
+""" Secondary indexes over the vehicles of the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+
+DRIVING = 'driving'
+STOPPED = 'stopped'
+ROADSIDE = 'roadside'
+ARRIVED = 'arrived'
+STATES = (DRIVING, STOPPED, ROADSIDE, ARRIVED)
+
+## stopFlags bit of the stops in a parking area (see ParkingMonitor.is_parking_area)
+_PARKING_AREA_FLAG = 128
+
+def get_vehicle_state(record):
+    """ Return the state of the vehicle: ARRIVED, ROADSIDE, STOPPED (in a parking area) or
+        DRIVING. """
+    if record['arrived'] is not None:
+        return ARRIVED
+    if record['roadside']:
+        return ROADSIDE
+    if record['stopped']:
+        return STOPPED
+    return DRIVING
+
+def get_next_parking(record):
+    """ Return the first parking area in the stops of the vehicle (the one it is heading to, or
+        the one it is parked in), or None. """
+    for _, _, stop, flags, _, _ in record['stops']:
+        if flags & _PARKING_AREA_FLAG:
+            return stop
+    return None
+
+class VehicleIndex():
+    """ Sets of vehicle IDs by state, next parking area, vClass and subscription status.
+
+        The ParkingMonitor calls update() every time a vehicle record changes, and subscribe()
+        every time a vehicle is added to (delta=1) or removed from (delta=-1) the subscriptions
+        of a parking area. The subscriptions are counted also for the vehicles not (yet) in the
+        index.
+    """
+
+    def __init__(self):
+        """ Initialize the empty indexes. """
+        self._entries = dict()
+        self.by_state = {state: set() for state in STATES}
+        self.by_parking = collections.defaultdict(set)
+        self.by_vclass = collections.defaultdict(set)
+        self.subscribed = set()
+        self._subscriptions = collections.Counter()
+
+    @staticmethod
+    def _discard(index, key, vehicle):
+        """ Remove the vehicle from index[key], dropping the empty sets. """
+        index[key].discard(vehicle)
+        if not index[key]:
+            del index[key]
+
+    def update(self, record):
+        """ Add the vehicle record to the indexes, or move it if its state changed. """
+        vehicle = record['id']
+        entry = (get_vehicle_state(record), get_next_parking(record), record['vClass'])
+        previous = self._entries.get(vehicle)
+        if entry == previous:
+            return
+        if previous:
+            self.remove(vehicle)
+        self._entries[vehicle] = entry
+        state, parking, v_class = entry
+        self.by_state[state].add(vehicle)
+        if parking is not None:
+            self.by_parking[parking].add(vehicle)
+        self.by_vclass[v_class].add(vehicle)
+        if self._subscriptions[vehicle] > 0:
+            self.subscribed.add(vehicle)
+
+    def remove(self, vehicle):
+        """ Remove the vehicle from the indexes. """
+        state, parking, v_class = self._entries.pop(vehicle)
+        self.by_state[state].discard(vehicle)
+        if parking is not None:
+            self._discard(self.by_parking, parking, vehicle)
+        self._discard(self.by_vclass, v_class, vehicle)
+        self.subscribed.discard(vehicle)
+
+    def subscribe(self, vehicle, delta):
+        """ Account for the vehicle added to (delta=1) or removed from (delta=-1) the
+            subscriptions of a parking area. """
+        self._subscriptions[vehicle] += delta
+        if self._subscriptions[vehicle] <= 0:
+            del self._subscriptions[vehicle]
+            self.subscribed.discard(vehicle)
+        elif vehicle in self._entries:
+            self.subscribed.add(vehicle)
+
+    def query(self, state=None, parking=None, vclass=None, subscribed=None):
+        """ Return the set of vehicle IDs matching all the given filters (None: any).
+
+            The smallest of the selected indexes is scanned, and the other filters are checked
+            on its vehicles.
+        """
+        candidates = []
+        if state is not None:
+            candidates.append(self.by_state[state])
+        if parking is not None:
+            candidates.append(self.by_parking.get(parking, set()))
+        if vclass is not None:
+            candidates.append(self.by_vclass.get(vclass, set()))
+        if subscribed:
+            candidates.append(self.subscribed)
+        if not candidates:
+            candidates.append(self._entries.keys())
+        candidates.sort(key=len)
+
+        smallest, others = candidates[0], candidates[1:]
+        if subscribed is False:
+            others.append(_Complement(self.subscribed))
+        return {vehicle for vehicle in smallest
+                if all(vehicle in other for other in others)}
+
+class _Complement():
+    """ Membership test for the vehicles not in the given set. """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __contains__(self, vehicle):
+        return vehicle not in self._data
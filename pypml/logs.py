@@ -0,0 +1,40 @@
+""" Logging helpers for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import json
+import logging
+import logging.handlers
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that leaves the formatting to the listener thread.
+
+        The standard QueueHandler formats the message before queuing the record, in the thread
+        that logs. Here the record is queued as it is, so the arguments of the logging calls
+        must not be modified afterwards (the monitor logs only IDs and numbers).
+    """
+
+    def prepare(self, record):
+        return record
+
+class JsonLinesFormatter(logging.Formatter):
+    """ Format each record as a JSON object on a single line, with the creation time, the
+        level, the message template and its arguments. """
+
+    def format(self, record):
+        event = {
+            'time': record.created,
+            'level': record.levelname,
+            'event': record.msg,
+            'args': record.args,
+        }
+        if record.exc_info:
+            event['exc'] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
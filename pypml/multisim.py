@@ -0,0 +1,188 @@
+""" Several simulations, each one with its own parking monitor, in the same process.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+import concurrent.futures
+import os
+
+from .backend import BackendError, get_backend
+from .pypml import ParkingMonitor, ParkingMonitorGenericError
+
+class MultiSimulation():
+    """ Driver of several SUMO simulations, identified by a label, each one with its own
+        ParkingMonitor.
+
+        Every monitor uses only the TraCI connection it was given (never the module-level
+        traci API), so there is no need for traci.switch and the simulations are stepped
+        concurrently by a pool of threads: the socket communication with the SUMO processes
+        overlaps, while the processing of the monitors is serialized by the interpreter.
+        The static data computed once, as the parking travel time, is shared between the
+        monitors of the same scenario.
+        libsumo supports a single simulation per process, use labeled TraCI connections.
+    """
+
+    def __init__(self, max_workers=None):
+        """ Prepare the driver.
+
+            max_workers: Integer. Number of threads stepping the simulations. Default: one for
+                         each simulation.
+        """
+        self._max_workers = max_workers
+        self._executor = None
+        self._simulations = collections.OrderedDict()
+        self._net_files = dict()
+        self._running = list()
+
+    def start(self, label, sumo_cmd, options, port=None, net_file=None):
+        """ Start SUMO with a labeled TraCI connection and attach a new monitor to it.
+            Return the monitor.
+
+            label:    String. Label of the simulation and of the TraCI connection.
+            sumo_cmd: List of strings. SUMO command line, as for traci.start.
+            options:  Dictionary. Options of the ParkingMonitor.
+            port:     Integer. TraCI port, if None a free one is used.
+            net_file: String. SUMO network of the simulation, see add().
+        """
+        try:
+            handler = get_backend('traci', sumo_cmd=sumo_cmd, port=port, label=label)
+        except BackendError as excpt:
+            raise ParkingMonitorGenericError(str(excpt))
+        return self.add(label, handler, options, net_file=net_file)
+
+    def add(self, label, handler, options, net_file=None):
+        """ Attach a new monitor to an already initialized TraCI handler and return it.
+            The 'label' option of the monitor is set to the label of the simulation, if missing.
+            Raises an ParkingMonitorGenericError if the label is already used.
+
+            label:    String. Label of the simulation.
+            handler:  TraCI connection (or any handler with the same API) of the simulation.
+            options:  Dictionary. Options of the ParkingMonitor.
+            net_file: String. SUMO network of the simulation, required to share the static data
+                      with the other simulations (see compute_parking_travel_time).
+        """
+        if label in self._simulations:
+            raise ParkingMonitorGenericError('Simulation {} already exists.'.format(label))
+        options = dict(options)
+        options.setdefault('label', label)
+        monitor = ParkingMonitor(handler, options)
+        self._simulations[label] = (handler, monitor)
+        if net_file is not None:
+            self._net_files[label] = os.path.abspath(net_file)
+        self._running.append(label)
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return monitor
+
+    def get_labels(self):
+        """ Return the labels of all the simulations. """
+        return list(self._simulations)
+
+    def get_running(self):
+        """ Return the labels of the simulations that are not over. """
+        return list(self._running)
+
+    def get_monitor(self, label):
+        """ Return the monitor of the simulation.
+
+            label: String. Label of the simulation.
+        """
+        return self._simulations[label][1]
+
+    def get_handler(self, label):
+        """ Return the TraCI handler of the simulation.
+
+            label: String. Label of the simulation.
+        """
+        return self._simulations[label][0]
+
+    def _get_scenario(self, label):
+        """ Return the key of the static data of the simulation: network, 'sumo_parking_file',
+            'blacklist' and 'vclasses', or None if the network is unknown. """
+        if label not in self._net_files:
+            return None
+        # pylint: disable=protected-access
+        options = self.get_monitor(label)._options
+        return (self._net_files[label], os.path.abspath(options['sumo_parking_file']),
+                sorted(options['blacklist']), sorted(options['vclasses']))
+
+    def compute_parking_travel_time(self, label=None, **kwargs):
+        """ Compute the travel time structure in a simulation and share it with the monitors
+            of the other simulations with the same network (see add()), 'sumo_parking_file',
+            'blacklist' and 'vclasses'. The simulations added without network are not shared.
+
+            label:  String. Simulation used for the computation. Default: the first one.
+            kwargs: Arguments of ParkingMonitor.compute_parking_travel_time.
+        """
+        if label is None:
+            label = next(iter(self._simulations))
+        monitor = self.get_monitor(label)
+        monitor.compute_parking_travel_time(**kwargs)
+        scenario = self._get_scenario(label)
+        if scenario is None:
+            return
+        for other, (_, other_monitor) in self._simulations.items():
+            if other != label and self._get_scenario(other) == scenario:
+                other_monitor.share_parking_travel_time(monitor)
+
+    def _step(self, label):
+        """ Step the simulation (and its monitor), return True if it is not over. """
+        handler, monitor = self._simulations[label]
+        monitor.simulation_step()
+        return handler.simulation.getMinExpectedNumber() > 0
+
+    def step(self):
+        """ Make a simulation step in all the running simulations, concurrently, and return the
+            labels of the ones that are still running. An exception raised in a simulation is
+            raised here, after all the simulations completed the step.
+        """
+        if not self._running:
+            return []
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._max_workers or len(self._simulations),
+                thread_name_prefix='pypml-multisim')
+        futures = [(label, self._executor.submit(self._step, label)) for label in self._running]
+        concurrent.futures.wait([future for _, future in futures])
+        running = []
+        for label, future in futures:
+            if future.result():
+                running.append(label)
+        self._running = running
+        return list(running)
+
+    def run(self, steps=None):
+        """ Step all the simulations until they are over, or for the given number of steps.
+            Return the number of steps.
+
+            steps: Integer. Maximum number of steps.
+        """
+        done = 0
+        while self._running and (steps is None or done < steps):
+            self.step()
+            done += 1
+        return done
+
+    def close(self, close_handlers=True):
+        """ Close the monitors and, if close_handlers, the TraCI handlers (ending SUMO).
+
+            close_handlers: Boolean. If False, the TraCI connections are left open.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        for handler, monitor in self._simulations.values():
+            monitor.close()
+            if close_handlers:
+                handler.close()
+        self._simulations.clear()
+        self._net_files.clear()
+        self._running = []
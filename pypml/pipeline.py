@@ -0,0 +1,89 @@
+""" TraCI snapshots for the pipelined mode of the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+from .backend import exceptions
+
+## Calls queued by the snapshot, and made later on the real handler
+_WRITES = ('subscribe', 'unsubscribe')
+
+class SnapshotError(Exception):
+    """ The code using the snapshot made a TraCI call that was not retrieved in advance. """
+
+class TraCISnapshot():
+    """ TraCI results of a simulation step, retrieved in advance with read(), that answer the
+        same calls made later (e.g. by a worker thread, while the TraCI connection is busy).
+
+        A call that was not read in advance raises a SnapshotError, a call that raised a
+        TraCIException raises it again. The subscribe and unsubscribe calls are queued, and
+        made on the real handler by apply_writes().
+    """
+
+    def __init__(self, handler):
+        """ Prepare an empty snapshot of the given TraCI handler. """
+        self._handler = handler
+        self._results = dict()
+        self._domains = dict()
+        self.writes = []
+
+    def read(self, domain, name, *args):
+        """ Make the call on the handler, save and return its result (None if it failed). """
+        try:
+            value = getattr(getattr(self._handler, domain), name)(*args)
+        except exceptions.TraCIException as excpt:
+            self._results[(domain, name, args)] = (False, excpt)
+            return None
+        self._results[(domain, name, args)] = (True, value)
+        return value
+
+    def _answer(self, domain, name, args, kwargs):
+        """ Return (or raise) the saved result, or queue the write. """
+        if name in _WRITES:
+            self.writes.append((domain, name, args, kwargs))
+            return None
+        if kwargs or (domain, name, args) not in self._results:
+            raise SnapshotError('Call {}.{}{} not in the snapshot.'.format(domain, name, args))
+        success, value = self._results[(domain, name, args)]
+        if not success:
+            raise value
+        return value
+
+    def apply_writes(self):
+        """ Make the queued calls on the real handler, and return the list of the ones that
+            raised a TraCIException, as (domain, name, args, exception). """
+        failed = []
+        for domain, name, args, kwargs in self.writes:
+            try:
+                getattr(getattr(self._handler, domain), name)(*args, **kwargs)
+            except exceptions.TraCIException as excpt:
+                failed.append((domain, name, args, excpt))
+        self.writes = []
+        return failed
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._domains:
+            self._domains[name] = _SnapshotDomain(name, self)
+        return self._domains[name]
+
+class _SnapshotDomain():
+    """ TraCI domain of the TraCISnapshot. """
+
+    def __init__(self, name, snapshot):
+        self._name = name
+        self._snapshot = snapshot
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def _snapshot_call(*args, **kwargs):
+            return self._snapshot._answer(self._name, name, args, kwargs)
+        return _snapshot_call
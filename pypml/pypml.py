@@ -7,24 +7,40 @@
     http://www.eclipse.org/legal/epl-2.0.
 """
 
+import atexit
+import bisect
 import collections
+import concurrent.futures
 import copy
 import logging
-import operator
+import logging.handlers
 import os
+import queue
 import sys
+import timeit
 import xml.etree.ElementTree
 
+import numpy
 from numpy.random import RandomState
 
-# """ Import TraCI library """
-if 'SUMO_TOOLS' in os.environ:
-    sys.path.append(os.environ['SUMO_TOOLS'])
-    import traci
-    import traci.constants as tc
-else:
-    sys.exit("""The PyPML package uses SUMO TraCI API.
-             Please declare the environment variable 'SUMO_TOOLS'""")
+from .archive import VehicleArchive
+from .backend import (BackendError, StepListener, _normalize_stop, exceptions, get_backend,
+                      is_libsumo, tc)
+from .expressions import (build_environment, compile_expression, get_row_environment,
+                          get_row_value)
+from .indexes import DRIVING, STATES, VehicleIndex
+from .logs import DeferredQueueHandler, JsonLinesFormatter
+from .pipeline import TraCISnapshot
+from .routes import DEFAULT_TTL, RouteCache
+from .series import OccupancySeries
+from .stats import CountingTraCI, StepStats, dump_metrics
+from .store import OCCUPANCY, PROJECTIONS, SUBSCRIBED, ParkingStore
+from .traveltime import (TravelTimeMatrix, TravelTimeRefresher, compute_travel_time_rows,
+                         compute_travel_time_rows_parallel, get_parking_access_points,
+                         get_travel_time_cache_key, load_travel_time_cache,
+                         save_travel_time_cache)
+from .vehicles import VehicleRecord, get_stops_fingerprint, intern_stops
+from .views import read_only
 
 class ParkingMonitorGenericError(Exception):
     """ Parking Monitor Exception Class """
@@ -38,40 +54,87 @@ class ParkingMonitorGenericError(Exception):
     def __str__(self):
         return self.message
 
-class ParkingMonitor(traci.StepListener):
+## Events that can be handled with ParkingMonitor.register_callback
+EVENTS = ('on_vehicle_departed', 'on_vehicle_arrived', 'on_parking_started', 'on_parking_ended',
+          'on_projection_changed', 'on_parking_overbooked')
+
+class ParkingMonitor(StepListener):
     """ SUMO StepListener class for the parking monitoring. """
 
     _logger = None
+    _log_debug = False
+    _log_listener = None
+    _log_handlers = None
     _options = None
     _random = None
-
-    _parking_db = dict()
-    _routers_db = dict()
-    _vehicles_db = dict()
-    _passengers_db = set()
-
-    _edges_routers_mapping = collections.defaultdict(list)
-
-    _blacklisted_edges_pairs = collections.defaultdict(list)
-    _static_parking_travel_time = collections.defaultdict(list)
+    _read_only_views = False
+
+    _label = None
+
+    _parking_db = None
+    _routers_db = None
+    _vehicles_db = None
+    _passengers_db = None
+
+    _parking_store = None
+    _vehicles_archive = None
+    _archive_grace_period = None
+    _archive_queue = None
+    _stops_table = None
+    _vehicle_index = None
+
+    _callbacks = None
+    _overbooked = None
+    _rerouted = None
+
+    _step_stats = None
+    _traci_counter = None
+    _traci_mark = (0, 0, 0)
+    _prefetch_traci = None
+    _validation_time = 0.0
+
+    _edges_routers_mapping = None
+
+    _blacklisted_edges_pairs = None
+    _static_parking_travel_time = None
+    _travel_time_store_index = None
+    _route_cache = None
+    _travel_time_refresher = None
+    _travel_time_route_edges = None
+    _time = 0.0
 
     _traci_handler = None
+    _traci_backend = None
+    _owns_traci_handler = False
+    _next_stops_subscription = True
+    _pipelined = False
+    _pipeline = None
+    _synced = True
+    _traci_parking_occupancy = False
     _traci_arrived_list = None
     _traci_departed_list = None
     _traci_vehicle_subscription = None
     _traci_simulation_subscriptions = None
     _traci_starting_stop_subscriptions = None
     _traci_ending_stop_subscriptions = None
+    _traci_parkingarea_subscriptions = None
 
     ## ===============================      INITIALIZATION      ================================ ##
 
     def _logs(self):
         """ Log init. """
-        self._logger = logging.getLogger('parkingmonitor.ParkingMonitor')
+        if self._label is None:
+            self._logger = logging.getLogger('parkingmonitor.ParkingMonitor')
+        else:
+            self._logger = logging.getLogger('parkingmonitor.ParkingMonitor.{}'.format(
+                self._label))
         self._logger.setLevel(self._options['logging']['level'])
 
         handlers = []
-        formatter = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s')
+        if self._options['logging'].get('format', 'text') == 'jsonl':
+            formatter = JsonLinesFormatter()
+        else:
+            formatter = logging.Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s')
         if self._options['logging']['filename']:
             # create file handler which logs even debug messages
             file_handler = logging.FileHandler(filename=self._options['logging']['filename'],
@@ -88,29 +151,74 @@ class ParkingMonitor(traci.StepListener):
             handlers.append(console_handler)
 
         if handlers:
+            if self._options['logging'].get('queue', False):
+                # formatting and writing are done by the listener thread
+                log_queue = queue.SimpleQueue()
+                self._log_listener = logging.handlers.QueueListener(
+                    log_queue, *handlers, respect_handler_level=True)
+                self._log_listener.start()
+                atexit.register(self._log_listener.stop)
+                handlers = [DeferredQueueHandler(log_queue)]
             # add the handlers to the logger
             for handler in handlers:
                 self._logger.addHandler(handler)
+            self._log_handlers = handlers
+            if self._label is not None:
+                ## not written again by the handlers of an unlabeled monitor
+                self._logger.propagate = False
         else:
             self._logger = None
 
+        ## resolved once, checked in the monitoring loops
+        self._log_debug = bool(self._logger) and self._logger.isEnabledFor(logging.DEBUG)
+
     def __init__(self, traci_handler, options):
         """ Initialize the knowlegde base for the parking monitor.
 
-        traci_handler: already initialized TraCI socket that is going to be used by PyPML
+        traci_handler: already initialized TraCI socket (or libsumo, or any handler with the same
+                       API) that is going to be used by PyPML. If None, it is created with the
+                       'backend' option.
         options:       in order to reduce the number of parameters and increase the flexibility,
                        the complete initialization is done using a dict()
 
         Options format:
         {
             'seed': Integer. Initialization seed for numpy.random.RandomState.
+            'label': String (optional, default None). Name of the monitor, used for its logger
+                     ('parkingmonitor.ParkingMonitor.<label>') when several monitors run in the
+                     same process. With its own handlers, it does not propagate its records to
+                     the logger of the unlabeled monitor.
+            'backend': { (optional) TraCI backend used when traci_handler is None, see
+                         pypml.backend. The handler is returned by get_traci_handler() and
+                         closed by close().
+                'name': String (default 'traci'). 'traci' (TraCI socket), 'libsumo' (SUMO
+                        in-process), 'fake' (FakeTraCI), 'replay' (ReplayTraCI), or a backend
+                        added with pypml.backend.register_backend.
+                Any other key is passed to the backend, e.g. 'sumo_cmd' to start SUMO with
+                'traci' and 'libsumo', 'port' and 'label' for 'traci', 'filename' for 'replay'.
+            },
             'addStepListener': Boolean. Ff True, pypml is added as step listener in SUMO.
                                In case it's False the function step() must be called by hand every
                                simulation step.
+            'pipelined': Boolean (optional, default False). If True, the simulation is advanced
+                         with simulation_step(), and the Python processing of each step is done
+                         by a worker thread while SUMO simulates the following one. All the
+                         TraCI calls are still made serially on the connection. It requires
+                         'addStepListener' False, see simulation_step() and sync().
+            'read_only_views': Boolean (optional, default False). If True, the query API returns
+                               read-only views sharing memory with the internal databases instead
+                               of deep copies. The views follow the state of the monitor, cannot be
+                               modified, and their copy() returns a private mutable deep copy.
             'logging': {
                 'stdout': Boolean. If True, the logging will be both file and stdout.
                 'filename': String. Name of the logging file.
                 'level': Logging level as defined in the logging library. E.g.: logging.DEBUG
+                'queue': Boolean (optional, default False). If True, the log records are queued
+                         and formatted and written by a background thread. It is stopped by
+                         close(), or at exit.
+                'format': String (optional, default 'text'). With 'jsonl', each record is
+                          written as a JSON object (time, level, event template and arguments)
+                          on a single line.
             },
             'sumo_parking_file': String. Path and file name of the SUMO additional file defining the
                                  parkings.
@@ -119,11 +227,67 @@ class ParkingMonitor(traci.StepListener):
             'vclasses': Set of strings. Set of vTypes, as defined in SUMO, comprehensive of all the
                         vehicles used in the simulation.
             'generic_conf': List. List of generic configuration applied to all the parking areas.
+                            The expressions can use 'total_capacity', 'total_occupancy' and the
+                            SUMO attributes of the parking areas (e.g. 'id', 'lane', 'endPos'),
+                            any other string is a constant.
             'specific_conf': Dictionary. Dictionary of configuration applied to specific parking
                              areas.
+            'occupancy_series': { (optional) Storage of the parking occupancy series.
+                'chunk_size': Integer (default 1024). Number of samples in each memory chunk.
+                'retention': Float (default None). If set, samples older than 'retention'
+                             seconds are dropped.
+                'window': Float (default None). If set, the samples in the same window of
+                          'window' seconds are merged in a single sample.
+                'aggregate': String (default 'last'). Merge function for the window: 'last',
+                             'min' or 'max'.
+                'spill_dir': String (default None). If set, the old chunks are saved in this
+                             directory and loaded only when accessed.
+                'chunks_in_memory': Integer. Number of full chunks kept in memory with
+                                    'spill_dir'.
+            },
+            'vehicles_archive': { (optional) If set, the arrived vehicles are moved from the
+                                  vehicles database to an append-only archive, and the vehicle
+                                  iterator covers only the vehicles still in the simulation.
+                'grace_period': Float (default 0.0). Seconds after the arrival before a vehicle
+                                is archived.
+                'filename': String (default None). SQLite file used for the archive, if None
+                            the archive is kept in memory.
+            },
+            'instrumentation': { (optional) If set, the monitor measures every step, see
+                                 get_step_stats(), and counts the TraCI calls (and bytes, with a
+                                 TraCI socket) going through a proxy of the handler.
+                'window': Integer (default 1000). Number of steps used for the statistics.
+                'metrics_file': String (default None). If set, the statistics are written in
+                                this text file every 'metrics_period' steps.
+                'metrics_period': Integer (default 100). Steps between two metrics dumps.
+            },
+            'travel_time_refresh': { (optional) If set, the travel time structure is kept up
+                                     to date incrementally, during the simulation steps,
+                                     computing again only the rows using the edges whose
+                                     travel time changed. The queries use the previous
+                                     version until all the changed rows are computed.
+                'period': Float (default 300.0). Seconds of simulation between two refreshes.
+                'threshold': Float (default 0.2). Relative change of the travel time of an edge
+                             that triggers the computation of the rows using it.
+                'budget': Float (default 0.005). Seconds of work on the refresh for each
+                          simulation step.
+            },
+            'route_cache': { (optional) Cache of the routes used by find_route() and
+                             compute_parking_travel_time().
+                'max_size': Integer (default 65536). Maximum number of routes (and failures)
+                            in the cache, the least recently used are evicted.
+                'ttl': Float (default 60.0). Seconds of simulation after which a route is
+                       computed again, following the traffic. If None, the routes do not
+                       expire.
+                'negative_ttl': Float (default 'ttl'). Same as 'ttl', for the failures.
+            },
             'subscriptions': {
                 'only_parkings': Boolean. If True, PyPML subscribes only to the vehicles that have
                                  a <stop> define at the beginning of the simulation.
+                'parking_occupancy': Boolean (optional, default False). If True, the occupancy of
+                                     all the monitored parking areas is retrieved with TraCI
+                                     parkingarea subscriptions, in a single result per step,
+                                     instead of one simulation.getParameter per parking area.
             },
         }
 
@@ -146,6 +310,8 @@ class ParkingMonitor(traci.StepListener):
         ]
         In this example, every parkign area with more than 50 places will have an uncertainty with
             sigma equal to 20% of the capacity.
+        The names that can be used in the expressions are 'total_capacity', 'total_occupancy' and
+            the attributes of the parkingArea in the SUMO additional file (e.g. 'roadsideCapacity').
 
         Example of specific_conf:
         Each parking area needs a specific entry in the dictionary.
@@ -167,6 +333,16 @@ class ParkingMonitor(traci.StepListener):
         """
 
         self._options = options
+        self._label = options.get('label')
+
+        ## Databases, private to each monitor
+        self._parking_db = dict()
+        self._routers_db = dict()
+        self._vehicles_db = dict()
+        self._passengers_db = set()
+        self._edges_routers_mapping = collections.defaultdict(list)
+        self._blacklisted_edges_pairs = collections.defaultdict(list)
+        self._static_parking_travel_time = collections.defaultdict(list)
 
         ## Random generator initialization
         if 'seed' in options:
@@ -177,9 +353,50 @@ class ParkingMonitor(traci.StepListener):
         ## Logs initialization
         self._logs()
 
+        ## Query API: deep copies or read-only views
+        self._read_only_views = options.get('read_only_views', False)
+
+        ## Event callbacks
+        self._callbacks = {event: [] for event in EVENTS}
+        self._overbooked = set()
+
+        ## Vehicles rerouted by resolve_overbooking in the current step
+        self._rerouted = dict()
+
+        ## Stops shared between the vehicle records
+        self._stops_table = dict()
+
+        ## Archive of the arrived vehicles
+        if 'vehicles_archive' in options:
+            self._vehicles_archive = VehicleArchive(options['vehicles_archive'].get('filename'))
+            self._archive_grace_period = options['vehicles_archive'].get('grace_period', 0.0)
+            self._archive_queue = collections.deque()
+
         ## TraCI initialization
+        if traci_handler is None:
+            backend = dict(options.get('backend', {}))
+            try:
+                traci_handler = get_backend(backend.pop('name', 'traci'), **backend)
+            except BackendError as excpt:
+                raise ParkingMonitorGenericError(str(excpt))
+            self._owns_traci_handler = True
+        self._traci_backend = traci_handler
         self._traci_handler = traci_handler
+        ## libsumo does not convert the VAR_NEXT_STOPS subscription results, the stops are
+        ## retrieved with getNextStops, which is an in-process call
+        self._next_stops_subscription = not is_libsumo(traci_handler)
+        if 'instrumentation' in options:
+            self._step_stats = StepStats(options['instrumentation'].get('window', 1000))
+            self._traci_counter = CountingTraCI(traci_handler)
+            self._traci_handler = self._traci_counter
         time = self._traci_handler.simulation.getTime()
+        self._time = time
+
+        ## Cache of the routes, aged with the simulation time
+        route_cache = options.get('route_cache', {})
+        self._route_cache = RouteCache(
+            self._traci_handler, lambda: self._time, max_size=route_cache.get('max_size', 65536),
+            ttl=route_cache.get('ttl', DEFAULT_TTL), negative_ttl=route_cache.get('negative_ttl'))
 
         ## Read parkings and routers from SUMO add.xml
         self._load_parkings_and_routers()
@@ -193,7 +410,8 @@ class ParkingMonitor(traci.StepListener):
                 self._traci_handler.simulation.getParameter(pid, 'parkingArea.occupancy'))
             parking['total_capacity'] = capacity   # TraCI value
             parking['total_occupancy'] = occupancy # TraCI value
-            parking['occupancy_series'] = [(occupancy, time)]
+            parking['occupancy_series'] = OccupancySeries(
+                [(occupancy, time)], name=pid, **options.get('occupancy_series', {}))
             parking['occupancy_by_class'] = dict()
             parking['projections_by_class'] = dict()
             for vclass in self._options['vclasses']:
@@ -208,37 +426,20 @@ class ParkingMonitor(traci.StepListener):
                 'sigma': 0.0,
             }
 
-            ## Apply GENERAL CONFIGURATIONS
-            for gopt in options['generic_conf']:
-                if self._parse_generic_condition(gopt['cond'], parking):
-                    for key, value in gopt['set_to']:
-                        if key == 'uncertainty':
-                            parking['uncertainty'] = {
-                                'mu': self._eval_expression(value['mu'], parking),
-                                'sigma': self._eval_expression(value['sigma'], parking),
-                            }
-                        else:
-                            ## not sure what this can be
-                            parking[key] = copy.deepcopy(value)
-
-            ## Apply SPECIFIC VALUES
-            if pid in options['specific_conf'].keys():
-                if 'capacity_by_class' in options['specific_conf'][pid]:
-                    parking['capacity_by_class'] = copy.deepcopy(
-                        options['specific_conf'][pid]['capacity_by_class'])
-                if 'subscriptions_by_class' in options['specific_conf'][pid]:
-                    parking['subscriptions_by_class'] = copy.deepcopy(
-                        options['specific_conf'][pid]['subscriptions_by_class'])
-                if 'uncertainty' in options['specific_conf'][pid]:
-                    parking['uncertainty'] = {
-                        'mu': self._eval_expression(
-                            options['specific_conf'][pid]['uncertainty']['mu'], parking),
-                        'sigma': self._eval_expression(
-                            options['specific_conf'][pid]['uncertainty']['sigma'], parking),
-                    }
-
             total += capacity
 
+        self._apply_parking_configurations()
+
+        ## Columnar copy of the parking state
+        self._parking_store = ParkingStore(self._parking_db.keys(), self._options['vclasses'])
+        for pid, parking in self._parking_db.items():
+            self._parking_store.load(pid, parking)
+
+        ## Secondary indexes over the vehicles
+        self._vehicle_index = VehicleIndex()
+        for parking in self._parking_db.values():
+            self._update_subscription_index(parking['subscriptions_by_class'], 1)
+
         if self._logger:
             self._logger.info('Monitoring %s parkings with a total capacity of %d.',
                               len(self._parking_db), total)
@@ -247,42 +448,145 @@ class ParkingMonitor(traci.StepListener):
         self._traci_handler.simulation.subscribe(varIDs=(tc.VAR_PARKING_STARTING_VEHICLES_IDS,
                                                          tc.VAR_PARKING_ENDING_VEHICLES_IDS))
 
+        ## Parkings occupancy subscriptions
+        self._traci_parking_occupancy = self._options['subscriptions'].get('parking_occupancy',
+                                                                           False)
+        if self._traci_parking_occupancy:
+            for pid in self._parking_db:
+                self._traci_handler.parkingarea.subscribe(
+                    pid, varIDs=(tc.VAR_STOP_STARTING_VEHICLES_NUMBER,))
+
         ## StepListener registration
         if self._options['addStepListener']:
             self._traci_handler.addStepListener(self)
 
+        ## Pipelined mode
+        self._pipelined = options.get('pipelined', False)
+        if self._pipelined:
+            if self._options['addStepListener']:
+                raise ParkingMonitorGenericError(
+                    'The pipelined mode is not compatible with addStepListener.')
+            self._pipeline = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='pypml-pipeline')
+
+        ## the TraCI calls of the initialization are not part of the step statistics
+        if self._traci_counter is not None:
+            self._count_traci()
+
+    def _apply_parking_configurations(self):
+        """ Apply 'generic_conf' and 'specific_conf' to all the parkings.
+
+            The expressions are compiled once and the conditions are evaluated on the arrays of
+            the parking attributes, for all the parkings at once.
+        """
+        parkings = list(self._parking_db.values())
+        environment = build_environment(parkings)
+
+        ## Apply GENERAL CONFIGURATIONS
+        for gopt in self._options['generic_conf']:
+            selected = compile_expression(gopt['cond'])(environment)
+            selected = numpy.broadcast_to(numpy.asarray(selected, dtype=bool), (len(parkings),))
+            rows = numpy.flatnonzero(selected).tolist()
+            if not rows:
+                continue
+            for key, value in gopt['set_to']:
+                if key == 'uncertainty':
+                    ## only on the selected parkings: the expressions may not be valid for the
+                    ## others (e.g. a division by their capacity)
+                    rows_environment = {name: values[rows] for name, values in environment.items()}
+                    mu = compile_expression(value['mu'])(rows_environment)
+                    sigma = compile_expression(value['sigma'])(rows_environment)
+                    for pos, row in enumerate(rows):
+                        parkings[row]['uncertainty'] = {
+                            'mu': get_row_value(mu, pos),
+                            'sigma': get_row_value(sigma, pos),
+                        }
+                else:
+                    ## not sure what this can be
+                    for row in rows:
+                        parkings[row][key] = copy.deepcopy(value)
+                    if key in environment and isinstance(value, (int, float)):
+                        environment[key] = environment[key].copy()
+                        environment[key][rows] = value
+
+        ## Apply SPECIFIC VALUES
+        for row, (pid, parking) in enumerate(self._parking_db.items()):
+            if pid not in self._options['specific_conf'].keys():
+                continue
+            if 'capacity_by_class' in self._options['specific_conf'][pid]:
+                parking['capacity_by_class'] = copy.deepcopy(
+                    self._options['specific_conf'][pid]['capacity_by_class'])
+            if 'subscriptions_by_class' in self._options['specific_conf'][pid]:
+                parking['subscriptions_by_class'] = copy.deepcopy(
+                    self._options['specific_conf'][pid]['subscriptions_by_class'])
+            if 'uncertainty' in self._options['specific_conf'][pid]:
+                row_environment = get_row_environment(environment, row)
+                uncertainty = self._options['specific_conf'][pid]['uncertainty']
+                parking['uncertainty'] = {
+                    'mu': compile_expression(uncertainty['mu'])(row_environment),
+                    'sigma': compile_expression(uncertainty['sigma'])(row_environment),
+                }
+
     def _load_parkings_and_routers(self):
-        """ Load the parking and routers definition from SUMO add.xml and apply restrictions. """
+        """ Load the parking and routers definition from SUMO add.xml and apply restrictions.
+
+            The file is parsed incrementally and the elements are freed as soon as they are
+            processed. The rerouter intervals are sorted by end, with their begin and end
+            times in separate lists for the bisection in get_rerouter_iterator.
+        """
 
         filename = self._options['sumo_parking_file']
-        xml_tree = xml.etree.ElementTree.parse(filename).getroot()
 
-        for child in xml_tree:
-            if child.tag == 'parkingArea' and child.attrib['id'] not in self._options['blacklist']:
-                self._parking_db[child.attrib['id']] = {
-                    'sumo': child.attrib,
-                }
+        root = None
+        depth = 0
+        intervals = None
+        parkings = None
+        for event, element in xml.etree.ElementTree.iterparse(filename, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    root = element
+                elif depth == 2 and element.tag == 'rerouter':
+                    intervals = list()
+                elif depth == 3 and intervals is not None and element.tag == 'interval':
+                    parkings = list()
+                continue
+
+            depth -= 1
+            if depth == 1 and element.tag == 'parkingArea':
+                if element.attrib['id'] not in self._options['blacklist']:
+                    self._parking_db[element.attrib['id']] = {
+                        'sumo': dict(element.attrib),
+                    }
             ## rerouters
-            elif child.tag == 'rerouter':
-                self._routers_db[child.attrib['id']] = {
-                    'id': child.attrib['id'],
-                    'edges': child.attrib['edges'].strip(' ').split(' '),
-                    'intervals': list(),
+            elif depth == 3 and parkings is not None and element.tag == 'parkingAreaReroute':
+                if 'visible' in element.attrib and element.attrib['visible'] == 'true':
+                    parkings.append((element.attrib['id'], True))
+                else:
+                    parkings.append((element.attrib['id'], False))
+            elif depth == 2 and parkings is not None and element.tag == 'interval':
+                _begin = float(element.attrib.get('begin', 0)) * 1000 # interval in milliseconds
+                _end = float(element.attrib['end']) * 1000 # interval in milliseconds
+                intervals.append((_end, _begin, parkings))
+                parkings = None
+            elif depth == 1 and element.tag == 'rerouter':
+                intervals.sort(key=lambda interval: interval[0])
+                self._routers_db[element.attrib['id']] = {
+                    'id': element.attrib['id'],
+                    'edges': element.attrib['edges'].strip(' ').split(' '),
+                    'intervals': [(_end, _parkings) for _end, _, _parkings in intervals],
+                    'begins': [_begin for _, _begin, _ in intervals],
+                    'ends': [_end for _end, _, _ in intervals],
                 }
+                intervals = None
 
                 ## given and edge, retrieve the list of routers associated.
-                for edge in self._routers_db[child.attrib['id']]['edges']:
-                    self._edges_routers_mapping[edge].append(child.attrib['id'])
+                for edge in self._routers_db[element.attrib['id']]['edges']:
+                    self._edges_routers_mapping[edge].append(element.attrib['id'])
 
-                for interval in child:
-                    _end = float(interval.attrib['end']) * 1000 # interval in milliseconds
-                    parkings = list()
-                    for area in interval:
-                        if 'visible' in area.attrib and area.attrib['visible'] == 'true':
-                            parkings.append((area.attrib['id'], True))
-                        else:
-                            parkings.append((area.attrib['id'], False))
-                    self._routers_db[child.attrib['id']]['intervals'].append((_end, parkings))
+            if depth == 1:
+                ## the top level element is completely processed
+                root.clear()
 
         if self._routers_db:
             if self._logger:
@@ -290,64 +594,6 @@ class ParkingMonitor(traci.StepListener):
                                      files have priority over any TraCI API
                                      (e.g. traci.vehicle.rerouteParkingArea).""")
 
-
-    @staticmethod
-    def _get_operator(oper):
-        """ Return the function associated to the operator. """
-        return {
-            'and': operator.and_,
-            'or': operator.or_,
-            '>': operator.gt,
-            '>=': operator.ge,
-            '=': operator.eq,
-            '<=': operator.le,
-            '<': operator.lt,
-            '+': operator.add,
-            '-': operator.sub,
-            '*': operator.mul,
-            '/': operator.truediv,
-            '**': operator.pow,
-        }[oper]
-
-    def _parse_generic_condition(self, condition, environment):
-        """ Parse the generic condition and returns True or False accordingly. """
-        oper, operand_1, operand_2 = condition
-
-        if isinstance(operand_1, list):
-            operand_1 = self._parse_generic_condition(operand_1, environment)
-        if isinstance(operand_2, list):
-            operand_2 = self._parse_generic_condition(operand_2, environment)
-
-        if operand_1 in environment:
-            operand_1 = environment[operand_1]
-        if operand_2 in environment:
-            operand_2 = environment[operand_2]
-
-        return self._get_operator(oper)(operand_1, operand_2)
-
-    def _eval_expression(self, expr, environment):
-        """ Evaluate an expression in the enviroment. """
-        ## usual case with simple evaluation
-        if not isinstance(expr, list):
-            if expr in environment:
-                return environment[expr]
-            return expr
-
-        ## complex expression
-        oper, operand_1, operand_2 = expr
-
-        if isinstance(operand_1, list):
-            operand_1 = self._eval_expression(operand_1, environment)
-        if isinstance(operand_2, list):
-            operand_2 = self._eval_expression(operand_2, environment)
-
-        if operand_1 in environment:
-            operand_1 = environment[operand_1]
-        if operand_2 in environment:
-            operand_2 = environment[operand_2]
-
-        return self._get_operator(oper)(operand_1, operand_2)
-
     ## ===============================         OVERLOADS         =============================== ##
 
     def step(self, t=0):
@@ -356,14 +602,238 @@ class ParkingMonitor(traci.StepListener):
             In order to be independent from the call, t is not used and the time is directly
             retrieved using simulation.getTime().
         """
+        if self._step_stats is not None:
+            return self._instrumented_step()
         time = self._traci_handler.simulation.getTime()
+        self._time = time
+        self._parking_store.clear_dirty()
+        self._rerouted.clear()
         self._monitor_vehicles(time)
         self._update_vehicles_db(time)
         self._update_parking_db(time)
+        if self._vehicles_archive is not None:
+            self._archive_vehicles(time)
+        if self._travel_time_refresher is not None and not self._pipelined:
+            self._refresh_travel_time(time)
         return True
 
+    def _count_traci(self):
+        """ Return the (calls, bytes sent, bytes received) of the TraCI counter since the
+            previous time. """
+        counter = self._traci_counter
+        current = (counter.calls, counter.bytes_sent, counter.bytes_received)
+        mark, self._traci_mark = self._traci_mark, current
+        return tuple(now - before for now, before in zip(current, mark))
+
+    def _instrumented_step(self):
+        """ Same as step(), measuring every phase. """
+        self._validation_time = 0.0
+
+        start = timeit.default_timer()
+        time = self._traci_handler.simulation.getTime()
+        self._time = time
+        self._parking_store.clear_dirty()
+        self._rerouted.clear()
+        self._monitor_vehicles(time)
+        monitor_done = timeit.default_timer()
+        self._update_vehicles_db(time)
+        vehicles_done = timeit.default_timer()
+        self._update_parking_db(time)
+        parkings_done = timeit.default_timer()
+        if self._vehicles_archive is not None:
+            self._archive_vehicles(time)
+        if self._travel_time_refresher is not None and not self._pipelined:
+            self._refresh_travel_time(time)
+        end = timeit.default_timer()
+
+        if self._pipelined:
+            ## the step runs on the snapshot, in the worker: the calls are the ones counted by
+            ## the thread owning the connection up to the prefetch of the step
+            calls, sent, received = self._prefetch_traci
+        else:
+            calls, sent, received = self._count_traci()
+        self._step_stats.add({
+            'step_time': end - start,
+            'monitor_vehicles_time': monitor_done - start,
+            'update_vehicles_db_time': vehicles_done - monitor_done,
+            'update_parking_db_time': parkings_done - vehicles_done,
+            'validation_time': self._validation_time,
+            ## since the previous step, simulation step included
+            'traci_calls': calls,
+            'traci_bytes_sent': sent,
+            'traci_bytes_received': received,
+            'vehicles': len(self._vehicles_db),
+            'passengers': len(self._passengers_db),
+            'parkings': len(self._parking_db),
+            'archived_vehicles': self.get_archive_size(),
+        })
+
+        period = self._options['instrumentation'].get('metrics_period', 100)
+        filename = self._options['instrumentation'].get('metrics_file')
+        if filename and self._step_stats.steps % period == 0:
+            dump_metrics(filename, self._step_stats.summary())
+        return True
+
+    def get_step_stats(self):
+        """ Return the statistics of the last steps, or None without instrumentation.
+
+            Format:
+            {
+                'steps': Integer. Number of steps measured.
+                'window': Integer. Number of steps used for the statistics.
+                'last': Dict. { metric: value } of the last step.
+                'mean', 'max', 'p50', 'p90', 'p99': Dict. { metric: value } over the window.
+            }
+            The metrics are the times (in seconds) of the step, of its phases
+            ('monitor_vehicles_time', 'update_vehicles_db_time', 'update_parking_db_time') and
+            of the validation (part of 'update_parking_db_time'), the TraCI calls and bytes sent
+            and received by the monitor since the previous step, and the sizes of the databases
+            ('vehicles', 'passengers', 'parkings', 'archived_vehicles'). With 'pipelined', the
+            TraCI calls of a step are the ones made up to its prefetch: the simulation step and
+            the delayed calls of the previous step, and the prefetch itself.
+        """
+        if self._step_stats is None:
+            return None
+        return self._step_stats.summary()
+
+    def simulation_step(self):
+        """ Advance the simulation of one step and update the monitor.
+
+            Without 'pipelined', it is the same as calling simulationStep() on the TraCI handler
+            (and step(), if the monitor is not a step listener).
+
+            With 'pipelined', the TraCI results required by the step are retrieved first, and
+            a worker thread updates the monitor with them while SUMO simulates the following
+            step. The retrieval (and the delayed subscriptions) are TraCI calls made serially on
+            the connection, before and after the simulation step: only the Python processing
+            of the monitor overlaps with SUMO. When it returns, the worker is done and the monitor reflects the simulation
+            step before the current one: this is the consistency point for the queries, and
+            sync() processes the current step as well. The callbacks are called in the worker,
+            where they cannot use TraCI, and the subscriptions of the vehicles that departed
+            are made with one step of delay.
+        """
+        if not self._pipelined:
+            self._traci_handler.simulationStep()
+            if not self._options['addStepListener']:
+                self.step()
+            return
+
+        traci_handler = self._traci_handler
+        snapshot, processing = None, None
+        if not self._synced:
+            snapshot = TraCISnapshot(traci_handler)
+            self._prefetch_step(snapshot)
+            if self._traci_counter is not None:
+                self._prefetch_traci = self._count_traci()
+            processing = self._pipeline.submit(self._snapshot_step, snapshot)
+        try:
+            traci_handler.simulationStep()
+        finally:
+            if snapshot is not None:
+                processing.result()
+                self._complete_snapshot_step(snapshot)
+        self._synced = False
+
+    def sync(self):
+        """ With 'pipelined', process the current simulation step in the calling thread, if it
+            was not processed yet, so that the monitor reflects the current simulation time. """
+        if not self._pipelined or self._synced:
+            return
+        snapshot = TraCISnapshot(self._traci_handler)
+        self._prefetch_step(snapshot)
+        if self._traci_counter is not None:
+            self._prefetch_traci = self._count_traci()
+        self._snapshot_step(snapshot)
+        self._complete_snapshot_step(snapshot)
+        self._synced = True
+
+    def _prefetch_step(self, snapshot):
+        """ Retrieve in the snapshot the TraCI results used by step(). """
+        snapshot.read('simulation', 'getTime')
+        only_parkings = self._options['subscriptions']['only_parkings']
+        for vehicle in snapshot.read('simulation', 'getDepartedIDList') or ():
+            v_class = snapshot.read('vehicle', 'getVehicleClass', vehicle)
+            if only_parkings and v_class in ['bus', 'rail']:
+                continue
+            stops = snapshot.read('vehicle', 'getNextStops', vehicle) or ()
+            if only_parkings and not any(self.is_parking_area(_normalize_stop(stop)[3])
+                                         for stop in stops):
+                continue
+            snapshot.read('vehicle', 'getPersonIDList', vehicle)
+        snapshot.read('simulation', 'getArrivedIDList')
+        subscriptions = snapshot.read('vehicle', 'getAllSubscriptionResults') or {}
+        if not self._next_stops_subscription:
+            for vehicle in subscriptions:
+                snapshot.read('vehicle', 'getNextStops', vehicle)
+        if self._traci_parking_occupancy:
+            snapshot.read('parkingarea', 'getAllSubscriptionResults')
+        else:
+            for parking in self._parking_db:
+                snapshot.read('simulation', 'getParameter', parking, 'parkingArea.occupancy')
+        snapshot.read('simulation', 'getAllSubscriptionResults')
+
+    def _snapshot_step(self, snapshot):
+        """ Run step() answering the TraCI calls with the snapshot. """
+        traci_handler = self._traci_handler
+        self._traci_handler = snapshot
+        try:
+            self.step()
+        finally:
+            self._traci_handler = traci_handler
+
+    def _complete_snapshot_step(self, snapshot):
+        """ Make the TraCI calls queued by the step, and the ones step() leaves to the thread
+            owning the TraCI connection. """
+        for _, name, args, excpt in snapshot.apply_writes():
+            ## the vehicle may have left the simulation in the meantime
+            if self._logger:
+                self._logger.warning('[%.2f] Delayed %s of %s failed: %s',
+                                     self._time, name, args[0], excpt)
+        if self._travel_time_refresher is not None:
+            self._refresh_travel_time(self._time)
+
+    def get_traci_handler(self):
+        """ Return the TraCI handler used by the monitor (e.g. the one created with the
+            'backend' option, to run the simulation). """
+        return self._traci_backend
+
+    def close(self):
+        """ Flush and stop the background logging, if any, remove the log handlers of the
+            monitor, and close the vehicles archive, the spilled occupancy series and the TraCI
+            handler created with the 'backend' option.
+        """
+        if self._pipeline is not None:
+            self._pipeline.shutdown()
+            self._pipeline = None
+        if self._log_handlers:
+            for handler in self._log_handlers:
+                self._logger.removeHandler(handler)
+            self._log_handlers = None
+            self._logger.propagate = True
+        if self._log_listener:
+            atexit.unregister(self._log_listener.stop)
+            self._log_listener.stop()
+            for handler in self._log_listener.handlers:
+                handler.close()
+            self._log_listener = None
+        if self._vehicles_archive is not None:
+            self._vehicles_archive.close()
+            self._vehicles_archive = None
+        if 'spill_dir' in self._options.get('occupancy_series', {}):
+            for parking in self._parking_db.values():
+                parking['occupancy_series'].close()
+        if self._owns_traci_handler:
+            self._traci_backend.close()
+            self._owns_traci_handler = False
+
     ## ===============================         UTILITIES         =============================== ##
 
+    def _export(self, value):
+        """ Return the value in a form that cannot be used to modify the internal state. """
+        if self._read_only_views:
+            return read_only(value)
+        return copy.deepcopy(value)
+
     @staticmethod
     def is_parking_area(flags):
         """ isStoppedParking(string) -> bool
@@ -402,7 +872,8 @@ class ParkingMonitor(traci.StepListener):
             if self._options['subscriptions']['only_parkings'] and v_class in ['bus', 'rail']:
                 continue
 
-            current_stops = self._traci_handler.vehicle.getNextStops(vehicle)
+            current_stops = tuple(map(_normalize_stop,
+                                      self._traci_handler.vehicle.getNextStops(vehicle)))
             _parking_stops = set()
             for stop in current_stops:
                 _, _, stopping_place, stop_flags, _, _ = stop
@@ -416,133 +887,181 @@ class ParkingMonitor(traci.StepListener):
             for passenger in passengers:
                 self._passengers_db.add(passenger)
 
-            if self._logger:
+            if self._log_debug:
                 self._logger.debug('[%.2f] Vehicle %s added to subscriptions.', step, vehicle)
-            self._traci_handler.vehicle.subscribe(
-                vehicle, varIDs=(tc.VAR_ROAD_ID, tc.VAR_NEXT_STOPS, tc.LAST_STEP_PERSON_ID_LIST))
-
-            self._vehicles_db[vehicle] = {
-                'id': vehicle,
-                'departure': step,
-                'edge': '',
-                'stops': current_stops,
-                'history': [],
-                'vClass': v_class,
-                'passengers': passengers,
-                'arrived': None,
-                'stopped': False,
-                'roadside': False,
-                'current_parking_area': None,
-            }
+            if self._next_stops_subscription:
+                self._traci_handler.vehicle.subscribe(
+                    vehicle,
+                    varIDs=(tc.VAR_ROAD_ID, tc.VAR_NEXT_STOPS, tc.LAST_STEP_PERSON_ID_LIST))
+            else:
+                self._traci_handler.vehicle.subscribe(
+                    vehicle, varIDs=(tc.VAR_ROAD_ID, tc.LAST_STEP_PERSON_ID_LIST))
+
+            self._vehicles_db[vehicle] = VehicleRecord(
+                vehicle, step, intern_stops(current_stops, self._stops_table), v_class,
+                passengers)
+            self._vehicle_index.update(self._vehicles_db[vehicle])
 
             ## update parking projections
             for area in _parking_stops:
-                self._parking_db[area]['projections_by_class'][v_class].add(vehicle)
-                if self._logger:
+                self._add_vehicle_to_parking(area, PROJECTIONS, v_class, vehicle)
+                if self._log_debug:
                     self._logger.debug('[%.2f] Vehicle %s added to the projections of %s.',
                                        step, vehicle, area)
 
+            if self._callbacks['on_vehicle_departed']:
+                self._fire('on_vehicle_departed', step, vehicle)
+
         self._traci_arrived_list = self._traci_handler.simulation.getArrivedIDList()
         for vehicle in self._traci_arrived_list:
             if vehicle in self._vehicles_db:
                 self._vehicles_db[vehicle]['arrived'] = step
-                if self._logger:
+                self._vehicle_index.update(self._vehicles_db[vehicle])
+                if self._archive_queue is not None:
+                    self._archive_queue.append((step, vehicle))
+                if self._log_debug:
                     self._logger.debug('[%.2f] Vehicle %s has arrived.', step, vehicle)
+                if self._callbacks['on_vehicle_arrived']:
+                    self._fire('on_vehicle_arrived', step, vehicle)
 
                 ## TODO: cleanup the parking areas --> Ask Jakob.
                 parking_area = self._get_parking_area_from_vehicle(vehicle)
                 if parking_area:
                     v_class = self._vehicles_db[vehicle]['vClass']
                     if vehicle in self._parking_db[parking_area]['projections_by_class'][v_class]:
-                        if self._logger:
+                        if self._log_debug:
                             self._logger.debug(
                                 '[%.2f] Vehicle %s removed from the projections of %s.',
                                 step, vehicle, parking_area)
                     if vehicle in self._parking_db[parking_area]['occupancy_by_class'][v_class]:
-                        if self._logger:
+                        if self._log_debug:
                             self._logger.debug(
                                 '[%.2f] Vehicle %s removed from parking area %s.',
                                 step, vehicle, parking_area)
 
-    @staticmethod
-    def _is_same_destinations(a_stops, b_stops):
-        """ Return true iff the series of stops ids is the same. """
-        if len(a_stops) != len(b_stops):
-            return False
-        nmr_stops = len(a_stops)
-        for pos in range(nmr_stops):
-            if a_stops[pos][2] != b_stops[pos][2]:
-                return False
-        return True
-
     def _update_vehicles_db(self, step):
         """ Update subscriptions and vechiles database. """
         self._traci_vehicle_subscription = self._traci_handler.vehicle.getAllSubscriptionResults()
         for vehicle, data in self._traci_vehicle_subscription.items():
+            record = self._vehicles_db[vehicle]
             ## always to update
-            self._vehicles_db[vehicle]['edge'] = data[tc.VAR_ROAD_ID]
-            self._vehicles_db[vehicle]['passengers'] = data[tc.LAST_STEP_PERSON_ID_LIST]
-            for passenger in data[tc.LAST_STEP_PERSON_ID_LIST]:
-                self._passengers_db.add(passenger)
+            record.edge = sys.intern(data[tc.VAR_ROAD_ID])
+            record.passengers = data[tc.LAST_STEP_PERSON_ID_LIST]
+            self._passengers_db.update(record.passengers)
 
-            ## stop check
-            current_stops = data[tc.VAR_NEXT_STOPS]
-            _new_stops = set()
-            for stop in current_stops:
-                _, _, stopping_place, stop_flags, _, _ = stop
-                if self.is_parking_area(stop_flags):
-                    _new_stops.add(stopping_place)
-
-            if self._is_same_destinations(self._vehicles_db[vehicle]['stops'], current_stops):
-                ## nothing changed
+            ## stop check: same sequence of stopping places, nothing changed
+            if self._next_stops_subscription:
+                current_stops = data[tc.VAR_NEXT_STOPS]
+            else:
+                current_stops = tuple(map(_normalize_stop,
+                                          self._traci_handler.vehicle.getNextStops(vehicle)))
+            fingerprint = get_stops_fingerprint(current_stops)
+            if fingerprint == record.fingerprint:
                 continue
 
-            if self._logger:
+            if self._log_debug:
                 self._logger.debug('[%.2f] Stop change for %s.', step, vehicle)
 
             ## update parking projections
+            _new_stops = set()
+            for _, _, _stop, _flags, _, _ in current_stops:
+                if self.is_parking_area(_flags):
+                    _new_stops.add(_stop)
             _old_stops = set()
-            for _, _, _stop, _flags, _, _ in self._vehicles_db[vehicle]['stops']:
+            for _, _, _stop, _flags, _, _ in record.stops:
                 if self.is_parking_area(_flags):
                     _old_stops.add(_stop)
-            v_class = self._vehicles_db[vehicle]['vClass']
+            v_class = record.vClass
             for area in _old_stops - _new_stops:
                 ## the vehicle may have already been removed (when added to occupancy_by_vclass)
                 ## if the change in stops is due to a vehilce leaving the parking
                 if vehicle in self._parking_db[area]['projections_by_class'][v_class]:
-                    self._parking_db[area]['projections_by_class'][v_class].remove(vehicle)
-                    if self._logger:
+                    self._remove_vehicle_from_parking(area, PROJECTIONS, v_class, vehicle)
+                    if self._log_debug:
                         self._logger.debug('[%.2f] Vehicle %s removed from the projections of %s.',
                                            step, vehicle, area)
             for area in _new_stops - _old_stops:
-                self._parking_db[area]['projections_by_class'][v_class].add(vehicle)
-                if self._logger:
+                self._add_vehicle_to_parking(area, PROJECTIONS, v_class, vehicle)
+                if self._log_debug:
                     self._logger.debug('[%.2f] Vehicle %s added to the projections of %s.',
                                        step, vehicle, area)
+            if self._callbacks['on_projection_changed'] and _old_stops != _new_stops:
+                self._fire('on_projection_changed', step, vehicle,
+                           frozenset(_old_stops - _new_stops), frozenset(_new_stops - _old_stops))
 
             ## update stops
-            self._vehicles_db[vehicle]['history'].append(
-                self._vehicles_db[vehicle]['stops'])
-            self._vehicles_db[vehicle]['stops'] = current_stops
+            record.push_stops(intern_stops(current_stops, self._stops_table), fingerprint)
+            self._vehicle_index.update(record)
 
             if self._options['subscriptions']['only_parkings'] and not current_stops:
-                if self._logger:
+                if self._log_debug:
                     self._logger.debug('[%.2f] Unsubscribing from vehicle %s, no additional stops.',
                                        step, vehicle)
                 try:
                     self._traci_handler.vehicle.unsubscribe(vehicle)
-                except traci.exceptions.TraCIException:
+                except exceptions.TraCIException:
                     if self._logger:
                         self._logger.critical('[%.2f] Unsubscription failed.', step)
 
     def _check_occupancy(self, step):
         """ Gather parking current occupancy. """
+        if self._traci_parking_occupancy:
+            ## all the occupancies come with a single subscription result
+            self._traci_parkingarea_subscriptions = (
+                self._traci_handler.parkingarea.getAllSubscriptionResults())
+            for parking, data in self._traci_parkingarea_subscriptions.items():
+                if parking in self._parking_db:
+                    self._update_total_occupancy(
+                        parking, int(data[tc.VAR_STOP_STARTING_VEHICLES_NUMBER]), step)
+            return
+
         for parking in self._parking_db:
             occupancy = int(self._traci_handler.simulation.getParameter(parking,
                                                                         'parkingArea.occupancy'))
-            if self._parking_db[parking]['total_occupancy'] != occupancy:
-                self._parking_db[parking]['occupancy_series'].append((occupancy, step))
-                self._parking_db[parking]['total_occupancy'] = occupancy
+            self._update_total_occupancy(parking, occupancy, step)
+
+    def _update_total_occupancy(self, parking, occupancy, step):
+        """ Update the parking total occupancy and its series, if it changed. """
+        if self._parking_db[parking]['total_occupancy'] != occupancy:
+            self._parking_db[parking]['occupancy_series'].append((occupancy, step))
+            self._parking_db[parking]['total_occupancy'] = occupancy
+            self._parking_store.set_total_occupancy(parking, occupancy)
+
+    def _get_memberships(self, parking, v_class, vehicle):
+        """ Return the membership of the vehicle to the (occupancy, projections, subscriptions)
+            of the parking area for the given vClass. """
+        subscribed = False
+        if v_class in self._parking_db[parking]['subscriptions_by_class']:
+            subscribed = (
+                vehicle in self._parking_db[parking]['subscriptions_by_class'][v_class][1])
+        return (vehicle in self._parking_db[parking]['occupancy_by_class'][v_class],
+                vehicle in self._parking_db[parking]['projections_by_class'][v_class],
+                subscribed)
+
+    def _add_vehicle_to_parking(self, parking, kind, v_class, vehicle):
+        """ Add the vehicle to the occupancy (kind=OCCUPANCY) or to the projections
+            (kind=PROJECTIONS) of the parking area, keeping the parking store in sync. """
+        if kind == OCCUPANCY:
+            vehicles = self._parking_db[parking]['occupancy_by_class'][v_class]
+        else:
+            vehicles = self._parking_db[parking]['projections_by_class'][v_class]
+        if vehicle in vehicles:
+            return
+        vehicles.add(vehicle)
+        self._parking_store.update(parking, v_class, kind, 1,
+                                   self._get_memberships(parking, v_class, vehicle))
+
+    def _remove_vehicle_from_parking(self, parking, kind, v_class, vehicle):
+        """ Remove the vehicle from the occupancy (kind=OCCUPANCY) or from the projections
+            (kind=PROJECTIONS) of the parking area, keeping the parking store in sync.
+            Raises KeyError if the vehicle is not there. """
+        if kind == OCCUPANCY:
+            vehicles = self._parking_db[parking]['occupancy_by_class'][v_class]
+        else:
+            vehicles = self._parking_db[parking]['projections_by_class'][v_class]
+        vehicles.remove(vehicle)
+        self._parking_store.update(parking, v_class, kind, -1,
+                                   self._get_memberships(parking, v_class, vehicle))
 
     def _get_parking_area_from_vehicle(self, vehicle):
         """ Return the parking area ID of the 'current' stop. """
@@ -570,20 +1089,24 @@ class ParkingMonitor(traci.StepListener):
                             step, vehicle)
                     continue
                 self._vehicles_db[vehicle]['stopped'] = False
-                if self._logger:
+                self._vehicle_index.update(self._vehicles_db[vehicle])
+                if self._log_debug:
                     self._logger.debug('[%.2f] Vehicle %s is not stopped anymore.',
                                        step, vehicle)
 
                 parking_area = self._vehicles_db[vehicle]['current_parking_area']
                 if not parking_area and self._vehicles_db[vehicle]['roadside']:
                     self._vehicles_db[vehicle]['roadside'] = False
+                    self._vehicle_index.update(self._vehicles_db[vehicle])
+                    if self._callbacks['on_parking_ended']:
+                        self._fire('on_parking_ended', step, vehicle, None)
                 else:
                     if parking_area in self._parking_db:
                         v_class = self._vehicles_db[vehicle]['vClass']
                         try:
-                            self._parking_db[parking_area]['occupancy_by_class'][v_class].remove(
-                                vehicle)
-                            if self._logger:
+                            self._remove_vehicle_from_parking(parking_area, OCCUPANCY, v_class,
+                                                              vehicle)
+                            if self._log_debug:
                                 self._logger.debug('[%.2f] Vehicle %s removed from %s.',
                                                    step, vehicle, parking_area)
                         except KeyError:
@@ -595,8 +1118,10 @@ class ParkingMonitor(traci.StepListener):
                                 '[{}] Vehicle {} cannot be removed from area {}.'.format(
                                     step, vehicle, parking_area))
                         _to_validate.add(parking_area)
+                        if self._callbacks['on_parking_ended']:
+                            self._fire('on_parking_ended', step, vehicle, parking_area)
                     else:
-                        if self._logger:
+                        if self._log_debug:
                             self._logger.debug('[%.2f] Parking area %s not monitored.',
                                                step, parking_area)
 
@@ -616,7 +1141,8 @@ class ParkingMonitor(traci.StepListener):
                                              step, vehicle)
                     continue
                 self._vehicles_db[vehicle]['stopped'] = True
-                if self._logger:
+                self._vehicle_index.update(self._vehicles_db[vehicle])
+                if self._log_debug:
                     self._logger.debug('[%.2f] Vehicle %s is stopping.', step, vehicle)
 
                 parking_area = self._get_parking_area_from_vehicle(vehicle)
@@ -626,18 +1152,20 @@ class ParkingMonitor(traci.StepListener):
                         if self._vehicles_db[vehicle]['edge'] == parking_edge:
                             v_class = self._vehicles_db[vehicle]['vClass']
                             self._vehicles_db[vehicle]['current_parking_area'] = parking_area
-                            self._parking_db[parking_area]['projections_by_class'][v_class].remove(
-                                vehicle)
-                            if self._logger:
+                            self._remove_vehicle_from_parking(parking_area, PROJECTIONS,
+                                                              v_class, vehicle)
+                            if self._log_debug:
                                 self._logger.debug(
                                     '[%.2f] Vehicle %s removed from the projections of %s.',
                                     step, vehicle, parking_area)
-                            self._parking_db[parking_area]['occupancy_by_class'][v_class].add(
-                                vehicle)
-                            if self._logger:
+                            self._add_vehicle_to_parking(parking_area, OCCUPANCY, v_class,
+                                                         vehicle)
+                            if self._log_debug:
                                 self._logger.debug('[%.2f] Vehicle %s added to %s.',
                                                    step, vehicle, parking_area)
                             _to_validate.add(parking_area)
+                            if self._callbacks['on_parking_started']:
+                                self._fire('on_parking_started', step, vehicle, parking_area)
                         else:
                             import pprint
                             pprint.pprint(self._vehicles_db[vehicle])
@@ -646,49 +1174,135 @@ class ParkingMonitor(traci.StepListener):
                                     vehicle, self._vehicles_db[vehicle]['edge'],
                                     parking_area, parking_edge))
                     else:
-                        if self._logger:
+                        if self._log_debug:
                             self._logger.debug('[%.2f] Parking area %s not monitored.',
                                                step, parking_area)
                 else:
                     self._vehicles_db[vehicle]['roadside'] = True
                     self._vehicles_db[vehicle]['current_parking_area'] = None
-                    if self._logger:
+                    self._vehicle_index.update(self._vehicles_db[vehicle])
+                    if self._log_debug:
                         self._logger.debug(
                             '[%.2f] Vehicle %s is stopping outside a parking area.', step, vehicle)
+                    if self._callbacks['on_parking_started']:
+                        self._fire('on_parking_started', step, vehicle, None)
 
+        if self._step_stats is not None:
+            validation_start = timeit.default_timer()
         for pid in _to_validate:
             try:
                 self._validate_parking_occupancy(pid)
             except ParkingMonitorGenericError as excpt:
                 if self._logger:
                     self._logger.critical('%s', str(excpt))
+        if self._step_stats is not None:
+            self._validation_time = timeit.default_timer() - validation_start
+
+        if self._callbacks['on_parking_overbooked']:
+            self._check_overbooking(step)
+
+    def _check_overbooking(self, step):
+        """ Fire 'on_parking_overbooked' for the parkings changed in this step that became
+            overbooked, with more vehicles (occupancy and projections) than places. """
+        for parking in self._parking_store.dirty:
+            free = self._parking_store.free_places_row(self._parking_store.index[parking],
+                                                       with_projections=True)
+            overbooked = min(free) < 0 if isinstance(free, tuple) else free < 0
+            if not overbooked:
+                self._overbooked.discard(parking)
+            elif parking not in self._overbooked:
+                self._overbooked.add(parking)
+                self._fire('on_parking_overbooked', step, parking)
+
+    ## ===============================          CALLBACKS         ============================== ##
+
+    def register_callback(self, event, callback):
+        """ Register the callback for the given event, it is called in the monitor step.
+            Raises an ParkingMonitorGenericError if the event does not exist.
+
+            Events and callback arguments:
+                'on_vehicle_departed':   callback(step, vehicle)
+                'on_vehicle_arrived':    callback(step, vehicle)
+                'on_parking_started':    callback(step, vehicle, parking), parking is None for
+                                         a stop outside a parking area.
+                'on_parking_ended':      callback(step, vehicle, parking), parking is None for
+                                         a stop outside a parking area.
+                'on_projection_changed': callback(step, vehicle, removed, added), with the
+                                         frozensets of parking areas removed from and added to
+                                         the stops of the vehicle.
+                'on_parking_overbooked': callback(step, parking), when occupancy and projections
+                                         exceed the capacity (by vClass, if defined).
+            An exception raised by a callback is logged (also without the 'logging' handlers,
+            with the 'parkingmonitor.ParkingMonitor' logger) and does not interrupt the step,
+            nor the other callbacks.
+
+            event:    String. Event name.
+            callback: Callable.
+        """
+        if event not in self._callbacks:
+            raise ParkingMonitorGenericError('Event {} does not exist.'.format(event))
+        self._callbacks[event].append(callback)
+
+    def remove_callback(self, event, callback):
+        """ Remove the callback registered for the given event.
+            Returns False if the callback was not registered.
+
+            event:    String. Event name.
+            callback: Callable.
+        """
+        if event in self._callbacks and callback in self._callbacks[event]:
+            self._callbacks[event].remove(callback)
+            return True
+        return False
+
+    def _fire(self, event, *args):
+        """ Call the callbacks registered for the event, logging their exceptions. """
+        for callback in self._callbacks[event]:
+            try:
+                callback(*args)
+            except Exception: # pylint: disable=broad-except
+                ## the step must complete, to keep the databases consistent
+                logger = self._logger or logging.getLogger('parkingmonitor.ParkingMonitor')
+                logger.exception('[%.2f] Callback %r for %s failed.', args[0], callback, event)
 
     ## ===============================    TRACI SUBSCRIPTIONS     ============================== ##
 
     def get_traci_vehicle_subscriptions(self):
         """ Return TraCI vehicle subscriptions for the last simulation-step. """
-        return copy.deepcopy(self._traci_vehicle_subscription)
+        return self._export(self._traci_vehicle_subscription)
 
     def get_traci_simulation_subscriptions(self):
         """ Return TraCI simulation subscriptions for the last simulation-step. """
-        return copy.deepcopy(self._traci_simulation_subscriptions)
+        return self._export(self._traci_simulation_subscriptions)
+
+    def get_traci_parkingarea_subscriptions(self):
+        """ Return TraCI parkingarea subscriptions for the last simulation-step.
+            They are available only if 'parking_occupancy' subscriptions are enabled.
+        """
+        return self._export(self._traci_parkingarea_subscriptions)
 
     ## ===============================          REROUTERS         ============================== ##
 
     def get_rerouter_iterator(self, step):
         """ Return the rerouter info for the given step.
+            The info is the list of (parking id, visible) of the interval active at the given
+            step: the first one, by end, with begin <= step <= end (both in seconds, as in the
+            SUMO additional file). Outside all the intervals (before the first begin, after
+            the last end, or in a gap between two intervals) the info is None.
+            Until release 0.2 the step was compared with the ends in milliseconds, and the
+            first interval was returned outside of them.
 
             step: Float. Simulation time in seconds.
         """
+        _step = step * 1000 # intervals in milliseconds
         for value in self._routers_db.values():
             current = None
-            for end, parkings in value['intervals']:
-                if not current:
-                    current = parkings
-                if step <= end:
-                    current = parkings
-                else:
-                    break
+            pos = bisect.bisect_left(value['ends'], _step)
+            ## with nested intervals, the first ending after the step may not be begun yet
+            while pos < len(value['ends']) and value['begins'][pos] > _step:
+                pos += 1
+            if pos < len(value['ends']):
+                current = value['intervals'][pos][1]
             yield {
                 'id': value['id'],
                 'edges': value['edges'],
@@ -706,17 +1320,65 @@ class ParkingMonitor(traci.StepListener):
 
     def get_vehicle_iterator(self):
         """ Return the vehicle info. """
-        for value in self._vehicles_db.values():
-            yield value
+        if self._read_only_views:
+            for value in self._vehicles_db.values():
+                yield read_only(value)
+        else:
+            for value in self._vehicles_db.values():
+                yield value
 
     def get_vehicle(self, vehicle):
         """ Return the vehicle with the given ID or None if not existent.
+            The archived vehicles are retrieved from the archive.
 
             vehicle: String. Vehicle ID as defined in SUMO.
         """
         if vehicle in self._vehicles_db:
-            return copy.deepcopy(self._vehicles_db[vehicle])
-        return None
+            return self._export(self._vehicles_db[vehicle])
+        return self.get_archived_vehicle(vehicle)
+
+    def _archive_vehicles(self, step):
+        """ Move the vehicles arrived more than 'grace_period' seconds ago to the archive.
+
+            Vehicles are archived from the step after their arrival at the earliest, once the
+            parking events delayed by one step have been processed.
+        """
+        archived = []
+        while (self._archive_queue and
+               self._archive_queue[0][0] < step - self._archive_grace_period):
+            _, vehicle = self._archive_queue.popleft()
+            if vehicle in self._vehicles_db:
+                archived.append(self._vehicles_db.pop(vehicle))
+                self._vehicle_index.remove(vehicle)
+        if archived:
+            self._vehicles_archive.add(archived)
+            if self._log_debug:
+                self._logger.debug('[%.2f] %d vehicles archived.', step, len(archived))
+
+    def get_archived_vehicle(self, vehicle):
+        """ Return the archived vehicle with the given ID or None if not archived.
+
+            vehicle: String. Vehicle ID as defined in SUMO.
+        """
+        if self._vehicles_archive is None:
+            return None
+        record = self._vehicles_archive.get(vehicle)
+        if record is None:
+            return None
+        ## same type as the live vehicles
+        return self._export(record)
+
+    def get_archived_vehicle_iterator(self):
+        """ Return the iterator over the archived vehicles, in order of arrival. """
+        if self._vehicles_archive is None:
+            return iter(())
+        return map(self._export, self._vehicles_archive)
+
+    def get_archive_size(self):
+        """ Return the number of archived vehicles. """
+        if self._vehicles_archive is None:
+            return 0
+        return len(self._vehicles_archive)
 
     def set_vehicle_param(self, vehicle, param, value):
         """ Set the param=value in the vehicle with the given ID.
@@ -728,15 +1390,32 @@ class ParkingMonitor(traci.StepListener):
             """
         if vehicle in self._vehicles_db:
             self._vehicles_db[vehicle][param] = copy.deepcopy(value)
+            self._vehicle_index.update(self._vehicles_db[vehicle])
             return True
         return False
 
+    def get_vehicle_ids(self, state=None, parking=None, vclass=None, subscribed=None):
+        """ Return the set of IDs of the vehicles in the vehicle database matching all the
+            given filters, using the secondary indexes. A filter set to None is not applied.
+            Raises an ParkingMonitorGenericError if the state does not exist.
+
+            state:      String. 'driving', 'stopped' (in a parking area), 'roadside' or
+                        'arrived'.
+            parking:    String. Parking area ID of the first parking area in the stops of the
+                        vehicle (where it is heading to or parked).
+            vclass:     String. vClass as defined in SUMO.
+            subscribed: Boolean. Whether the vehicle is subscribed to at least a parking area.
+        """
+        if state is not None and state not in STATES:
+            raise ParkingMonitorGenericError('State {} does not exist.'.format(state))
+        return self._vehicle_index.query(state, parking, vclass, subscribed)
+
     ## ===============================          PARKINGS         =============================== ##
 
     def get_parking_iterator(self):
         """ Return the parking iterator. """
         for value in self._parking_db.values():
-            yield copy.deepcopy(value)
+            yield self._export(value)
 
     def get_parking(self, parking):
         """ Return the parking area with the given ID or None if not existent.
@@ -744,52 +1423,198 @@ class ParkingMonitor(traci.StepListener):
             parking: String. Parking area ID as defined in SUMO.
         """
         if parking in self._parking_db:
-            return copy.deepcopy(self._parking_db[parking])
+            return self._export(self._parking_db[parking])
         return None
 
-    def compute_parking_travel_time(self):
+    def compute_parking_travel_time(self, processes=1, sumo_cmd=None, use_libsumo=False,
+                                    cache_dir=None, net_file=None, refresh=False, backend=None):
         """ For each parking, saves the parkings reachable by 'passenger' vClass where the weight
             is the travel time at the current stage of the simulation.
             Each call of the funcion destroy the previous state.
+            Raises an ParkingMonitorGenericError if processes > 1 and sumo_cmd is not set, or if
+            cache_dir is set without net_file.
+
+            processes:   Int. If greater than 1, the origin parkings are distributed to a pool of
+                         worker processes, each one with its own SUMO instance. The travel
+                         times are the ones of the networks loaded by the workers.
+            sumo_cmd:    List of strings. SUMO command line used by the workers, it must load the
+                         same network and the 'passenger' vType.
+                         E.g.: ['sumo', '-n', 'net.xml', '-a', 'vtypes.add.xml']
+            use_libsumo: Boolean. If True, the workers use libsumo instead of TraCI.
+            backend:     Dictionary. Backend of the workers, as the 'backend' option, instead of
+                         sumo_cmd and use_libsumo (e.g. the 'fake' one).
+            cache_dir:   String. If set, the result is saved in this directory, identified by a
+                         hash of net_file, 'sumo_parking_file', 'blacklist' and vType, and it is
+                         loaded (memory-mapped) instead of being computed when already there.
+                         The files are hashed again only when their size or modification
+                         time change.
+            net_file:    String. Path and file name of the SUMO network, required by cache_dir.
+            refresh:     Boolean. If True, the cached result is ignored and overwritten.
         """
 
-        self._static_parking_travel_time = collections.defaultdict(list)
+        vtype = 'passenger'
 
-        parkings = []
-        for parking in self._parking_db.values():
-            pid = parking['sumo']['id']
-            edge = parking['sumo']['lane'].split('_')[0]
-            end_pos = float(parking['sumo']['endPos'])
-            parkings.append((pid, edge, end_pos))
-
-        for from_pid, from_edge, from_end_pos in parkings:
-            for to_pid, to_edge, to_end_pos in parkings:
-                if from_pid == to_pid:
-                    continue
-                if from_edge == to_edge and to_end_pos <= from_end_pos:
-                    ## parking not reachable
-                    continue
-                if to_edge in self._blacklisted_edges_pairs[from_edge]:
-                    ##  route not available
-                    continue
+        cache = None
+        if cache_dir:
+            if not net_file:
+                raise ParkingMonitorGenericError(
+                    'The travel time cache requires the SUMO network file.')
+            cache = os.path.join(cache_dir, get_travel_time_cache_key(
+                net_file, self._options['sumo_parking_file'], self._options['blacklist'], vtype,
+                cache_dir=cache_dir))
+            if not refresh:
+                cached = load_travel_time_cache(cache)
+                if cached:
+                    matrix, blacklist, route_edges = cached
+                    self._set_parking_travel_time(matrix)
+                    for from_edge, to_edges in blacklist.items():
+                        for to_edge in to_edges:
+                            if to_edge not in self._blacklisted_edges_pairs[from_edge]:
+                                self._blacklisted_edges_pairs[from_edge].append(to_edge)
+                    if self._logger:
+                        self._logger.info('Parking travel time loaded from %s.', cache)
+                    self._start_travel_time_refresh(route_edges)
+                    return
 
-                route = None
-                try:
-                    route = self._traci_handler.simulation.findRoute(from_edge, to_edge,
-                                                                     vType='passenger')
-                except traci.exceptions.TraCIException:
-                    route = None
+        parkings = get_parking_access_points(self._parking_db)
+
+        route_edges = collections.defaultdict(set)
+        if processes > 1:
+            if not sumo_cmd and not backend:
+                raise ParkingMonitorGenericError(
+                    'The parallel computation of the travel time requires a SUMO command or a '
+                    'backend.')
+            rows = compute_travel_time_rows_parallel(sumo_cmd, processes, parkings,
+                                                     self._blacklisted_edges_pairs, vtype,
+                                                     use_libsumo=use_libsumo,
+                                                     route_edges=route_edges, backend=backend)
+        else:
+            rows = compute_travel_time_rows(self._traci_handler, parkings, parkings,
+                                            self._blacklisted_edges_pairs, vtype,
+                                            route_cache=self._route_cache,
+                                            route_edges=route_edges)
+
+        self._set_parking_travel_time(
+            TravelTimeMatrix.from_rows([pid for pid, _, _ in parkings], rows))
+        self._start_travel_time_refresh(route_edges)
+
+        if cache:
+            save_travel_time_cache(cache, self._static_parking_travel_time,
+                                   dict(self._blacklisted_edges_pairs), route_edges)
+            if self._logger:
+                self._logger.info('Parking travel time saved in %s.', cache)
+
+    def _set_parking_travel_time(self, matrix):
+        """ Set the travel time matrix and map its parkings to the parking store rows. """
+        self._static_parking_travel_time = matrix
+        self._travel_time_store_index = numpy.array(
+            [self._parking_store.index[pid] for pid in matrix.parkings], dtype=numpy.int64)
+
+    def _start_travel_time_refresh(self, route_edges):
+        """ Start the incremental refresh of the travel time structure, if enabled.
+
+            route_edges: Dictionary. { from_pid: set of the edges of its routes }, kept to
+                         start the refresh of the monitors sharing the structure.
+        """
+        self._travel_time_route_edges = route_edges
+        if 'travel_time_refresh' not in self._options:
+            return
+        matrix = self._static_parking_travel_time
+        refresh = self._options['travel_time_refresh']
+        self._travel_time_refresher = TravelTimeRefresher(
+            self._traci_handler, matrix,
+            [parking for parking in get_parking_access_points(self._parking_db)
+             if parking[0] in matrix.index],
+            self._blacklisted_edges_pairs, 'passenger', route_cache=self._route_cache,
+            route_edges=route_edges, period=refresh.get('period', 300.0),
+            threshold=refresh.get('threshold', 0.2), budget=refresh.get('budget', 0.005))
+
+    def _refresh_travel_time(self, step):
+        """ Advance the incremental refresh, publishing the new travel time structure. """
+        matrix = self._travel_time_refresher.step(step)
+        if matrix is not None:
+            ## same parkings, same mapping to the parking store
+            self._static_parking_travel_time = matrix
+            if self._logger:
+                self._logger.info('[%.2f] Parking travel time updated (version %d).',
+                                  step, self._travel_time_refresher.version)
+
+    def get_travel_time_refresh_stats(self):
+        """ Return the statistics of the incremental refresh of the travel time structure (see
+            the 'travel_time_refresh' option), or None if it is not running:
+            {
+                'version': number of updated structures published,
+                'cycles': number of refresh cycles,
+                'sampled_edges': number of edge travel times retrieved,
+                'changed_edges': number of edge travel times above the threshold,
+                'computed_rows': number of rows computed again,
+                'seeded_rows': number of rows routed only to find the edges they use,
+                'pending_samples', 'pending_rows': work left in the current cycle,
+                'pending_seeds': rows whose edges are still unknown,
+            }
+        """
+        if self._travel_time_refresher is None:
+            return None
+        return self._travel_time_refresher.stats()
+
+    def share_parking_travel_time(self, monitor):
+        """ Use the travel time structure of another monitor, e.g. running the same scenario in
+            another simulation, instead of computing it again. The matrix is read-only and it is
+            shared, the blacklisted edges pairs are copied.
+            Raises an ParkingMonitorGenericError if the structure of the other monitor is not
+            initialized or if it contains parkings that are not monitored here.
+
+            monitor: ParkingMonitor. Monitor with the travel time structure initialized.
+        """
+        # pylint: disable=protected-access
+        matrix = monitor._static_parking_travel_time
+        if not matrix:
+            raise ParkingMonitorGenericError(
+                'Estimated travel time structure for parkings is not initialized.')
+        self.set_parking_travel_time(matrix, monitor._blacklisted_edges_pairs,
+                                     monitor._travel_time_route_edges)
+
+    def set_parking_travel_time(self, matrix, blacklist=None, route_edges=None):
+        """ Use a precomputed travel time structure (e.g. synthesized, or computed offline)
+            instead of compute_parking_travel_time. The matrix is read-only and it is not
+            copied, the blacklisted edges pairs are added to the ones of the monitor.
+            Raises an ParkingMonitorGenericError if the matrix contains parkings that are not
+            monitored here.
+
+            matrix:      TravelTimeMatrix. Travel time between the parkings.
+            blacklist:   Dictionary. { from_edge: [to_edge, ...] } of the edges pairs without a
+                         route, if known.
+            route_edges: Dictionary. { from_pid: set of the edges of its routes }, if known, used
+                         by the 'travel_time_refresh' (the unknown ones are found while
+                         refreshing).
+        """
+        missing = [pid for pid in matrix.parkings if pid not in self._parking_db]
+        if missing:
+            raise ParkingMonitorGenericError(
+                'The travel time structure contains parkings that are not monitored: {}'.format(
+                    missing[:10]))
+        self._set_parking_travel_time(matrix)
+        for from_edge, to_edges in (blacklist or {}).items():
+            for to_edge in to_edges:
+                if to_edge not in self._blacklisted_edges_pairs[from_edge]:
                     self._blacklisted_edges_pairs[from_edge].append(to_edge)
+        self._start_travel_time_refresh(route_edges)
 
-                cost = None
-                if route and route.edges:
-                    cost = route.travelTime
+    def find_route(self, from_edge, to_edge, vclass='passenger'):
+        """ Return the route between the edges, as simulation.findRoute, or None if there is no
+            route. The results (failures included) are cached, see the 'route_cache' option,
+            and the returned route must not be modified.
 
-                if cost:
-                    self._static_parking_travel_time[from_pid].append((cost, to_pid))
+            from_edge: String. Edge ID as defined in SUMO.
+            to_edge:   String. Edge ID as defined in SUMO.
+            vclass:    String. vType used for the routing.
+        """
+        return self._route_cache.find_route(from_edge, to_edge, vclass)
 
-        for distances in self._static_parking_travel_time.values():
-            distances.sort()
+    def get_route_cache_stats(self):
+        """ Return the statistics of the route cache as a dict: 'size', 'hits', 'negative_hits',
+            'misses' (router calls), 'expired' and 'evictions'. """
+        return self._route_cache.stats()
 
     def get_closest_parkings(self, parking, num=None):
         """ Return the 'num' closest parkings by travel time from the requested parking.
@@ -813,6 +1638,244 @@ class ParkingMonitor(traci.StepListener):
                 parkings.append(item)
         return parkings
 
+    def find_alternatives(self, parking, vclass, num=None, max_travel_time=None, min_free=1,
+                          exclude=None, with_projections=False, with_subscriptions=False,
+                          with_uncertainty=False):
+        """ Return the 'num' closest parkings by travel time from the requested parking that have
+            at least 'min_free' free places for the given vType, as a list of
+            (travel time, parking id, free places) sorted by travel time.
+            It requires the travel time structure initialization using
+            compute_parking_travel_time(), it raises an ParkingMonitorGenericError
+            if the structure is not yet initialized, or if the parking area or the vType do not
+            exist.
+
+            parking:            String. Parking area ID as defined in SUMO.
+            vclass:             String. vType as defined in SUMO.
+            num:                Int. Maximum number of element to be returned.
+            max_travel_time:    Float. If set, farther parkings are ignored.
+            min_free:           Int. Minimum number of free places.
+            exclude:            Collection of strings. Parking area IDs to be ignored.
+            with_projections:   Boolean. If True, projections are taken into account.
+            with_subscriptions: Boolean. If True, subscriptions are taken into account.
+            with_uncertainty:   Boolean. If True, uncertainty is applied.
+        """
+
+        if not self._static_parking_travel_time:
+            raise ParkingMonitorGenericError(
+                'Estimated travel time structure for parkings is not initialized.')
+        if parking not in self._parking_db:
+            raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
+        if vclass not in self._parking_store.vclass_index:
+            raise ParkingMonitorGenericError('vClass "{}" is not monitored.'.format(vclass))
+
+        if parking not in self._static_parking_travel_time:
+            return []
+        costs, targets = self._static_parking_travel_time.get_row_arrays(parking)
+        if max_travel_time is not None:
+            ## the row is sorted by travel time
+            costs = costs[:numpy.searchsorted(costs, max_travel_time, side='right')]
+
+        free_places = self._parking_store.free_places(
+            with_projections=with_projections,
+            with_subscriptions=with_subscriptions)[:, self._parking_store.vclass_index[vclass]]
+        excluded = None
+        if exclude:
+            excluded = numpy.array([self._parking_store.index[pid] for pid in exclude
+                                    if pid in self._parking_store.index], dtype=numpy.int64)
+
+        ## scan the row in blocks of increasing size, stopping as soon as 'num' are found
+        alternatives = []
+        start = 0
+        block = max(2 * num, 32) if num else len(costs)
+        while start < len(costs) and not (num and len(alternatives) >= num):
+            end = min(start + block, len(costs))
+            rows = self._travel_time_store_index[targets[start:end]]
+            available = free_places[rows]
+            if with_uncertainty:
+                available = available + numpy.round(self._random.normal(
+                    self._parking_store.mu[rows], self._parking_store.sigma[rows])).astype(
+                        numpy.int64)
+            selected = available >= min_free
+            if excluded is not None and len(excluded):
+                selected &= ~numpy.isin(rows, excluded)
+            for pos in numpy.flatnonzero(selected).tolist():
+                alternatives.append((float(costs[start + pos]),
+                                     self._parking_store.parkings[rows[pos]],
+                                     int(available[pos])))
+                if num and len(alternatives) == num:
+                    break
+            start = end
+            block *= 2
+        return alternatives
+
+    def resolve_overbooking(self, max_reroutes=None, max_travel_time=None, num=25,
+                            with_subscriptions=True, apply=True, verify_routes=False):
+        """ Redistribute the vehicles heading to the overbooked parkings, where occupancy and
+            projections exceed the capacity (by vType, if defined), to the closest parkings with
+            free places, and return the decisions as a list of
+            (vehicle id, overbooked parking id, new parking id, travel time between parkings).
+
+            All the overbooked parkings are solved together with a greedy assignment on the
+            travel time matrix: the (parking, alternative) pairs are sorted by travel time and
+            the cheapest ones are used first, until the excess of vehicles is redistributed or
+            the alternatives are full. Only the vehicles driving to the overbooked parking as
+            their next stop, not on an intersection and not subscribed to it, are moved.
+            It requires the travel time structure initialization using
+            compute_parking_travel_time(), it raises an ParkingMonitorGenericError
+            if the structure is not yet initialized.
+
+            max_reroutes:       Int. If set, maximum number of vehicles rerouted in the current
+                                simulation step, the ones rerouted by the previous calls in the
+                                same step included.
+            max_travel_time:    Float. If set, farther alternatives are ignored.
+            num:                Int. Alternatives considered for each overbooked parking.
+            with_subscriptions: Boolean. If True, subscriptions are taken into account.
+            apply:              Boolean. If True, the vehicles are rerouted with
+                                vehicle.rerouteParkingArea, and the decisions that failed are
+                                not returned. Otherwise nothing is changed.
+            verify_routes:      Boolean. If True, a vehicle is moved to an alternative only if
+                                there is a route from its current edge to the parking (see
+                                find_route, with its vClass), otherwise the travel time matrix
+                                between the parkings is trusted.
+        """
+
+        if not self._static_parking_travel_time:
+            raise ParkingMonitorGenericError(
+                'Estimated travel time structure for parkings is not initialized.')
+
+        budget = None
+        if max_reroutes is not None:
+            budget = max_reroutes - len(self._rerouted)
+            if budget <= 0:
+                return []
+
+        store = self._parking_store
+        matrix = self._static_parking_travel_time
+        available = store.free_places(with_projections=True,
+                                      with_subscriptions=with_subscriptions).copy()
+        ## the projections do not include the reroutes of this step yet
+        for parking, alternative, v_class in self._rerouted.values():
+            col = store.vclass_index[v_class]
+            for pid, delta in ((parking, 1), (alternative, -1)):
+                row = store.index[pid]
+                if store.with_capacity[row]:
+                    available[row, col] += delta
+                else:
+                    available[row] += delta
+
+        ## Overbooked parkings: the excess is by vType with capacity_by_class, total otherwise
+        excess = dict()
+        sources = []
+        overbooked = collections.defaultdict(list)
+        for row, col in zip(*(axis.tolist() for axis in numpy.nonzero(available < 0))):
+            if store.with_capacity[row] or col == 0:
+                overbooked[row].append(col)
+        for row, cols in overbooked.items():
+            pid = store.parkings[row]
+            if pid not in matrix:
+                continue
+            ## movable vehicles, by vType
+            candidates = collections.defaultdict(list)
+            subscriptions = self._parking_db[pid]['subscriptions_by_class']
+            for vehicle in self._vehicle_index.query(DRIVING, pid):
+                if vehicle in self._rerouted:
+                    continue
+                record = self._vehicles_db[vehicle]
+                if not record.edge or ':' in record.edge or record.stops[0][2] != pid:
+                    continue
+                v_class = record.vClass
+                if v_class in subscriptions and vehicle in subscriptions[v_class][1]:
+                    continue
+                candidates[v_class].append(vehicle)
+            for col in cols:
+                pool = (row, col)
+                excess[pool] = int(-available[row, col])
+                if store.with_capacity[row]:
+                    vclasses = (store.vclasses[col],)
+                else:
+                    vclasses = store.vclasses
+                for v_class in vclasses:
+                    if candidates.get(v_class):
+                        ## popped from the end, in ID order
+                        sources.append((pool, pid, store.vclass_index[v_class],
+                                        sorted(candidates[v_class], reverse=True)))
+
+        if not sources:
+            return []
+
+        ## Candidate assignments: the 'num' closest alternatives with free places, gathered
+        ## from the rows of the travel time matrix of all the sources at once
+        positions = numpy.array([matrix.index[pid] for _, pid, _, _ in sources], dtype=numpy.int64)
+        starts = matrix.offsets[positions].astype(numpy.int64)
+        lengths = matrix.offsets[positions + 1].astype(numpy.int64) - starts
+        firsts = numpy.cumsum(lengths) - lengths
+        owners = numpy.repeat(numpy.arange(len(sources)), lengths)
+        cells = numpy.arange(lengths.sum()) - numpy.repeat(firsts - starts, lengths)
+        costs = matrix.costs[cells]
+        targets = self._travel_time_store_index[matrix.targets[cells]]
+        cols = numpy.array([col for _, _, col, _ in sources], dtype=numpy.int64)
+        selected = available[targets, cols[owners]] > 0
+        if max_travel_time is not None:
+            selected &= costs <= max_travel_time
+        ## rank of each selected alternative in its row
+        counts = numpy.concatenate(([0], numpy.cumsum(selected)))
+        selected &= counts[1:] - numpy.repeat(counts[firsts], lengths) <= num
+        costs = costs[selected]
+        owners, targets = owners[selected].tolist(), targets[selected].tolist()
+
+        ## Greedy assignment, cheapest pairs first
+        decisions = []
+        for pos in numpy.argsort(costs, kind='stable').tolist():
+            pool, pid, col, candidates = sources[owners[pos]]
+            target = targets[pos]
+            while (excess[pool] > 0 and candidates and available[target, col] > 0 and
+                   (budget is None or len(decisions) < budget)):
+                if verify_routes:
+                    vehicle = self._pop_routable(candidates, store.parkings[target])
+                    if vehicle is None:
+                        ## none of the vehicles can reach this alternative
+                        break
+                else:
+                    vehicle = candidates.pop()
+                decisions.append((vehicle, pid, store.parkings[target], float(costs[pos])))
+                excess[pool] -= 1
+                if store.with_capacity[target]:
+                    available[target, col] -= 1
+                else:
+                    available[target] -= 1
+            if budget is not None and len(decisions) >= budget:
+                break
+
+        if not apply:
+            return decisions
+
+        rerouted = []
+        for decision in decisions:
+            vehicle, overbooked, parking, _ = decision
+            try:
+                self._traci_handler.vehicle.rerouteParkingArea(vehicle, parking)
+            except exceptions.TraCIException as excpt:
+                if self._logger:
+                    self._logger.warning('Rerouting of %s to %s failed: %s',
+                                         vehicle, parking, excpt)
+                continue
+            self._rerouted[vehicle] = (overbooked, parking, self._vehicles_db[vehicle].vClass)
+            rerouted.append(decision)
+        if self._logger and rerouted:
+            self._logger.info('%d vehicles rerouted from overbooked parkings.', len(rerouted))
+        return rerouted
+
+    def _pop_routable(self, candidates, parking):
+        """ Remove and return the last of the candidate vehicles with a route from its current
+            edge to the parking, or None. """
+        edge = self._parking_db[parking]['sumo']['lane'].split('_')[0]
+        for pos in range(len(candidates) - 1, -1, -1):
+            record = self._vehicles_db[candidates[pos]]
+            route = self.find_route(record.edge, edge, record.vClass)
+            if route and len(route.edges) >= 2:
+                return candidates.pop(pos)
+        return None
+
     ## ============================     PARKING SUBSCRIPTIONS      ============================= ##
 
     def get_parking_subscriptions(self, parking):
@@ -822,7 +1885,7 @@ class ParkingMonitor(traci.StepListener):
             parking: String. Parking area ID as defined in SUMO.
         """
         if parking in self._parking_db.keys():
-            return copy.deepcopy(self._parking_db[parking]['subscriptions_by_class'])
+            return self._export(self._parking_db[parking]['subscriptions_by_class'])
         raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
 
     def set_parking_subscriptions(self, parking, subscriptions):
@@ -834,11 +1897,22 @@ class ParkingMonitor(traci.StepListener):
             subscriptions: Dict. { 'vType': int, .., 'vType': int }
         """
         if parking in self._parking_db:
+            self._update_subscription_index(self._parking_db[parking]['subscriptions_by_class'],
+                                            -1)
             self._parking_db[parking]['subscriptions_by_class'] = copy.deepcopy(subscriptions)
+            self._update_subscription_index(self._parking_db[parking]['subscriptions_by_class'], 1)
+            self._parking_store.load(parking, self._parking_db[parking])
             self._validate_parking_subscriptions(parking)
         else:
             raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
 
+    def _update_subscription_index(self, subscriptions, delta):
+        """ Add (delta=1) or remove (delta=-1) all the subscribed vehicles to the index. """
+        for value in subscriptions.values():
+            if isinstance(value, (list, tuple)) and len(value) == 2:
+                for vehicle in value[1]:
+                    self._vehicle_index.subscribe(vehicle, delta)
+
     def subscribe_vehicle_to_parking(self, parking, vclass, vehicle):
         """ Add the vehicle to the subscription list of the parking area.
             Returns False iif the number of already subscribed vehicles is equal to the number
@@ -857,6 +1931,9 @@ class ParkingMonitor(traci.StepListener):
                     return False
                 if len(vehicles) < _capacity:
                     vehicles.add(vehicle)
+                    self._vehicle_index.subscribe(vehicle, 1)
+                    self._parking_store.update(parking, vclass, SUBSCRIBED, 1,
+                                               self._get_memberships(parking, vclass, vehicle))
                     return True
                 # subscription full
                 return False
@@ -880,6 +1957,9 @@ class ParkingMonitor(traci.StepListener):
                 _capacity, vehicles = self._parking_db[parking]['subscriptions_by_class'][vclass]
                 if vehicle in vehicles:
                     vehicles.remove(vehicle)
+                    self._vehicle_index.subscribe(vehicle, -1)
+                    self._parking_store.update(parking, vclass, SUBSCRIBED, -1,
+                                               self._get_memberships(parking, vclass, vehicle))
                     return True
                 # vehicle not found
                 return False
@@ -898,7 +1978,7 @@ class ParkingMonitor(traci.StepListener):
             parking: String. Parking area ID as defined in SUMO.
         """
         if parking in self._parking_db.keys():
-            return copy.deepcopy(self._parking_db[parking]['projection_by_class'])
+            return self._export(self._parking_db[parking]['projections_by_class'])
         raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
 
     ## ============================  PARKING CAPACITY - OCCUPANCY  ============================= ##
@@ -923,43 +2003,61 @@ class ParkingMonitor(traci.StepListener):
             error = round(self._random.normal(self._parking_db[parking]['uncertainty']['mu'],
                                               self._parking_db[parking]['uncertainty']['sigma']))
 
-        current_capacity = dict()
-        for key, capacity in self._parking_db[parking]['capacity_by_class'].items():
-            current_capacity[key] = capacity
-
-        total_occupancy = self._parking_db[parking]['total_occupancy']
-        occupancy = dict()
-        for key, values in self._parking_db[parking]['occupancy_by_class'].items():
-            occupancy[key] = set(values)
-
-        total_projections = 0
-        if with_projections:
-            for key, vehicles in self._parking_db[parking]['projections_by_class'].items():
-                total_projections += len(vehicles)
-                occupancy[key] = occupancy[key] | vehicles
-
-        total_subscriptions = 0
-        partial_subscriptions = 0
-        subscriptions = dict()
-        if with_subscriptions:
-            for key, (num, veh) in self._parking_db[parking]['subscriptions_by_class'].items():
-                subscriptions[key] = num - len(veh)
-                occupancy[key] = occupancy[key] | veh
-                total_subscriptions += num
-                partial_subscriptions += subscriptions[key]
-
-        if current_capacity:
-            for key, vehicles in occupancy.items():
-                current_capacity[key] += error
-                current_capacity[key] -= len(vehicles)
-                if with_subscriptions and subscriptions:
-                    current_capacity[key] -= subscriptions[key]
-            if vclass in current_capacity:
-                return current_capacity[vclass]
-            return current_capacity
-
-        return (self._parking_db[parking]['total_capacity'] - total_occupancy -
-                total_projections - total_subscriptions + error)
+        free_places = self._parking_store.free_places_row(
+            self._parking_store.index[parking],
+            with_projections=with_projections, with_subscriptions=with_subscriptions)
+
+        if isinstance(free_places, tuple):
+            ## capacity by class
+            if vclass in self._parking_store.vclass_index:
+                return free_places[self._parking_store.vclass_index[vclass]] + error
+            return {key: value + error
+                    for key, value in zip(self._parking_store.vclasses, free_places)}
+        return free_places + error
+
+    def get_free_places_bulk(self, vclass=None, with_projections=False, with_subscriptions=False,
+                             with_uncertainty=False):
+        """ Returns the free places of all the parking areas with a single vectorized call.
+            Rows follow the order of get_parking_ids() and columns the one of get_vclass_ids().
+            For the parking areas without 'capacity_by_class', every column holds the total
+            number of free places, as returned by get_free_places.
+            Raises an ParkingMonitorGenericError if the requested vclass is not monitored.
+
+            vclass:             String. If set, returns a 1D array only for the specified vType,
+                                otherwise a 2D array (parkings x vTypes).
+            with_projections:   Boolean. If True, projections are taken into account.
+            with_subscriptions: Boolean. If True, subscriptions are taken into account.
+            with_uncertainty:   Boolean. If True, uncertainty is applied (one sample per parking).
+        """
+
+        if vclass is not None and vclass not in self._parking_store.vclass_index:
+            raise ParkingMonitorGenericError('vClass "{}" is not monitored.'.format(vclass))
+
+        free_places = self._parking_store.free_places(with_projections=with_projections,
+                                                      with_subscriptions=with_subscriptions)
+        if with_uncertainty:
+            error = numpy.round(self._random.normal(self._parking_store.mu,
+                                                    self._parking_store.sigma)).astype(numpy.int64)
+            free_places = free_places + error[:, None]
+        else:
+            free_places = free_places.copy()
+
+        if vclass is not None:
+            return free_places[:, self._parking_store.vclass_index[vclass]]
+        return free_places
+
+    def get_dirty_parkings(self):
+        """ Return the IDs of the parking areas whose state changed since the beginning of the
+            last simulation step, user changes (e.g. subscriptions) included. """
+        return frozenset(self._parking_store.dirty)
+
+    def get_parking_ids(self):
+        """ Return the parking IDs in the order used by the bulk queries. """
+        return self._parking_store.parkings
+
+    def get_vclass_ids(self):
+        """ Return the vTypes in the order used by the bulk queries. """
+        return self._parking_store.vclasses
 
     def get_parking_capacity_vclass(self, parking):
         """ Given a parking ID, returns the capacity by vclass information.
@@ -968,7 +2066,7 @@ class ParkingMonitor(traci.StepListener):
             parking: String. Parking area ID as defined in SUMO.
         """
         if parking in self._parking_db.keys():
-            return copy.deepcopy(self._parking_db[parking]['capacity_by_class'])
+            return self._export(self._parking_db[parking]['capacity_by_class'])
         raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
 
     def set_parking_capacity_vclass(self, parking, capacities):
@@ -981,6 +2079,7 @@ class ParkingMonitor(traci.StepListener):
         """
         if parking in self._parking_db:
             self._parking_db[parking]['capacity_by_class'] = copy.deepcopy(capacities)
+            self._parking_store.load(parking, self._parking_db[parking])
             self._validate_parking_capacity(parking)
         else:
             raise ParkingMonitorGenericError('Parking {} does not exist.'.format(parking))
@@ -1021,7 +2120,7 @@ class ParkingMonitor(traci.StepListener):
                     "The occupancy in parking area {} for vType {} is {} of {}.".format(
                         parking, v_class, len(value),
                         self._parking_db[parking]['capacity_by_class'][v_class]))
-                if self._logger:
+                if self._log_debug:
                     self._logger.debug(info)
                 if len(value) > self._parking_db[parking]['capacity_by_class'][v_class]:
                     raise ParkingMonitorGenericError(info)
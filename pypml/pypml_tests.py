@@ -11,13 +11,1397 @@
     http://www.eclipse.org/legal/epl-2.0.
 """
 
-from unittest import TestCase
+import collections
+import copy
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase, mock
+
+import numpy
 
 from pypml import ParkingMonitor
+from pypml.archive import VehicleArchive
+from pypml.backend import BACKENDS, exceptions, register_backend, tc
+from pypml.expressions import build_environment, compile_expression
+from pypml.fake import VCLASSES, FakeTraCI
+from pypml.indexes import VehicleIndex
+from pypml.logs import DeferredQueueHandler, JsonLinesFormatter
+from pypml.multisim import MultiSimulation
+from pypml.pipeline import SnapshotError, TraCISnapshot
+from pypml.pypml import ParkingMonitorGenericError
+from pypml.replay import RecordingTraCI, ReplayError, ReplayTraCI
+from pypml.routes import DEFAULT_TTL, RouteCache
+from pypml.series import OccupancySeries
+from pypml.stats import StepStats, dump_metrics
+from pypml.store import OCCUPANCY, PROJECTIONS, SUBSCRIBED, ParkingStore
+from pypml.traveltime import (TravelTimeMatrix, TravelTimeRefresher, compute_travel_time_rows,
+                              get_travel_time_cache_key)
+from pypml.vehicles import VehicleRecord, get_stops_fingerprint, intern_stops
+from pypml.views import read_only
+
+def _fake_options(fake, **options):
+    """ Return the options of a ParkingMonitor for the FakeTraCI scenario (None if the monitor
+        creates the backend, then 'sumo_parking_file' must be given), updated with the given
+        ones. """
+    defaults = {
+        'seed': 42,
+        'addStepListener': True,
+        'logging': {'stdout': False, 'filename': None, 'level': logging.WARNING},
+        'sumo_parking_file': fake.filename if fake is not None else None,
+        'blacklist': [],
+        'vclasses': set(VCLASSES),
+        'generic_conf': [],
+        'specific_conf': {},
+        'subscriptions': {'only_parkings': True},
+    }
+    defaults.update(options)
+    return defaults
 
 class TestParkingMonitor(TestCase):
     """ Test class for the ParkingMonitor """
 
     def test_init_parking_monitor(self):
-        """ Test __init__ """
-        pass
\ No newline at end of file
+        """ Test __init__ and a complete run with the fake TraCI """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=10, vehicles=100, horizon=200)
+            options = {
+                'seed': 42,
+                'addStepListener': True,
+                'logging': {'stdout': False, 'filename': None, 'level': logging.DEBUG},
+                'sumo_parking_file': fake.filename,
+                'blacklist': [],
+                'vclasses': set(VCLASSES),
+                'generic_conf': [],
+                'specific_conf': {},
+                'subscriptions': {'only_parkings': True},
+            }
+            monitor = ParkingMonitor(fake, options)
+            monitor.compute_parking_travel_time()
+            self.assertEqual(sorted(monitor.get_parking_ids()), sorted(fake.pids))
+            self.assertEqual(len(monitor.get_closest_parkings('pa1', num=3)), 3)
+            ## cached by compute_parking_travel_time
+            self.assertEqual(monitor.find_route('e1', 'e4').travelTime, 32.5)
+            self.assertEqual(monitor.get_route_cache_stats()['hits'], 1)
+
+            parked = 0
+            while fake.simulation.getMinExpectedNumber() > 0:
+                fake.simulationStep()
+                for pid in fake.pids:
+                    self.assertEqual(monitor.get_parking(pid)['total_occupancy'],
+                                     len(fake.parked[pid]))
+                    self.assertEqual(monitor.get_free_places(pid), 5 - len(fake.parked[pid]))
+                parked = max(parked, len(monitor.get_vehicle_ids(state='stopped')))
+            self.assertGreater(parked, 0)
+            self.assertEqual(len(monitor.get_vehicle_ids(state='arrived')), 100)
+            monitor.close()
+
+class TestParkingOccupancySubscriptions(TestCase):
+    """ Test class for the 'parking_occupancy' subscription mode """
+
+    def test_parking_occupancy(self):
+        """ Test that the subscriptions and getParameter give the same occupancy every step """
+        with tempfile.TemporaryDirectory() as directory:
+            fakes, monitors = [], []
+            for parking_occupancy in (False, True):
+                os.mkdir(os.path.join(directory, str(parking_occupancy)))
+                fake = FakeTraCI(os.path.join(directory, str(parking_occupancy)), parkings=10,
+                                 vehicles=100, horizon=200)
+                fakes.append(fake)
+                monitors.append(ParkingMonitor(fake, _fake_options(fake, subscriptions={
+                    'only_parkings': True, 'parking_occupancy': parking_occupancy})))
+            occupied = 0
+            while fakes[0].simulation.getMinExpectedNumber() > 0:
+                for fake in fakes:
+                    fake.simulationStep()
+                self.assertEqual(
+                    sorted(monitors[1].get_traci_parkingarea_subscriptions()), fakes[1].pids)
+                for pid in fakes[0].pids:
+                    occupancy = monitors[0].get_parking(pid)['total_occupancy']
+                    self.assertEqual(occupancy, len(fakes[0].parked[pid]))
+                    self.assertEqual(monitors[1].get_parking(pid)['total_occupancy'], occupancy)
+                    occupied += occupancy
+            self.assertGreater(occupied, 0)
+            self.assertEqual(fakes[1].simulation.getMinExpectedNumber(), 0)
+            for monitor in monitors:
+                monitor.close()
+
+class TestDirtyParkings(TestCase):
+    """ Test class for ParkingMonitor.get_dirty_parkings """
+
+    def test_dirty_parkings(self):
+        """ Test that the dirty set covers the changes of the last step, and is then cleared """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            monitor = ParkingMonitor(fake, _fake_options(fake, specific_conf={
+                'pa3': {'subscriptions_by_class': {'passenger': [2, set()]}}}))
+            fake.simulationStep()
+            self.assertEqual(monitor.get_dirty_parkings(), frozenset())
+
+            ## occupancy change in SUMO, seen by the step
+            fake.parked['pa1'].update(('parked1', 'parked2'))
+            fake.simulationStep()
+            self.assertEqual(monitor.get_dirty_parkings(), frozenset(['pa1']))
+            ## user change after the step
+            self.assertTrue(monitor.subscribe_vehicle_to_parking('pa3', 'passenger', 'veh0'))
+            self.assertEqual(monitor.get_dirty_parkings(), frozenset(['pa1', 'pa3']))
+
+            fake.simulationStep()
+            self.assertEqual(monitor.get_dirty_parkings(), frozenset())
+            monitor.remove_subscribed_vehicle('pa3', 'passenger', 'veh0')
+            self.assertEqual(monitor.get_dirty_parkings(), frozenset(['pa3']))
+            monitor.close()
+
+class TestReadOnlyViews(TestCase):
+    """ Test class for the read-only views """
+
+    def test_read_only_views(self):
+        """ Test read_only """
+        internal = {'capacity_by_class': {'passenger': 10},
+                    'subscriptions_by_class': {'passenger': [5, {'veh1'}]}}
+        view = read_only(internal)
+        capacity, vehicles = view['subscriptions_by_class']['passenger']
+        self.assertEqual(capacity, 5)
+        self.assertEqual(vehicles - {'veh1'}, frozenset())
+        with self.assertRaises(TypeError):
+            view['capacity_by_class']['passenger'] = 0
+        with self.assertRaises(AttributeError):
+            vehicles.add('veh2')
+        private = view.copy()
+        private['subscriptions_by_class']['passenger'][1].add('veh2')
+        self.assertEqual(internal['subscriptions_by_class']['passenger'][1], {'veh1'})
+        internal['capacity_by_class']['passenger'] = 20
+        self.assertEqual(view['capacity_by_class']['passenger'], 20)
+
+class TestExpressions(TestCase):
+    """ Test class for the generic_conf expressions """
+
+    def test_vectorized_expressions(self):
+        """ Test compile_expression on scalars and arrays """
+        parkings = [
+            {'total_capacity': 100, 'total_occupancy': 0, 'sumo': {'id': 'pa1', 'endPos': '50'}},
+            {'total_capacity': 20, 'total_occupancy': 0, 'sumo': {'id': 'pa2', 'endPos': '10'}},
+        ]
+        condition = compile_expression(['and', ['>', 'total_capacity', 50], ['>', 'endPos', 5]])
+        self.assertEqual(condition(build_environment(parkings)).tolist(), [True, False])
+        sigma = compile_expression(['*', 'total_capacity', 0.20])
+        self.assertEqual(sigma({'total_capacity': 100}), 20.0)
+        self.assertEqual(compile_expression('id')({'total_capacity': 100}), 'id')
+        ## as Python does with integers
+        inverse = compile_expression(['**', 'total_capacity', -1])
+        self.assertEqual(inverse({'total_capacity': 5}), 0.2)
+        self.assertEqual(inverse(build_environment(parkings)).tolist(), [0.01, 0.05])
+
+    def test_set_to_selected_only(self):
+        """ Test that the set_to expressions are evaluated only on the selected parkings """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=6, vehicles=0)
+            fake.capacity['pa0'] = 0
+            monitor = ParkingMonitor(fake, _fake_options(fake, generic_conf=[{
+                'cond': ['>', 'total_capacity', 0],
+                'set_to': [['uncertainty', {'mu': ['/', 10, 'total_capacity'],
+                                            'sigma': ['**', 'total_capacity', -1]}]],
+            }]))
+            self.assertEqual(monitor.get_parking('pa0')['uncertainty'],
+                             {'mu': 0.0, 'sigma': 0.0})
+            for pid in fake.pids[1:]:
+                self.assertEqual(monitor.get_parking(pid)['uncertainty'],
+                                 {'mu': 2.0, 'sigma': 0.2})
+            monitor.close()
+
+class TestOccupancySeries(TestCase):
+    """ Test class for the OccupancySeries """
+
+    def test_retention_and_window(self):
+        """ Test the bounded and downsampled series """
+        series = OccupancySeries(chunk_size=2, retention=10.0)
+        for time in range(20):
+            series.append((time, float(time)))
+        self.assertEqual(list(series), [(time, float(time)) for time in range(9, 20)])
+        self.assertEqual(series[0], (9, 9.0))
+
+        series = OccupancySeries(window=10.0, aggregate='max')
+        for occupancy, time in [(1, 0.0), (5, 2.0), (3, 9.0), (2, 10.0)]:
+            series.append((occupancy, time))
+        self.assertEqual(series, [(5, 9.0), (2, 10.0)])
+
+        ## the copy aggregates the new samples in the same way
+        duplicate = copy.deepcopy(series)
+        for target in (series, duplicate):
+            target.append((7, 12.0))
+            target.append((4, 15.0))
+        self.assertEqual(duplicate, [(5, 9.0), (7, 15.0)])
+        self.assertEqual(duplicate, series)
+
+    def test_spill_to_disk(self):
+        """ Test the series with old chunks on disk """
+        with tempfile.TemporaryDirectory() as directory:
+            series = OccupancySeries(chunk_size=2, spill_dir=directory, chunks_in_memory=1)
+            for time in range(9):
+                series.append((time, float(time)))
+            self.assertEqual(list(series), [(time, float(time)) for time in range(9)])
+            self.assertEqual(len(os.listdir(directory)), 1)
+            self.assertEqual(len(os.listdir(os.path.join(directory, os.listdir(directory)[0]))),
+                             3)
+
+            ## same name and directory, private files
+            other = OccupancySeries(chunk_size=2, spill_dir=directory, chunks_in_memory=1)
+            for time in range(9):
+                other.append((-time, float(time)))
+            self.assertEqual(list(series), [(time, float(time)) for time in range(9)])
+            self.assertEqual(list(other), [(-time, float(time)) for time in range(9)])
+            series.close()
+            other.close()
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(list(series), [(time, float(time)) for time in range(6, 9)])
+
+    def test_small_series(self):
+        """ Test that the current chunk grows with the samples """
+        series = OccupancySeries([(0, 0.0)])
+        self.assertLess(series._time.nbytes, 1024) # pylint: disable=protected-access
+        for time in range(1, 3000):
+            series.append((time % 7, float(time)))
+        self.assertEqual(list(series), [(time % 7, float(time)) for time in range(3000)])
+
+    def test_spill_retention(self):
+        """ Test that the retention does not read the spilled chunk at every append """
+        with tempfile.TemporaryDirectory() as directory:
+            series = OccupancySeries(chunk_size=4, retention=10.0, spill_dir=directory,
+                                     chunks_in_memory=1)
+            load = numpy.load
+            calls = []
+
+            def _load(*args, **kwargs):
+                calls.append(args)
+                return load(*args, **kwargs)
+
+            with mock.patch('numpy.load', _load):
+                for time in range(100):
+                    series.append((time, time / 4))
+            self.assertEqual(list(series),
+                             [(time, time / 4) for time in range(100) if time / 4 >= 14.75])
+            ## at most once for each spilled chunk that becomes the first one
+            self.assertLessEqual(len(calls), 100 // 4)
+            series.close()
+
+class TestParkingStore(TestCase):
+    """ Test class for the columnar ParkingStore """
+
+    def test_incremental_updates(self):
+        """ Test that update() matches a complete load() """
+        parking = {
+            'total_capacity': 10, 'total_occupancy': 0,
+            'uncertainty': {'mu': 0.0, 'sigma': 0.0},
+            'capacity_by_class': {'passenger': 6, 'truck': 4},
+            'occupancy_by_class': {'passenger': set(), 'truck': set()},
+            'projections_by_class': {'passenger': set(), 'truck': set()},
+            'subscriptions_by_class': {'passenger': [3, set()], 'truck': [1, set()]},
+        }
+        incremental = ParkingStore(['pa'], {'passenger', 'truck'})
+        incremental.load('pa', parking)
+        generator = random.Random(42)
+        for _ in range(500):
+            vclass = generator.choice(['passenger', 'truck'])
+            kind = generator.choice([OCCUPANCY, PROJECTIONS, SUBSCRIBED])
+            vehicle = generator.choice(['v1', 'v2', 'v3', 'v4'])
+            vehicles = [parking['occupancy_by_class'][vclass],
+                        parking['projections_by_class'][vclass],
+                        parking['subscriptions_by_class'][vclass][1]]
+            delta = -1 if vehicle in vehicles[kind] else 1
+            if delta > 0:
+                vehicles[kind].add(vehicle)
+            else:
+                vehicles[kind].remove(vehicle)
+            incremental.update('pa', vclass, kind, delta,
+                               tuple(vehicle in values for values in vehicles))
+            complete = ParkingStore(['pa'], {'passenger', 'truck'})
+            complete.load('pa', parking)
+            for projections in (False, True):
+                for subscriptions in (False, True):
+                    numpy.testing.assert_array_equal(
+                        incremental.free_places(with_projections=projections,
+                                                with_subscriptions=subscriptions),
+                        complete.free_places(with_projections=projections,
+                                             with_subscriptions=subscriptions))
+
+class TestTravelTimeMatrix(TestCase):
+    """ Test class for the TravelTimeMatrix """
+
+    def test_save_and_load(self):
+        """ Test from_rows, save and load """
+        rows = {
+            'pa1': [(30.0, 'pa3'), (10.0, 'pa2')],
+            'pa3': [(5.0, 'pa1')],
+        }
+        matrix = TravelTimeMatrix.from_rows(['pa1', 'pa2', 'pa3'], rows)
+        self.assertEqual(matrix['pa1'], [(10.0, 'pa2'), (30.0, 'pa3')])
+        self.assertNotIn('pa2', matrix)
+        self.assertEqual(len(matrix), 2)
+        with tempfile.TemporaryDirectory() as directory:
+            matrix.save(directory)
+            loaded = TravelTimeMatrix.load(directory)
+            self.assertEqual(dict(loaded), dict(matrix))
+
+    def test_cache(self):
+        """ Test the travel time cache: hits, invalidation and refresh """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=8, vehicles=0)
+            net_file = os.path.join(directory, 'net.net.xml')
+            with open(net_file, 'w') as fwrite:
+                fwrite.write('<net/>')
+            cache_dir = os.path.join(directory, 'cache')
+
+            def compute(refresh=False, **options):
+                """ Return the closest parkings of pa1 and the number of routes computed. """
+                monitor = ParkingMonitor(fake, _fake_options(fake, **options))
+                with mock.patch.object(fake.simulation, 'findRoute',
+                                       wraps=fake.simulation.findRoute) as find_route:
+                    monitor.compute_parking_travel_time(cache_dir=cache_dir, net_file=net_file,
+                                                        refresh=refresh)
+                closest = monitor.get_closest_parkings('pa1')
+                monitor.close()
+                return closest, find_route.call_count
+
+            closest, calls = compute()
+            self.assertGreater(calls, 0)
+            self.assertEqual(compute(), (closest, 0))
+            self.assertEqual(compute(refresh=True), (closest, calls))
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            ## blacklist
+            self.assertGreater(compute(blacklist=['pa3'])[1], 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            ## parking file
+            with open(fake.filename, 'a') as fwrite:
+                fwrite.write('<!-- changed -->\n')
+            self.assertGreater(compute()[1], 0)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+            ## vClass
+            self.assertNotEqual(
+                get_travel_time_cache_key(net_file, fake.filename, [], 'passenger', cache_dir),
+                get_travel_time_cache_key(net_file, fake.filename, [], 'bicycle', cache_dir))
+
+    def test_cache_key_digests(self):
+        """ Test that the files are hashed again only when their size or mtime change """
+        with tempfile.TemporaryDirectory() as directory:
+            net_file = os.path.join(directory, 'net.net.xml')
+            parking_file = os.path.join(directory, 'parkings.add.xml')
+            for filename in (net_file, parking_file):
+                with open(filename, 'w') as fwrite:
+                    fwrite.write('<net/>')
+            key = get_travel_time_cache_key(net_file, parking_file, [], cache_dir=directory)
+            self.assertTrue(os.path.isfile(os.path.join(directory, 'digests.json')))
+            self.assertEqual(get_travel_time_cache_key(net_file, parking_file, []), key)
+
+            ## same size and modification time: the digest is reused
+            stat = os.stat(net_file)
+            with open(net_file, 'w') as fwrite:
+                fwrite.write('<xxx/>')
+            os.utime(net_file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            self.assertEqual(
+                get_travel_time_cache_key(net_file, parking_file, [], cache_dir=directory), key)
+            os.utime(net_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+            self.assertNotEqual(
+                get_travel_time_cache_key(net_file, parking_file, [], cache_dir=directory), key)
+
+    def test_bool(self):
+        """ Test the truth value of the matrix """
+        self.assertFalse(TravelTimeMatrix.from_rows(['pa1', 'pa2'], {}))
+        self.assertTrue(TravelTimeMatrix.from_rows(['pa1', 'pa2'], {'pa2': [(1.0, 'pa1')]}))
+
+    def test_replace_rows(self):
+        """ Test that replace_rows returns a new matrix """
+        matrix = TravelTimeMatrix.from_rows(['pa1', 'pa2', 'pa3'], {
+            'pa1': [(30.0, 'pa3'), (10.0, 'pa2')],
+            'pa3': [(5.0, 'pa1')],
+        })
+        updated = matrix.replace_rows({'pa1': [(20.0, 'pa2')], 'pa2': [(1.0, 'pa3')]})
+        self.assertEqual(dict(updated), {'pa1': [(20.0, 'pa2')], 'pa2': [(1.0, 'pa3')],
+                                         'pa3': [(5.0, 'pa1')]})
+        self.assertEqual(matrix['pa1'], [(10.0, 'pa2'), (30.0, 'pa3')])
+
+    def test_refresh(self):
+        """ Test the incremental refresh under congestion """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=8, vehicles=0)
+            monitor = ParkingMonitor(fake, _fake_options(fake, travel_time_refresh={
+                'period': 10.0, 'threshold': 0.2, 'budget': 0.0}))
+            monitor.compute_parking_travel_time()
+            before = monitor.get_closest_parkings('pa1')
+            ## reference travel time of the edges
+            fake.simulationStep()
+            self.assertEqual(monitor.get_travel_time_refresh_stats()['cycles'], 1)
+            while monitor.get_travel_time_refresh_stats()['pending_samples']:
+                fake.simulationStep()
+
+            fake.delays['e3'] = 100.0
+            while monitor.get_travel_time_refresh_stats()['version'] == 0:
+                self.assertEqual(monitor.get_closest_parkings('pa1'), before)
+                fake.simulationStep()
+            after = monitor.get_closest_parkings('pa1')
+            self.assertEqual(after[-1], (10.0 + 15.0 + 100.0, 'pa3'))
+            self.assertEqual(sorted(after[:-1]), sorted(item for item in before
+                                                        if item[1] != 'pa3'))
+            stats = monitor.get_travel_time_refresh_stats()
+            self.assertEqual(stats['changed_edges'], 1)
+            ## the rows with a route to (or from) e3, all but pa0
+            self.assertEqual(stats['computed_rows'], 7)
+            monitor.close()
+
+    def test_parallel(self):
+        """ Test that the spawned workers compute the same matrix, and the route edges """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=12, vehicles=0)
+            serial = ParkingMonitor(fake, _fake_options(fake))
+            serial.compute_parking_travel_time()
+            parallel = ParkingMonitor(fake, _fake_options(fake, travel_time_refresh={}))
+            workers = os.path.join(directory, 'workers')
+            os.mkdir(workers)
+            parallel.compute_parking_travel_time(
+                processes=3, backend={'name': 'fake', 'directory': workers, 'parkings': 12,
+                                      'vehicles': 0})
+            for pid in fake.pids:
+                self.assertEqual(parallel.get_closest_parkings(pid),
+                                 serial.get_closest_parkings(pid))
+            ## the edges of the routes came back from the workers: nothing to compute again
+            self.assertEqual(parallel.get_travel_time_refresh_stats()['pending_rows'], 0)
+            self.assertEqual(parallel.get_travel_time_refresh_stats()['pending_seeds'], 0)
+            self.assertGreater(parallel.get_travel_time_refresh_stats()['pending_samples'], 0)
+            with self.assertRaises(ParkingMonitorGenericError):
+                parallel.compute_parking_travel_time(processes=2)
+            serial.close()
+            parallel.close()
+
+    def test_refresh_route_edges(self):
+        """ Test that the cached and the shared matrices keep the edges of their routes """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=8, vehicles=0)
+            net_file = os.path.join(directory, 'net.net.xml')
+            with open(net_file, 'w') as fwrite:
+                fwrite.write('<net/>')
+            cache_dir = os.path.join(directory, 'cache')
+            refresh = {'period': 10.0, 'budget': 0.0}
+            computed = ParkingMonitor(fake, _fake_options(fake, travel_time_refresh=refresh))
+            computed.compute_parking_travel_time(cache_dir=cache_dir, net_file=net_file)
+            cached = ParkingMonitor(fake, _fake_options(fake, travel_time_refresh=refresh))
+            cached.compute_parking_travel_time(cache_dir=cache_dir, net_file=net_file)
+            shared = ParkingMonitor(fake, _fake_options(fake, travel_time_refresh=refresh))
+            shared.share_parking_travel_time(cached)
+            for monitor in (computed, cached, shared):
+                stats = monitor.get_travel_time_refresh_stats()
+                self.assertEqual(stats['pending_rows'], 0)
+                self.assertEqual(stats['pending_seeds'], 0)
+                self.assertEqual(stats['pending_samples'],
+                                 computed.get_travel_time_refresh_stats()['pending_samples'])
+                monitor.close()
+
+    def test_set_parking_travel_time(self):
+        """ Test the use of a precomputed matrix """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=4, vehicles=0)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            monitor.set_parking_travel_time(TravelTimeMatrix.from_rows(
+                fake.pids, {'pa1': [(20.0, 'pa3'), (10.0, 'pa2')]}), {'e1': ['e0']})
+            self.assertEqual(monitor.get_closest_parkings('pa1'),
+                             [(10.0, 'pa2'), (20.0, 'pa3')])
+            with self.assertRaises(ParkingMonitorGenericError):
+                monitor.set_parking_travel_time(TravelTimeMatrix.from_rows(['pa1', 'pa9'], {}))
+            monitor.close()
+
+    def test_refresh_seeding(self):
+        """ Test that the rows without edges are seeded without being published again """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=8, vehicles=0)
+            parkings = [(pid, 'e{}'.format(pos), 20.0 + pos % 3)
+                        for pos, pid in enumerate(fake.pids)]
+            blacklist = collections.defaultdict(list)
+            rows = compute_travel_time_rows(fake, parkings, parkings, blacklist)
+            matrix = TravelTimeMatrix.from_rows(fake.pids, rows)
+            refresher = TravelTimeRefresher(fake, matrix, parkings, blacklist, budget=0.0)
+            self.assertEqual(refresher.stats()['pending_seeds'], 8)
+            for step in range(100):
+                self.assertIsNone(refresher.step(float(step)))
+            stats = refresher.stats()
+            self.assertEqual(stats['seeded_rows'], 8)
+            self.assertEqual(stats['computed_rows'], 0)
+            self.assertEqual(stats['pending_seeds'] + stats['pending_samples'], 0)
+            self.assertIs(refresher.matrix, matrix)
+
+class TestVehicleArchive(TestCase):
+    """ Test class for the VehicleArchive """
+
+    def test_add_and_get(self):
+        """ Test that the archived vehicles are retrieved unchanged """
+        vehicles = [
+            {'id': 'veh{}'.format(num), 'departure': float(num), 'arrived': 100.0 - num,
+             'vClass': 'passenger', 'stops': [('e1_0', 10.0, 'pa1', 137, 0.0, -1.0)],
+             'history': [[]], 'passengers': ('p1',)} for num in range(3)]
+        with tempfile.TemporaryDirectory() as directory:
+            archive = VehicleArchive(os.path.join(directory, 'archive.db'))
+            archive.add(vehicles)
+            self.assertEqual(len(archive), 3)
+            self.assertIn('veh1', archive)
+            self.assertEqual(archive.get('veh1'), vehicles[1])
+            self.assertIsNone(archive.get('veh3'))
+            self.assertEqual([vehicle['id'] for vehicle in archive], ['veh2', 'veh1', 'veh0'])
+            ## replaced, not counted again
+            archive.add([dict(vehicles[1], arrived=200.0), dict(vehicles[0], id='veh3')])
+            self.assertEqual(len(archive), 4)
+            self.assertEqual(archive.get('veh1')['arrived'], 200.0)
+            archive.close()
+            archive = VehicleArchive(os.path.join(directory, 'archive.db'))
+            self.assertEqual(len(archive), 4)
+            archive.close()
+
+    def test_monitor_archive(self):
+        """ Test the archive of the monitor, after the grace period """
+        for read_only_views in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                fake = FakeTraCI(directory, parkings=10, vehicles=50, horizon=200)
+                monitor = ParkingMonitor(fake, _fake_options(
+                    fake, vehicles_archive={'grace_period': 30.0},
+                    read_only_views=read_only_views))
+                arrivals = dict()
+                monitor.register_callback(
+                    'on_vehicle_arrived',
+                    lambda step, vehicle: arrivals.setdefault(vehicle, step))
+                live = dict()
+                while fake.time < 400.0:
+                    fake.simulationStep()
+                    for vehicle, arrived in arrivals.items():
+                        if fake.time - arrived <= 30.0:
+                            ## still in the vehicles database
+                            live[vehicle] = monitor.get_vehicle(vehicle)
+                            self.assertIn(vehicle, [record['id'] for record in
+                                                    monitor.get_vehicle_iterator()])
+                self.assertGreater(len(arrivals), 0)
+                self.assertEqual(monitor.get_archive_size(), len(arrivals))
+                self.assertFalse(set(arrivals) & {record['id'] for record in
+                                                  monitor.get_vehicle_iterator()})
+                for vehicle in arrivals:
+                    archived = monitor.get_vehicle(vehicle)
+                    self.assertIs(type(archived), type(live[vehicle]))
+                    self.assertEqual(dict(archived), dict(live[vehicle]))
+                monitor.close()
+
+class TestVehicleRecord(TestCase):
+    """ Test class for the VehicleRecord """
+
+    def test_dict_compatibility(self):
+        """ Test the dict interface and the history deltas """
+        table = dict()
+        first = ('e1_0', 10.0, 'pa1', 137, 0.0, -1.0)
+        second = ('e2_0', 5.0, 'pa2', 137, 0.0, -1.0)
+        third = ('e3_0', 5.0, 'pa3', 137, 0.0, -1.0)
+        record = VehicleRecord('veh', 1.0, intern_stops([first, second], table), 'passenger', ())
+        record.push_stops(intern_stops([second], table))
+        record.push_stops(intern_stops([third, second], table))
+        record['color'] = 'red'
+        self.assertEqual(record['history'], [(first, second), (second,)])
+        self.assertEqual(record['stops'], (third, second))
+        self.assertEqual(record.fingerprint, get_stops_fingerprint([third, second]))
+        self.assertIs(record['stops'][1], intern_stops([second], table)[0])
+        self.assertEqual(len(record), 12)
+        self.assertIn('color', record)
+        expected = dict(record)
+        self.assertEqual(copy.deepcopy(record), expected)
+        self.assertIsInstance(copy.deepcopy(record), dict)
+        record['history'] = [(third,)]
+        self.assertEqual(record['history'], [(third,)])
+
+    def test_unchanged_stops_skipped(self):
+        """ Test that only the vehicles whose stops changed update their projections """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=6, vehicles=120, capacity=2, horizon=100)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            # pylint: disable=protected-access
+            get_results = fake.vehicle.getAllSubscriptionResults
+            expected = set()
+
+            def _get_results():
+                """ The vehicles whose stopping places differ from their record """
+                results = get_results()
+                for vehicle, data in results.items():
+                    if (get_stops_fingerprint(data[tc.VAR_NEXT_STOPS]) !=
+                            monitor._vehicles_db[vehicle].fingerprint):
+                        expected.add(vehicle)
+                return results
+
+            push_stops = VehicleRecord.push_stops
+            pushed = set()
+
+            def _push_stops(record, stops, fingerprint=None):
+                pushed.add(record.id)
+                return push_stops(record, stops, fingerprint)
+
+            changed, unchanged = 0, 0
+            with mock.patch.object(fake.vehicle, 'getAllSubscriptionResults', _get_results), \
+                    mock.patch.object(VehicleRecord, 'push_stops', _push_stops), \
+                    mock.patch.object(monitor, '_add_vehicle_to_parking',
+                                      wraps=monitor._add_vehicle_to_parking) as add:
+                while fake.simulation.getMinExpectedNumber() > 0:
+                    expected.clear()
+                    pushed.clear()
+                    add.reset_mock()
+                    subscribed = len(fake.subscribed)
+                    fake.simulationStep()
+                    self.assertEqual(pushed, expected)
+                    ## the projections are only added for the vehicles with new stops
+                    projected = {call[0][3] for call in add.call_args_list
+                                 if call[0][1] == PROJECTIONS}
+                    self.assertLessEqual(projected - set(fake.departed), expected)
+                    changed += len(expected)
+                    unchanged += subscribed - len(expected)
+            self.assertGreater(changed, 0)
+            self.assertGreater(unchanged, changed)
+            monitor.close()
+
+class TestVehicleIndex(TestCase):
+    """ Test class for the VehicleIndex """
+
+    def test_queries(self):
+        """ Test the index updates and queries """
+        table = dict()
+        stop = ('e1_0', 10.0, 'pa1', 137, 0.0, -1.0)
+        index = VehicleIndex()
+        index.subscribe('veh2', 1)
+        records = [VehicleRecord('veh{}'.format(num), 0.0, intern_stops([stop], table),
+                                 'passenger' if num % 2 else 'truck', ()) for num in range(4)]
+        for record in records:
+            index.update(record)
+        records[1]['stopped'] = True
+        index.update(records[1])
+        records[3].push_stops(())
+        index.update(records[3])
+        self.assertEqual(index.query(state='driving', parking='pa1'), {'veh0', 'veh2'})
+        self.assertEqual(index.query(state='stopped'), {'veh1'})
+        self.assertEqual(index.query(vclass='passenger', parking='pa1'), {'veh1'})
+        self.assertEqual(index.query(subscribed=True), {'veh2'})
+        self.assertEqual(index.query(vclass='truck', subscribed=False), {'veh0'})
+        index.subscribe('veh2', -1)
+        index.remove('veh0')
+        self.assertEqual(index.query(vclass='truck'), {'veh2'})
+        self.assertEqual(index.query(subscribed=True), set())
+
+class TestLogs(TestCase):
+    """ Test class for the logging helpers """
+
+    def test_json_lines_formatter(self):
+        """ Test the structured format of the records """
+        record = logging.LogRecord('pypml', logging.DEBUG, __file__, 1,
+                                   '[%.2f] Vehicle %s has arrived.', (10.0, 'veh'), None)
+        event = json.loads(JsonLinesFormatter().format(record))
+        self.assertEqual(event['level'], 'DEBUG')
+        self.assertEqual(event['event'], '[%.2f] Vehicle %s has arrived.')
+        self.assertEqual(event['args'], [10.0, 'veh'])
+
+    def test_queue(self):
+        """ Test that the queued records reach the file and that close() stops the listener """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=10, vehicles=50, horizon=200)
+            filename = os.path.join(directory, 'pypml.log')
+            monitor = ParkingMonitor(fake, _fake_options(fake, logging={
+                'stdout': False, 'filename': filename, 'level': logging.DEBUG, 'queue': True,
+                'format': 'jsonl'}))
+            logger = logging.getLogger('parkingmonitor.ParkingMonitor')
+            # pylint: disable=protected-access
+            listener = monitor._log_listener
+            self.assertIsNotNone(listener._thread)
+            arrived = []
+            monitor.register_callback('on_vehicle_arrived',
+                                      lambda step, vehicle: arrived.append(vehicle))
+            while fake.time < 300.0:
+                fake.simulationStep()
+            self.assertGreater(len(arrived), 0)
+            monitor.close()
+            self.assertIsNone(listener._thread)
+            self.assertIsNone(monitor._log_listener)
+            self.assertFalse([handler for handler in logger.handlers
+                              if isinstance(handler, DeferredQueueHandler)])
+
+            with open(filename) as fread:
+                events = [json.loads(line) for line in fread]
+            logged = [event['args'][1] for event in events
+                      if event['event'] == '[%.2f] Vehicle %s has arrived.']
+            self.assertEqual(logged, arrived)
+            ## emitted after close(): not queued to the stopped listener
+            monitor._logger.debug('[%.2f] Vehicle %s has arrived.', 0.0, 'late')
+            with open(filename) as fread:
+                self.assertEqual(len(fread.readlines()), len(events))
+
+    def test_labeled_logger(self):
+        """ Test that the records of a labeled monitor are not written by an unlabeled one """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=4, vehicles=0)
+            monitors = dict()
+            for label in (None, 'labeled'):
+                monitors[label] = ParkingMonitor(fake, _fake_options(fake, label=label, logging={
+                    'stdout': False, 'filename': os.path.join(directory, '{}.log'.format(label)),
+                    'level': logging.INFO}))
+            # pylint: disable=protected-access
+            monitors['labeled']._logger.info('labeled record')
+            monitors[None]._logger.info('unlabeled record')
+            for monitor in monitors.values():
+                monitor.close()
+            with open(os.path.join(directory, 'None.log')) as fread:
+                content = fread.read()
+            self.assertIn('unlabeled record', content)
+            self.assertNotIn('labeled record', content.replace('unlabeled record', ''))
+            with open(os.path.join(directory, 'labeled.log')) as fread:
+                self.assertEqual(fread.read().count('labeled record'), 1)
+
+class TestStepStats(TestCase):
+    """ Test class for the StepStats """
+
+    def test_rolling_window(self):
+        """ Test the statistics over the rolling window and the metrics dump """
+        stats = StepStats(window=10)
+        for step in range(25):
+            stats.add({'step_time': float(step), 'vehicles': step})
+        summary = stats.summary()
+        self.assertEqual(summary['steps'], 25)
+        self.assertEqual(summary['window'], 10)
+        self.assertEqual(summary['max']['step_time'], 24.0)
+        self.assertEqual(summary['p50']['vehicles'], 19.5)
+        self.assertEqual(summary['last']['vehicles'], 24)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'metrics.txt')
+            dump_metrics(filename, summary)
+            with open(filename) as fread:
+                self.assertIn('pypml_step_time{stat="max"} 24.0\n', fread.read())
+
+    def test_traci_calls(self):
+        """ Test that the TraCI calls of the steps match the ones made, also pipelined """
+        for mode in ('listener', 'simulation_step', 'pipelined'):
+            with tempfile.TemporaryDirectory() as directory:
+                fake = FakeTraCI(directory, parkings=10, vehicles=50, horizon=200)
+                options = _fake_options(fake, instrumentation={'window': 1000},
+                                        addStepListener=mode == 'listener',
+                                        pipelined=mode == 'pipelined')
+                monitor = ParkingMonitor(fake, options)
+                initial = fake.calls
+                calls = 0
+                for _ in range(500):
+                    if mode == 'listener':
+                        fake.simulationStep()
+                    else:
+                        monitor.simulation_step()
+                    if monitor.get_step_stats()['steps']:
+                        calls += monitor.get_step_stats()['last']['traci_calls']
+                ## the vehicles are gone: sync() leaves no delayed calls behind
+                monitor.sync()
+                if mode == 'pipelined':
+                    calls += monitor.get_step_stats()['last']['traci_calls']
+                self.assertEqual(monitor.get_step_stats()['steps'], 500)
+                self.assertGreater(calls, 0)
+                ## the simulation steps made by the monitor are counted as well
+                steps = 0 if mode == 'listener' else 500
+                self.assertEqual(calls, fake.calls - initial + steps, mode)
+                monitor.close()
+
+class TestRecordReplay(TestCase):
+    """ Test class for the TraCI record and replay """
+
+    def test_record_and_replay(self):
+        """ Test that the replay returns the recorded results, step by step """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=50, horizon=20)
+            filename = os.path.join(directory, 'recording.gz')
+            recorder = RecordingTraCI(fake, filename)
+            recorded = []
+            while recorder.simulation.getMinExpectedNumber() > 0:
+                recorder.simulationStep()
+                recorded.append((recorder.simulation.getDepartedIDList(),
+                                 recorder.simulation.getParameter('pa1', 'parkingArea.occupancy'),
+                                 recorder.simulation.getTime()))
+            with self.assertRaises(exceptions.TraCIException):
+                recorder.simulation.getParameter('pa1', 'unknown')
+            recorder.close()
+
+            replay = ReplayTraCI(filename)
+            replayed = []
+            while replay.simulation.getMinExpectedNumber() > 0:
+                replay.simulationStep()
+                ## different order
+                time = replay.simulation.getTime()
+                replayed.append((replay.simulation.getDepartedIDList(),
+                                 replay.simulation.getParameter('pa1', 'parkingArea.occupancy'),
+                                 time))
+            self.assertEqual(recorded, replayed)
+            with self.assertRaises(exceptions.TraCIException):
+                replay.simulation.getParameter('pa1', 'unknown')
+            with self.assertRaises(ReplayError):
+                replay.simulation.getParameter('pa2', 'parkingArea.occupancy')
+            replay.close()
+
+class TestMultiSimulation(TestCase):
+    """ Test class for several monitors in the same process """
+
+    def test_multi_simulation(self):
+        """ Test that the monitors of concurrent simulations are independent """
+        with tempfile.TemporaryDirectory() as directory:
+            fakes = {}
+            simulations = MultiSimulation()
+            for label, seed, vehicles in (('first', 7, 60), ('second', 11, 90)):
+                os.mkdir(os.path.join(directory, label))
+                fakes[label] = FakeTraCI(os.path.join(directory, label), parkings=6,
+                                         vehicles=vehicles, seed=seed, horizon=100)
+                simulations.add(label, fakes[label], _fake_options(
+                    fakes[label], addStepListener=label == 'first'))
+            self.assertEqual(simulations.get_labels(), ['first', 'second'])
+
+            ## different additional files: the travel time is shared by hand
+            simulations.compute_parking_travel_time()
+            first = simulations.get_monitor('first')
+            second = simulations.get_monitor('second')
+            calls = fakes['second'].calls
+            second.share_parking_travel_time(first)
+            self.assertEqual(fakes['second'].calls, calls)
+            self.assertEqual(first.get_closest_parkings('pa1'), second.get_closest_parkings('pa1'))
+
+            while simulations.get_running():
+                for label in simulations.step():
+                    monitor = simulations.get_monitor(label)
+                    for pid in fakes[label].pids:
+                        self.assertEqual(monitor.get_parking(pid)['total_occupancy'],
+                                         len(fakes[label].parked[pid]))
+            self.assertEqual(len(first.get_vehicle_ids(state='arrived')), 60)
+            self.assertEqual(len(second.get_vehicle_ids(state='arrived')), 90)
+            simulations.close()
+
+    def test_share_key(self):
+        """ Test that the travel time is shared only with the same network, parkings,
+            blacklist and vClasses """
+        with tempfile.TemporaryDirectory() as directory:
+            simulations = MultiSimulation()
+            parking_file = None
+            for label, net_file, vclasses in (
+                    ('first', 'one.net.xml', VCLASSES), ('same', 'one.net.xml', VCLASSES),
+                    ('other_net', 'two.net.xml', VCLASSES),
+                    ('other_vclasses', 'one.net.xml', ('passenger',)),
+                    ('no_net', None, VCLASSES)):
+                os.mkdir(os.path.join(directory, label))
+                fake = FakeTraCI(os.path.join(directory, label), parkings=6, vehicles=0)
+                parking_file = parking_file or fake.filename
+                if net_file:
+                    net_file = os.path.join(directory, net_file)
+                simulations.add(label, fake, _fake_options(
+                    fake, sumo_parking_file=parking_file, vclasses=set(vclasses)),
+                                net_file=net_file)
+            simulations.compute_parking_travel_time()
+            first = simulations.get_monitor('first')
+            self.assertEqual(simulations.get_monitor('same').get_closest_parkings('pa1'),
+                             first.get_closest_parkings('pa1'))
+            for label in ('other_net', 'other_vclasses', 'no_net'):
+                with self.assertRaises(ParkingMonitorGenericError):
+                    simulations.get_monitor(label).get_closest_parkings('pa1')
+            simulations.close()
+
+class TestOverbooking(TestCase):
+    """ Test class for the overbooking resolution """
+
+    def test_resolve_overbooking(self):
+        """ Test the reroutes from the overbooked parkings, with the per-step cap """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=10, vehicles=150, horizon=100)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            monitor.compute_parking_travel_time()
+
+            rerouted = 0
+            while fake.simulation.getMinExpectedNumber() > 0:
+                fake.simulationStep()
+                free = dict(zip(monitor.get_parking_ids(), monitor.get_free_places_bulk(
+                    vclass='passenger', with_projections=True, with_subscriptions=True).tolist()))
+                planned = monitor.resolve_overbooking(max_reroutes=3, apply=False)
+                self.assertLessEqual(len(planned), 3)
+                decisions = monitor.resolve_overbooking(max_reroutes=3)
+                self.assertEqual(planned, decisions)
+                for vehicle, parking, alternative, travel_time in decisions:
+                    self.assertLess(free[parking], 0)
+                    self.assertGreater(free[alternative], 0)
+                    self.assertEqual(fake.vehicles[vehicle]['target'], alternative)
+                    self.assertIn((travel_time, alternative),
+                                  monitor.get_closest_parkings(parking))
+                ## the cap is for the whole step
+                self.assertEqual(monitor.resolve_overbooking(max_reroutes=3), [])
+                rerouted += len(decisions)
+            self.assertGreater(rerouted, 0)
+            monitor.close()
+
+    def test_verify_routes(self):
+        """ Test that the vehicles are not moved to the alternatives they cannot reach """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=10, vehicles=150, horizon=100)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            monitor.compute_parking_travel_time()
+            find_route = fake.simulation.findRoute
+
+            def _find_route(from_edge, to_edge, vType=''):
+                """ pa3 (on e3) is not reachable from the edge of the driving vehicles """
+                if from_edge == 'e11' and to_edge == 'e3':
+                    raise exceptions.TraCIException('No route.')
+                return find_route(from_edge, to_edge, vType=vType)
+
+            unverified, verified = 0, 0
+            with mock.patch.object(fake.simulation, 'findRoute', _find_route):
+                while fake.simulation.getMinExpectedNumber() > 0:
+                    fake.simulationStep()
+                    unverified += sum(1 for decision in monitor.resolve_overbooking(apply=False)
+                                      if decision[2] == 'pa3')
+                    decisions = monitor.resolve_overbooking(verify_routes=True)
+                    self.assertNotIn('pa3', [decision[2] for decision in decisions])
+                    verified += len(decisions)
+            self.assertGreater(unverified, 0)
+            self.assertGreater(verified, 0)
+            monitor.close()
+
+class TestFindAlternatives(TestCase):
+    """ Test class for ParkingMonitor.find_alternatives """
+
+    def _monitor(self, directory, **options):
+        """ Return the fake TraCI and the monitor, with pa2 full and pa4 with one free place. """
+        fake = FakeTraCI(directory, parkings=8, vehicles=0)
+        monitor = ParkingMonitor(fake, _fake_options(fake, **options))
+        fake.parked['pa2'].update('parked2.{}'.format(pos) for pos in range(5))
+        fake.parked['pa4'].update('parked4.{}'.format(pos) for pos in range(4))
+        fake.simulationStep()
+        return fake, monitor
+
+    def _expected(self, monitor, parking, min_free=1):
+        """ Return the alternatives computed from get_closest_parkings and get_free_places. """
+        return [(travel_time, pid, monitor.get_free_places(pid, vclass='passenger'))
+                for travel_time, pid in monitor.get_closest_parkings(parking)
+                if monitor.get_free_places(pid, vclass='passenger') >= min_free]
+
+    def test_find_alternatives(self):
+        """ Test num, max_travel_time, min_free and exclude """
+        with tempfile.TemporaryDirectory() as directory:
+            _, monitor = self._monitor(directory)
+            with self.assertRaises(ParkingMonitorGenericError):
+                monitor.find_alternatives('pa1', 'passenger')
+            monitor.compute_parking_travel_time()
+
+            expected = self._expected(monitor, 'pa1')
+            self.assertNotIn('pa2', [pid for _, pid, _ in expected])
+            self.assertIn(('pa4', 1), [(pid, free) for _, pid, free in expected])
+            self.assertEqual(monitor.find_alternatives('pa1', 'passenger'), expected)
+            self.assertEqual(monitor.find_alternatives('pa1', 'passenger', num=2), expected[:2])
+
+            max_travel_time = expected[2][0]
+            self.assertEqual(
+                monitor.find_alternatives('pa1', 'passenger', max_travel_time=max_travel_time),
+                [item for item in expected if item[0] <= max_travel_time])
+
+            self.assertEqual(monitor.find_alternatives('pa1', 'passenger', min_free=2),
+                             self._expected(monitor, 'pa1', min_free=2))
+            self.assertNotIn('pa4', [pid for _, pid, _ in monitor.find_alternatives(
+                'pa1', 'passenger', min_free=2)])
+
+            excluded = {expected[0][1], expected[1][1], 'unknown'}
+            self.assertEqual(
+                monitor.find_alternatives('pa1', 'passenger', num=2, exclude=excluded),
+                [item for item in expected if item[1] not in excluded][:2])
+
+            with self.assertRaises(ParkingMonitorGenericError):
+                monitor.find_alternatives('unknown', 'passenger')
+            with self.assertRaises(ParkingMonitorGenericError):
+                monitor.find_alternatives('pa1', 'unknown')
+            monitor.close()
+
+    def test_find_alternatives_uncertainty(self):
+        """ Test the uncertainty, with a deterministic error on pa3 """
+        with tempfile.TemporaryDirectory() as directory:
+            _, monitor = self._monitor(
+                directory, specific_conf={'pa3': {'uncertainty': {'mu': -3.0, 'sigma': 0.0}}})
+            monitor.compute_parking_travel_time()
+            certain = monitor.find_alternatives('pa1', 'passenger', min_free=3)
+            self.assertIn('pa3', [pid for _, pid, _ in certain])
+            uncertain = monitor.find_alternatives('pa1', 'passenger', min_free=3,
+                                                  with_uncertainty=True)
+            self.assertEqual(uncertain, [item for item in certain if item[1] != 'pa3'])
+            self.assertIn('pa3', [pid for _, pid, free in monitor.find_alternatives(
+                'pa1', 'passenger', min_free=2, with_uncertainty=True) if free == 2])
+            monitor.close()
+
+class TestRerouters(TestCase):
+    """ Test class for the rerouter intervals """
+
+    def test_rerouter_boundaries(self):
+        """ Test the active interval at the boundary steps of overlapping intervals """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+
+            def _visible(step):
+                info = next(monitor.get_rerouter_iterator(step))['info']
+                return None if info is None else info[0][1]
+
+            ## intervals [0, 300] (visible), [0, 600] and [0, 900] (not visible)
+            self.assertEqual(_visible(0.0), True)
+            self.assertEqual(_visible(300.0), True)
+            self.assertEqual(_visible(300.25), False)
+            self.assertEqual(_visible(900.0), False)
+            self.assertIsNone(_visible(900.25))
+            monitor.close()
+
+    def test_rerouter_gaps(self):
+        """ Test the steps before, between and after disjoint intervals """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=2, vehicles=0)
+            with open(fake.filename, 'w') as fwrite:
+                fwrite.write(
+                    '<additional>\n'
+                    '    <parkingArea id="pa0" lane="e0_0" startPos="5" endPos="20" '
+                    'roadsideCapacity="5"/>\n'
+                    '    <parkingArea id="pa1" lane="e1_0" startPos="5" endPos="21" '
+                    'roadsideCapacity="5"/>\n'
+                    '    <rerouter id="rr0" edges="e0">\n'
+                    '        <interval begin="300" end="400">\n'
+                    '            <parkingAreaReroute id="pa1"/>\n'
+                    '        </interval>\n'
+                    '        <interval begin="100" end="200">\n'
+                    '            <parkingAreaReroute id="pa0"/>\n'
+                    '        </interval>\n'
+                    '    </rerouter>\n'
+                    '    <rerouter id="rr1" edges="e1">\n'
+                    '        <interval begin="0" end="900">\n'
+                    '            <parkingAreaReroute id="pa0"/>\n'
+                    '        </interval>\n'
+                    '        <interval begin="500" end="600">\n'
+                    '            <parkingAreaReroute id="pa1"/>\n'
+                    '        </interval>\n'
+                    '    </rerouter>\n'
+                    '</additional>\n')
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+
+            def _parkings(step, rerouter='rr0'):
+                info = None
+                for value in monitor.get_rerouter_iterator(step):
+                    if value['id'] == rerouter:
+                        info = value['info']
+                return None if info is None else [pid for pid, _ in info]
+
+            self.assertIsNone(_parkings(99.75))
+            self.assertEqual(_parkings(100.0), ['pa0'])
+            self.assertEqual(_parkings(200.0), ['pa0'])
+            self.assertIsNone(_parkings(250.0))
+            self.assertEqual(_parkings(300.0), ['pa1'])
+            self.assertEqual(_parkings(400.0), ['pa1'])
+            self.assertIsNone(_parkings(400.25))
+            ## nested intervals
+            self.assertEqual(_parkings(100.0, 'rr1'), ['pa0'])
+            self.assertEqual(_parkings(550.0, 'rr1'), ['pa1'])
+            self.assertEqual(_parkings(700.0, 'rr1'), ['pa0'])
+            self.assertIsNone(_parkings(900.25, 'rr1'))
+            monitor.close()
+
+class TestCallbacks(TestCase):
+    """ Test class for the event callbacks """
+
+    def setUp(self):
+        self.events = {}
+        self.fake_starting, self.fake_ending = [], []
+
+    def _run(self, directory, callbacks):
+        """ Run the fake scenario with the callbacks, return the fake TraCI and the monitor. """
+        fake = FakeTraCI(directory, parkings=10, vehicles=100, horizon=200)
+        monitor = ParkingMonitor(fake, _fake_options(fake))
+        for event, callback in callbacks:
+            monitor.register_callback(event, callback)
+        while fake.simulation.getMinExpectedNumber() > 0:
+            fake.simulationStep()
+            self.fake_starting.extend(fake.starting)
+            self.fake_ending.extend(fake.ending)
+        return fake, monitor
+
+    def _record(self, event):
+        """ Return a callback recording its arguments in self.events[event]. """
+        self.events[event] = []
+        return event, lambda *args: self.events[event].append(args)
+
+    def test_vehicle_events(self):
+        """ Test on_vehicle_departed and on_vehicle_arrived """
+        with tempfile.TemporaryDirectory() as directory:
+            fake, monitor = self._run(directory, [self._record('on_vehicle_departed'),
+                                                  self._record('on_vehicle_arrived')])
+            self.assertEqual(sorted(vehicle for _, vehicle in self.events['on_vehicle_departed']),
+                             sorted(fake.vehicles))
+            self.assertEqual(sorted(vehicle for _, vehicle in self.events['on_vehicle_arrived']),
+                             sorted(fake.vehicles))
+            for step, vehicle in self.events['on_vehicle_arrived']:
+                self.assertEqual(monitor.get_vehicle(vehicle)['arrived'], step)
+            monitor.close()
+
+    def test_parking_events(self):
+        """ Test on_parking_started and on_parking_ended """
+        with tempfile.TemporaryDirectory() as directory:
+            fake, monitor = self._run(directory, [self._record('on_parking_started'),
+                                                  self._record('on_parking_ended')])
+            self.assertEqual(sorted(vehicle for _, vehicle, _ in self.events['on_parking_started']),
+                             sorted(self.fake_starting))
+            self.assertEqual(sorted(vehicle for _, vehicle, _ in self.events['on_parking_ended']),
+                             sorted(self.fake_ending))
+            for _, _, parking in self.events['on_parking_started']:
+                self.assertIn(parking, fake.pids)
+            monitor.close()
+
+    def test_projection_changed(self):
+        """ Test on_projection_changed, fired when the fake reroutes from a full parking """
+        with tempfile.TemporaryDirectory() as directory:
+            _, monitor = self._run(directory, [self._record('on_projection_changed')])
+            self.assertTrue(self.events['on_projection_changed'])
+            for _, vehicle, removed, added in self.events['on_projection_changed']:
+                self.assertIsInstance(removed, frozenset)
+                self.assertIsInstance(added, frozenset)
+                self.assertTrue(removed or added)
+                self.assertTrue(removed.isdisjoint(added))
+                self.assertIn(vehicle, [item['id'] for item in monitor.get_vehicle_iterator()])
+            monitor.close()
+
+    def test_parking_overbooked(self):
+        """ Test on_parking_overbooked against the free places with the projections """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=10, vehicles=100, horizon=200)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            monitor.register_callback(*self._record('on_parking_overbooked'))
+            while fake.simulation.getMinExpectedNumber() > 0:
+                fake.simulationStep()
+                for step, parking in self.events['on_parking_overbooked']:
+                    if step == fake.time:
+                        self.assertLess(monitor.get_free_places(
+                            parking, vclass='passenger', with_projections=True), 0)
+            self.assertTrue(self.events['on_parking_overbooked'])
+            monitor.close()
+
+    def test_callback_exception(self):
+        """ Test that a raising callback is logged and does not interrupt the step """
+
+        def _raise(step, vehicle):
+            raise ValueError('{} {}'.format(step, vehicle))
+
+        with tempfile.TemporaryDirectory() as directory:
+            with self.assertLogs('parkingmonitor.ParkingMonitor', level='ERROR') as logs:
+                fake, monitor = self._run(directory, [('on_vehicle_departed', _raise),
+                                                      self._record('on_vehicle_departed')])
+            self.assertEqual(len(logs.records), 100)
+            self.assertEqual(len(self.events['on_vehicle_departed']), 100)
+            for pid in fake.pids:
+                self.assertEqual(monitor.get_parking(pid)['total_occupancy'],
+                                 len(fake.parked[pid]))
+            self.assertEqual(len(monitor.get_vehicle_ids(state='arrived')), 100)
+            self.assertTrue(monitor.remove_callback('on_vehicle_departed', _raise))
+            self.assertFalse(monitor.remove_callback('on_vehicle_departed', _raise))
+            with self.assertRaises(ParkingMonitorGenericError):
+                monitor.register_callback('unknown', _raise)
+            monitor.close()
+
+class TestRouteCache(TestCase):
+    """ Test class for the route cache """
+
+    def test_default_ttl(self):
+        """ Test that the routes of the monitor expire by default """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            monitor = ParkingMonitor(fake, _fake_options(fake))
+            monitor.find_route('e1', 'e4')
+            monitor.find_route('e1', 'e4')
+            self.assertEqual(monitor.get_route_cache_stats()['misses'], 1)
+            for _ in range(int(DEFAULT_TTL) + 1):
+                fake.simulationStep()
+            monitor.find_route('e1', 'e4')
+            self.assertEqual(monitor.get_route_cache_stats()['expired'], 1)
+            self.assertEqual(monitor.get_route_cache_stats()['misses'], 2)
+            monitor.close()
+
+    def test_route_cache(self):
+        """ Test hits, failures, expiration and eviction """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            cache = RouteCache(fake, lambda: fake.time, max_size=3, ttl=10,
+                               negative_ttl=100)
+            calls = fake.calls
+            self.assertEqual(cache.find_route('e1', 'e4').travelTime, 32.5)
+            self.assertEqual(cache.find_route('e1', 'e4').travelTime, 32.5)
+            ## (1 + 2) % 17 == 3: no route
+            self.assertIsNone(cache.find_route('e1', 'e2'))
+            self.assertIsNone(cache.find_route('e1', 'e2'))
+            ## one findRoute for each pair
+            self.assertEqual(fake.calls - calls, 2)
+            self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'negative_hits': 1,
+                                             'misses': 2, 'expired': 0, 'evictions': 0})
+
+            for _ in range(11):
+                fake.simulationStep()
+            cache.find_route('e1', 'e4')
+            cache.find_route('e1', 'e2')
+            cache.find_route('e1', 'e4', max_age=0)
+            self.assertEqual(cache.stats()['expired'], 1)
+            self.assertEqual(cache.stats()['negative_hits'], 2)
+
+            cache.find_route('e0', 'e1')
+            cache.find_route('e0', 'e3')
+            self.assertEqual(len(cache), 3)
+            self.assertEqual(cache.stats()['evictions'], 1)
+
+class TestPipelined(TestCase):
+    """ Test class for the pipelined mode """
+
+    def test_pipelined(self):
+        """ Test the consistency points and the final state against the sequential mode """
+        results = []
+        for pipelined in (False, True):
+            with tempfile.TemporaryDirectory() as directory:
+                fake = FakeTraCI(directory, parkings=10, vehicles=100, horizon=200)
+                monitor = ParkingMonitor(fake, _fake_options(fake, addStepListener=False,
+                                                             pipelined=pipelined))
+                previous = None
+                while fake.simulation.getMinExpectedNumber() > 0:
+                    monitor.simulation_step()
+                    ## pipelined: the monitor reflects the previous step
+                    expected = previous if pipelined else fake.parked
+                    if expected is not None:
+                        for pid in fake.pids:
+                            self.assertEqual(monitor.get_parking(pid)['total_occupancy'],
+                                             len(expected[pid]))
+                    previous = copy.deepcopy(fake.parked)
+                monitor.sync()
+                results.append((
+                    {vehicle['id']: (vehicle['departure'], vehicle['arrived'], vehicle['history'])
+                     for vehicle in monitor.get_vehicle_iterator()},
+                    {parking['sumo']['id']: list(parking['occupancy_series'])
+                     for parking in monitor.get_parking_iterator()}))
+                monitor.close()
+        self.assertEqual(len(results[0][0]), 100)
+        self.assertEqual(results[0], results[1])
+
+    def test_snapshot(self):
+        """ Test the answers of the TraCI snapshot """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            snapshot = TraCISnapshot(fake)
+            snapshot.read('simulation', 'getParameter', 'pa1', 'parkingArea.capacity')
+            snapshot.read('simulation', 'getParameter', 'pa1', 'unknown')
+            self.assertEqual(snapshot.simulation.getParameter('pa1', 'parkingArea.capacity'), '5')
+            with self.assertRaises(exceptions.TraCIException):
+                snapshot.simulation.getParameter('pa1', 'unknown')
+            with self.assertRaises(SnapshotError):
+                snapshot.simulation.getTime()
+            snapshot.vehicle.subscribe('veh0', varIDs=())
+            self.assertNotIn('veh0', fake.subscribed)
+            self.assertEqual(snapshot.apply_writes(), [])
+            self.assertIn('veh0', fake.subscribed)
+
+class TestBackend(TestCase):
+    """ Test class for the TraCI backends """
+
+    def test_libsumo_semantics(self):
+        """ Test the monitor with a backend with the libsumo semantics, created by the monitor """
+        results = []
+        for libsumo, pipelined in ((False, False), (True, False), (True, True)):
+            with tempfile.TemporaryDirectory() as directory:
+                options = _fake_options(
+                    None, backend={'name': 'fake', 'directory': directory, 'parkings': 10,
+                                   'vehicles': 100, 'horizon': 200, 'libsumo': libsumo},
+                    addStepListener=False, pipelined=pipelined,
+                    sumo_parking_file=os.path.join(directory, 'parkings.add.xml'))
+                monitor = ParkingMonitor(None, options)
+                fake = monitor.get_traci_handler()
+                self.assertEqual(fake.isLibsumo(), libsumo)
+                while fake.simulation.getMinExpectedNumber() > 0:
+                    monitor.simulation_step()
+                monitor.sync()
+                results.append(
+                    {vehicle['id']: (vehicle['departure'], vehicle['arrived'], vehicle['history'])
+                     for vehicle in monitor.get_vehicle_iterator()})
+                monitor.close()
+        self.assertEqual(len(results[0]), 100)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+
+    def test_register_backend(self):
+        """ Test the registration of a backend and the unknown backends """
+        with tempfile.TemporaryDirectory() as directory:
+            fake = FakeTraCI(directory, parkings=5, vehicles=0)
+            options = _fake_options(fake, backend={'name': 'existing'}, addStepListener=False)
+            with self.assertRaises(ParkingMonitorGenericError):
+                ParkingMonitor(None, options)
+            register_backend('existing', lambda: fake)
+            try:
+                monitor = ParkingMonitor(None, options)
+                self.assertIs(monitor.get_traci_handler(), fake)
+                self.assertEqual(len(monitor.get_parking_ids()), 5)
+                monitor.close()
+            finally:
+                del BACKENDS['existing']
+
+    def test_without_traci(self):
+        """ Test the import and the fake backend without the TraCI library """
+        with tempfile.TemporaryDirectory() as directory:
+            code = (
+                "import sys\n"
+                "sys.modules['traci'] = sys.modules['libsumo'] = None\n"
+                "from pypml import ParkingMonitor\n"
+                "from pypml.backend import BackendError, get_backend\n"
+                "try:\n"
+                "    get_backend('traci')\n"
+                "except BackendError:\n"
+                "    pass\n"
+                "from pypml.pypml_tests import _fake_options\n"
+                "options = _fake_options(\n"
+                "    None, backend={{'name': 'fake', 'directory': {0!r}, 'vehicles': 20}},\n"
+                "    sumo_parking_file={1!r})\n"
+                "monitor = ParkingMonitor(None, options)\n"
+                "fake = monitor.get_traci_handler()\n"
+                "while fake.simulation.getMinExpectedNumber() > 0:\n"
+                "    fake.simulationStep()\n"
+                "print(len(monitor.get_vehicle_ids(state='arrived')))\n").format(
+                    directory, os.path.join(directory, 'parkings.add.xml'))
+            env = dict(os.environ)
+            env.pop('SUMO_TOOLS', None)
+            env.pop('SUMO_HOME', None)
+            env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            output = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True).stdout
+            self.assertEqual(output.strip(), '20')
+
+    def test_libsumo(self):
+        """ Test the monitor with the real libsumo backend, if available """
+        try:
+            import libsumo # pylint: disable=import-outside-toplevel,unused-import
+        except ImportError:
+            self.skipTest('libsumo is not available')
+        scenario = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'examples', 'test_scenario')
+        options = _fake_options(
+            None, backend={'name': 'libsumo',
+                           'sumo_cmd': ['sumo', '-c', os.path.join(scenario, 'sumo.simple.cfg'),
+                                        '--no-step-log', '--no-warnings',
+                                        '--duration-log.disable', '--verbose', 'false']},
+            sumo_parking_file=os.path.join(scenario, 'parkings.small.add.xml'),
+            vclasses={'truck', 'passenger', 'motorcycle'},
+            subscriptions={'only_parkings': False})
+        monitor = ParkingMonitor(None, options)
+        handler = monitor.get_traci_handler()
+        try:
+            for _ in range(600):
+                handler.simulationStep()
+            for pid in monitor.get_parking_ids():
+                self.assertEqual(
+                    monitor.get_parking(pid)['total_occupancy'],
+                    int(handler.simulation.getParameter(pid, 'parkingArea.occupancy')))
+            vehicles = [vehicle for vehicle in monitor.get_vehicle_iterator()
+                        if vehicle['stops'] and not vehicle['arrived']]
+            self.assertTrue(vehicles)
+            for vehicle in vehicles:
+                ## the stops are updated when their stopping places change
+                stops = handler.vehicle.getNextStops(vehicle['id'])
+                self.assertTrue(all(isinstance(stop, tuple) and len(stop) == 6
+                                    for stop in vehicle['stops']))
+                self.assertEqual([stop[2] for stop in vehicle['stops']],
+                                 [stop.stoppingPlaceID for stop in stops])
+        finally:
+            monitor.close()
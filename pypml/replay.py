@@ -0,0 +1,219 @@
+""" Record and replay of the TraCI calls made through a handler.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+import gzip
+import pickle
+
+from .backend import exceptions
+from .stats import TRACI_DOMAINS
+
+_FORMAT = 'pypml-traci-recording'
+_VERSION = 1
+
+## Calls recorded without their arguments (not serializable, e.g. the step listeners)
+_NO_ARGUMENTS = ('addStepListener', 'removeStepListener')
+
+class ReplayError(Exception):
+    """ The replayed code made a TraCI call that is not in the recording. """
+
+def _freeze(value):
+    """ Return a hashable version of the arguments. """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+class RecordingTraCI():
+    """ Proxy of a TraCI handler (traci, a TraCI connection or libsumo) recording every call,
+        with its arguments and result, in a gzip-compressed file.
+
+        The calls are saved in a chunk for each simulationStep made through the recorder, and
+        each chunk holds the calls made before the step returned (the step listeners included).
+        The recorder must be used both for the ParkingMonitor and for the simulation loop, and
+        closed at the end.
+    """
+
+    def __init__(self, handler, filename, compresslevel=6):
+        """ Wrap the handler and start recording in filename. """
+        self._handler = handler
+        self._file = gzip.open(filename, 'wb', compresslevel=compresslevel)
+        pickle.dump({'format': _FORMAT, 'version': _VERSION}, self._file)
+        self._chunk = []
+        self._domains = dict()
+        self._functions = dict()
+
+    def _recording(self, domain, name, function):
+        """ Return the function recording its calls. """
+        def _recording_call(*args, **kwargs):
+            if name in _NO_ARGUMENTS:
+                key = (domain, name, (), ())
+            else:
+                key = (domain, name, _freeze(args), _freeze(kwargs))
+            try:
+                result = function(*args, **kwargs)
+            except exceptions.TraCIException as excpt:
+                self._chunk.append(key + (False, str(excpt)))
+                raise
+            self._chunk.append(key + (True, result))
+            if domain == '' and name == 'simulationStep':
+                self._flush()
+            return result
+        return _recording_call
+
+    def _flush(self):
+        """ Write the current chunk. """
+        pickle.dump(self._chunk, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        self._chunk = []
+
+    def close(self):
+        """ Write the last chunk and close the file (not the handler). """
+        if self._file is None:
+            return
+        self._flush()
+        self._file.close()
+        self._file = None
+
+    def __getattr__(self, name):
+        if name in self._domains:
+            return self._domains[name]
+        if name in self._functions:
+            return self._functions[name]
+        value = getattr(self._handler, name)
+        if name in TRACI_DOMAINS:
+            self._domains[name] = _RecordingDomain(name, value, self)
+            return self._domains[name]
+        if callable(value) and not isinstance(value, type):
+            self._functions[name] = self._recording('', name, value)
+            return self._functions[name]
+        return value
+
+class _RecordingDomain():
+    """ Proxy of a TraCI domain recording the calls in the RecordingTraCI. """
+
+    def __init__(self, name, domain, recorder):
+        self._name = name
+        self._domain = domain
+        self._recorder = recorder
+        self._functions = dict()
+
+    def __getattr__(self, name):
+        if name not in self._functions:
+            value = getattr(self._domain, name)
+            if not callable(value):
+                return value
+            self._functions[name] = self._recorder._recording(self._name, name, value)
+        return self._functions[name]
+
+class ReplayTraCI():
+    """ TraCI handler answering with the results recorded by RecordingTraCI, without SUMO.
+
+        Within each simulation step, a call gets the next result recorded for the same
+        function with the same arguments, so the replayed code may make the calls in a
+        different order or skip some of them. A call that is not in the recording of the step
+        raises a ReplayError, a call that raised a TraCIException raises it again.
+        simulationStep() calls the registered step listeners and moves to the next step.
+    """
+
+    def __init__(self, filename):
+        """ Open the recording. """
+        self._file = gzip.open(filename, 'rb')
+        header = pickle.load(self._file)
+        if header.get('format') != _FORMAT or header.get('version') != _VERSION:
+            raise ReplayError('{} is not a PyPML TraCI recording.'.format(filename))
+        self._listeners = []
+        self._results = None
+        self._domains = dict()
+        self._functions = dict()
+        self.steps = 0
+        self._load_chunk()
+
+    def _load_chunk(self):
+        """ Load the calls of the next step, return False at the end of the recording. """
+        self._results = collections.defaultdict(collections.deque)
+        try:
+            chunk = pickle.load(self._file)
+        except EOFError:
+            return False
+        for domain, name, args, kwargs, success, value in chunk:
+            self._results[(domain, name, args, kwargs)].append((success, value))
+        return True
+
+    def _replay(self, domain, name, args, kwargs):
+        """ Return (or raise) the next recorded result of the call. """
+        if name in _NO_ARGUMENTS:
+            key = (domain, name, (), ())
+        else:
+            key = (domain, name, _freeze(args), _freeze(kwargs))
+        results = self._results.get(key)
+        if not results:
+            raise ReplayError('Call {}.{}{} not recorded at step {}.'.format(
+                domain or 'traci', name, args, self.steps))
+        success, value = results.popleft()
+        if not success:
+            raise exceptions.TraCIException(value)
+        return value
+
+    def _replaying(self, domain, name):
+        """ Return the function replaying the calls. """
+        def _replaying_call(*args, **kwargs):
+            return self._replay(domain, name, args, kwargs)
+        return _replaying_call
+
+    def addStepListener(self, listener):
+        """ Register the step listener, called by simulationStep. """
+        self._replay('', 'addStepListener', (), {})
+        self._listeners.append(listener)
+        return len(self._listeners) - 1
+
+    def simulationStep(self, step=0.0):
+        """ Call the step listeners and move to the next recorded step. """
+        for listener in self._listeners:
+            listener.step(step)
+        result = self._replay('', 'simulationStep', (step,) if step else (), {})
+        self.steps += 1
+        self._load_chunk()
+        return result
+
+    def close(self):
+        """ Close the recording. """
+        self._file.close()
+
+    def __getattr__(self, name):
+        if name in self._domains:
+            return self._domains[name]
+        if name in self._functions:
+            return self._functions[name]
+        if name in TRACI_DOMAINS:
+            self._domains[name] = _ReplayDomain(name, self)
+            return self._domains[name]
+        if name.startswith('_'):
+            raise AttributeError(name)
+        self._functions[name] = self._replaying('', name)
+        return self._functions[name]
+
+class _ReplayDomain():
+    """ TraCI domain of the ReplayTraCI. """
+
+    def __init__(self, name, replay):
+        self._name = name
+        self._replay = replay
+        self._functions = dict()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._functions:
+            self._functions[name] = self._replay._replaying(self._name, name)
+        return self._functions[name]
@@ -0,0 +1,93 @@
+""" Route cache for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+
+from .backend import exceptions
+
+## Default time-to-live of the cached routes, in seconds of simulation
+DEFAULT_TTL = 60.0
+
+class RouteCache():
+    """ LRU cache of the results of simulation.findRoute, by (from edge, to edge, vType).
+
+        The failures (TraCIException, or a route without edges) are cached as well, as None.
+        The age of the entries is measured with the given clock (e.g. the simulation time),
+        and the entries older than the time-to-live are computed again, because the travel
+        times change with the traffic.
+    """
+
+    def __init__(self, traci_handler, clock, max_size=65536, ttl=DEFAULT_TTL,
+                 negative_ttl=None):
+        """ Initialize the empty cache.
+
+            traci_handler: TraCI connection (or libsumo) used for simulation.findRoute.
+            clock:         Callable returning the current time.
+            max_size:      Int. Maximum number of entries, the least recently used are evicted.
+            ttl:           Float. Time-to-live of the routes (default DEFAULT_TTL), if None
+                           they do not expire.
+            negative_ttl:  Float. Time-to-live of the failures, if None it is the same as ttl.
+        """
+        self._traci_handler = traci_handler
+        self._clock = clock
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._entries = collections.OrderedDict()
+        self._stats = collections.Counter()
+
+    def find_route(self, from_edge, to_edge, vtype='passenger', max_age=None):
+        """ Return the route (as simulation.findRoute) or None if there is no route.
+
+            max_age: Float. If set, the entries older than max_age are computed again, even if
+                     their time-to-live is not over.
+        """
+        key = (from_edge, to_edge, vtype)
+        now = self._clock()
+        entry = self._entries.get(key)
+        if entry is not None:
+            route, timestamp = entry
+            ttl = self._ttl if route is not None else self._negative_ttl
+            age = now - timestamp
+            if (ttl is None or age <= ttl) and (max_age is None or age <= max_age):
+                self._entries.move_to_end(key)
+                self._stats['hits' if route is not None else 'negative_hits'] += 1
+                return route
+            self._stats['expired'] += 1
+
+        self._stats['misses'] += 1
+        try:
+            route = self._traci_handler.simulation.findRoute(from_edge, to_edge, vType=vtype)
+        except exceptions.TraCIException:
+            route = None
+        if route is not None and not route.edges:
+            route = None
+        self._entries[key] = (route, now)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+        return route
+
+    def clear(self):
+        """ Drop all the entries (the statistics are kept). """
+        self._entries.clear()
+
+    def stats(self):
+        """ Return the statistics of the cache as a dict: 'size', 'hits', 'negative_hits',
+            'misses' (router calls), 'expired' and 'evictions'. """
+        stats = {key: self._stats[key]
+                 for key in ('hits', 'negative_hits', 'misses', 'expired', 'evictions')}
+        stats['size'] = len(self._entries)
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,240 @@
+""" Compact occupancy time series for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+import collections.abc
+import os
+import shutil
+import tempfile
+
+import numpy
+
+## Initial capacity of the current chunk, doubled up to the chunk size when full
+_INITIAL_CAPACITY = 16
+
+_AGGREGATES = {
+    'last': lambda current, value: value,
+    'min': min,
+    'max': max,
+}
+
+class OccupancySeries(collections.abc.Sequence):
+    """ Sequence of (occupancy, time) samples stored in fixed-size NumPy chunks.
+
+        The samples are appended to the current chunk, that is sealed when full (it starts
+        small and grows geometrically up to the chunk size, so that a series with a few
+        samples does not allocate a whole chunk). With
+        'retention', the samples older than 'retention' seconds (with respect to the last one)
+        are dropped. With 'window', all the samples in the same window of 'window' seconds are
+        merged in a single one using 'aggregate' ('last', 'min' or 'max') on the occupancy,
+        with the time of the last sample. With 'spill_dir', only the most recent
+        'chunks_in_memory' sealed chunks are kept in memory, the older ones are saved in
+        'spill_dir' and read back (memory-mapped) only when accessed. The files are written in
+        a subdirectory of 'spill_dir' private to the series, removed by close().
+    """
+
+    def __init__(self, samples=(), chunk_size=1024, retention=None, window=None,
+                 aggregate='last', spill_dir=None, chunks_in_memory=None, name='series'):
+        """ Initialize the series with the given (occupancy, time) samples. """
+        if aggregate not in _AGGREGATES:
+            raise ValueError('Unknown aggregate "{}".'.format(aggregate))
+        if spill_dir and not chunks_in_memory:
+            raise ValueError('Spilling to disk requires "chunks_in_memory".')
+
+        self._chunk_size = chunk_size
+        self._retention = retention
+        self._window = window
+        self._aggregate_name = aggregate
+        self._aggregate = _AGGREGATES[aggregate]
+        self._spill_dir = spill_dir
+        self._chunks_in_memory = chunks_in_memory
+        self._name = name
+
+        ## sealed chunks: (occupancy, time) arrays or (filename, size, last time) once spilled
+        self._chunks = collections.deque()
+        self._spilled = 0
+        self._counter = 0
+        self._directory = None
+        self._head_time = None # times of the first chunk, if spilled, for the retention
+        self._offset = 0 # samples dropped from the first chunk
+        self._occupancy = numpy.zeros(min(_INITIAL_CAPACITY, chunk_size), dtype=numpy.int32)
+        self._time = numpy.zeros(min(_INITIAL_CAPACITY, chunk_size), dtype=numpy.float64)
+        self._size = 0
+        self._length = 0
+
+        for sample in samples:
+            self.append(sample)
+
+    ## ======================================    CHUNKS    ====================================== ##
+
+    def _get_chunk(self, pos):
+        """ Return the (occupancy, time) arrays of the sealed chunk. """
+        chunk = self._chunks[pos]
+        if isinstance(chunk[0], str):
+            data = numpy.load(chunk[0], mmap_mode='r')
+            return data[0].astype(numpy.int32), data[1]
+        return chunk
+
+    def _iter_chunks(self):
+        """ Yield the (occupancy, time) arrays of all the chunks, without the dropped samples. """
+        offset = self._offset
+        for pos in range(len(self._chunks)):
+            occupancy, time = self._get_chunk(pos)
+            yield occupancy[offset:], time[offset:]
+            offset = 0
+        yield self._occupancy[offset:self._size], self._time[offset:self._size]
+
+    def _grow(self):
+        """ Double the capacity of the current chunk, up to the chunk size. """
+        capacity = min(2 * len(self._time), self._chunk_size)
+        occupancy = numpy.zeros(capacity, dtype=numpy.int32)
+        time = numpy.zeros(capacity, dtype=numpy.float64)
+        occupancy[:self._size] = self._occupancy[:self._size]
+        time[:self._size] = self._time[:self._size]
+        self._occupancy, self._time = occupancy, time
+
+    def _seal(self):
+        """ Move the current chunk to the sealed ones and spill the old ones if required. """
+        self._chunks.append((self._occupancy, self._time))
+        self._occupancy = numpy.zeros(min(_INITIAL_CAPACITY, self._chunk_size),
+                                      dtype=numpy.int32)
+        self._time = numpy.zeros(min(_INITIAL_CAPACITY, self._chunk_size), dtype=numpy.float64)
+        self._size = 0
+
+        if not self._spill_dir:
+            return
+        while len(self._chunks) - self._spilled > self._chunks_in_memory:
+            if self._directory is None:
+                self._directory = tempfile.mkdtemp(prefix='{}.'.format(self._name),
+                                                   dir=self._spill_dir)
+            occupancy, time = self._chunks[self._spilled]
+            filename = os.path.join(self._directory, '{}.npy'.format(self._counter))
+            self._counter += 1
+            numpy.save(filename, numpy.vstack((occupancy.astype(numpy.float64), time)))
+            self._chunks[self._spilled] = (filename, len(time), float(time[-1]))
+            self._spilled += 1
+
+    def _drop_chunk(self):
+        """ Remove the oldest sealed chunk. """
+        chunk = self._chunks.popleft()
+        if isinstance(chunk[0], str):
+            os.remove(chunk[0])
+            self._spilled -= 1
+        self._head_time = None
+        self._length -= self._chunk_size - self._offset
+        self._offset = 0
+
+    def _get_last_time(self, pos):
+        """ Return the time of the last sample of the sealed chunk, without loading it. """
+        chunk = self._chunks[pos]
+        if isinstance(chunk[0], str):
+            return chunk[2]
+        return chunk[1][-1]
+
+    def _apply_retention(self, now):
+        """ Drop the samples older than the retention. """
+        limit = now - self._retention
+        while self._chunks:
+            if self._get_last_time(0) >= limit:
+                break
+            self._drop_chunk()
+        if self._chunks:
+            if isinstance(self._chunks[0][0], str):
+                ## loaded once, until the chunk is dropped
+                if self._head_time is None:
+                    self._head_time = numpy.array(self._get_chunk(0)[1])
+                time = self._head_time
+            else:
+                time = self._chunks[0][1]
+        else:
+            time = self._time[:self._size]
+        offset = max(int(numpy.searchsorted(time, limit, side='left')), self._offset)
+        self._length -= offset - self._offset
+        self._offset = offset
+
+    ## ======================================    SERIES    ====================================== ##
+
+    def append(self, sample):
+        """ Add the (occupancy, time) sample. """
+        occupancy, time = sample
+        last = self._size - 1
+        if (self._window and self._length and
+                time // self._window == self._time[last] // self._window):
+            ## same window, merge with the last sample (always in the current chunk)
+            self._occupancy[last] = self._aggregate(int(self._occupancy[last]), occupancy)
+            self._time[last] = time
+        else:
+            if self._size == self._chunk_size:
+                self._seal()
+            elif self._size == len(self._time):
+                self._grow()
+            self._occupancy[self._size] = occupancy
+            self._time[self._size] = time
+            self._size += 1
+            self._length += 1
+
+        if self._retention is not None:
+            self._apply_retention(time)
+
+    def close(self):
+        """ Remove the spilled chunks, with their directory. The series keeps only the samples
+            in memory. """
+        while self._spilled:
+            self._chunks.popleft()
+            self._spilled -= 1
+            self._length -= self._chunk_size - self._offset
+            self._offset = 0
+        self._head_time = None
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def to_arrays(self):
+        """ Return the (occupancy, time) samples as two NumPy arrays. """
+        occupancy, time = zip(*self._iter_chunks())
+        return numpy.concatenate(occupancy), numpy.concatenate(time)
+
+    def __deepcopy__(self, memo):
+        """ Return an in-memory copy, independent from the spilled chunks. """
+        return OccupancySeries(self, chunk_size=self._chunk_size, retention=self._retention,
+                               window=self._window, aggregate=self._aggregate_name,
+                               name=self._name)
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        for occupancy, time in self._iter_chunks():
+            yield from zip(occupancy.tolist(), time.tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError('OccupancySeries index out of range')
+        for occupancy, time in self._iter_chunks():
+            if index < len(time):
+                return int(occupancy[index]), float(time[index])
+            index -= len(time)
+        raise IndexError('OccupancySeries index out of range')
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Sequence):
+            return len(self) == len(other) and all(
+                tuple(mine) == tuple(theirs) for mine, theirs in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'OccupancySeries({!r})'.format(list(self))
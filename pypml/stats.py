@@ -0,0 +1,155 @@
+""" Step instrumentation for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import os
+
+import numpy
+
+## Per-step metrics, in the order of the StepStats columns
+METRICS = ('step_time', 'monitor_vehicles_time', 'update_vehicles_db_time',
+           'update_parking_db_time', 'validation_time', 'traci_calls', 'traci_bytes_sent',
+           'traci_bytes_received', 'vehicles', 'passengers', 'parkings', 'archived_vehicles')
+
+PERCENTILES = (50, 90, 99)
+
+## TraCI domains wrapped by the handler proxies
+TRACI_DOMAINS = ('simulation', 'vehicle', 'parkingarea', 'person', 'edge', 'lane', 'route',
+                 'vehicletype', 'poi', 'polygon', 'junction', 'trafficlight')
+
+class CountingTraCI():
+    """ Proxy of a TraCI handler (traci, a TraCI connection or libsumo) counting the calls.
+
+        If the handler uses a TraCI socket, the bytes sent and received on the socket are
+        counted as well, for all the commands (simulation steps included).
+    """
+
+    def __init__(self, handler):
+        """ Wrap the given handler. """
+        self._handler = handler
+        self._domains = dict()
+        self._functions = dict()
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        connection = handler
+        if hasattr(handler, 'getConnection'):
+            try:
+                connection = handler.getConnection()
+            except Exception: # pylint: disable=broad-except
+                connection = None
+        if connection is not None and hasattr(connection, '_sendExact'):
+            self._wrap_socket(connection)
+
+    def _wrap_socket(self, connection):
+        """ Count the bytes exchanged by the connection. """
+        send_exact = connection._sendExact
+
+        def _counting_send_exact():
+            self.bytes_sent += len(connection._string) + 4
+            result = send_exact()
+            self.bytes_received += len(result._content) + 4
+            return result
+
+        connection._sendExact = _counting_send_exact
+
+    def _counting(self, function):
+        """ Return the function counting its calls. """
+        def _counting_call(*args, **kwargs):
+            self.calls += 1
+            return function(*args, **kwargs)
+        return _counting_call
+
+    def __getattr__(self, name):
+        if name in self._domains:
+            return self._domains[name]
+        if name in self._functions:
+            return self._functions[name]
+        value = getattr(self._handler, name)
+        if name in TRACI_DOMAINS:
+            self._domains[name] = _CountingDomain(value, self)
+            return self._domains[name]
+        if callable(value) and not isinstance(value, type):
+            self._functions[name] = self._counting(value)
+            return self._functions[name]
+        return value
+
+class _CountingDomain():
+    """ Proxy of a TraCI domain counting the calls in the CountingTraCI. """
+
+    def __init__(self, domain, counter):
+        self._domain = domain
+        self._counter = counter
+        self._functions = dict()
+
+    def __getattr__(self, name):
+        if name not in self._functions:
+            value = getattr(self._domain, name)
+            if not callable(value):
+                return value
+            self._functions[name] = self._counter._counting(value)
+        return self._functions[name]
+
+class StepStats():
+    """ Rolling window of the per-step metrics (METRICS), in a NumPy ring buffer. """
+
+    def __init__(self, window=1000):
+        """ Allocate the buffer for the last 'window' steps. """
+        self._values = numpy.zeros((window, len(METRICS)), dtype=numpy.float64)
+        self._window = window
+        self._pos = 0
+        self.steps = 0
+        self.last = None
+
+    def add(self, sample):
+        """ Add the metrics of a step, given as { metric: value }. """
+        row = self._values[self._pos]
+        for col, metric in enumerate(METRICS):
+            row[col] = sample.get(metric, 0)
+        self._pos = (self._pos + 1) % self._window
+        self.steps += 1
+        self.last = dict(sample)
+
+    def summary(self):
+        """ Return the statistics of the window as a dict:
+            {
+                'steps': total number of steps,
+                'window': number of steps in the window,
+                'last': { metric: value } of the last step,
+                'mean', 'max', 'p50', 'p90', 'p99': { metric: value } over the window,
+            }
+        """
+        size = min(self.steps, self._window)
+        summary = {'steps': self.steps, 'window': size, 'last': self.last}
+        if not size:
+            return summary
+        values = self._values[:size]
+        summary['mean'] = dict(zip(METRICS, values.mean(axis=0).tolist()))
+        summary['max'] = dict(zip(METRICS, values.max(axis=0).tolist()))
+        percentiles = numpy.percentile(values, PERCENTILES, axis=0)
+        for percentile, row in zip(PERCENTILES, percentiles.tolist()):
+            summary['p{}'.format(percentile)] = dict(zip(METRICS, row))
+        return summary
+
+def dump_metrics(filename, summary):
+    """ Atomically write the summary in a text file, one 'pypml_<metric>{stat="..."} value'
+        line for each metric and statistic. """
+    lines = ['pypml_steps {}'.format(summary['steps'])]
+    for stat in ('last', 'mean', 'max') + tuple('p{}'.format(p) for p in PERCENTILES):
+        if not summary.get(stat):
+            continue
+        for metric in METRICS:
+            lines.append('pypml_{}{{stat="{}"}} {}'.format(
+                metric, stat, summary[stat].get(metric, 0)))
+    tmp_file = '{}.tmp'.format(filename)
+    with open(tmp_file, 'w') as fwrite:
+        fwrite.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, filename)
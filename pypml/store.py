@@ -0,0 +1,190 @@
+""" Columnar parking state for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import numpy
+
+OCCUPANCY = 0
+PROJECTIONS = 1
+SUBSCRIBED = 2
+
+class ParkingStore():
+    """ Parking state held in NumPy arrays indexed by a dense integer index.
+
+        Rows are parking areas and columns are vClasses, in the order of 'parkings' and
+        'vclasses'. The arrays are counters kept in sync by the ParkingMonitor with its own
+        databases, that remain the reference for the vehicle IDs. In order to reproduce the set
+        unions of ParkingMonitor.get_free_places, the sizes of the unions between occupancy (O),
+        projections (P) and subscribed vehicles (S) are maintained as well.
+
+        The free places are cached by parking (and for the bulk query) and every change to a row
+        invalidates only the cache of that parking, marking it as dirty. The uncertainty error
+        is not part of the cache, it must be added to the results by the caller.
+    """
+
+    def __init__(self, parkings, vclasses):
+        """ Allocate the arrays for the given parking IDs and vClasses. """
+        self.parkings = tuple(parkings)
+        self.index = {pid: row for row, pid in enumerate(self.parkings)}
+        self.vclasses = tuple(sorted(vclasses))
+        self.vclass_index = {vclass: col for col, vclass in enumerate(self.vclasses)}
+
+        shape = (len(self.parkings), len(self.vclasses))
+        self.total_capacity = numpy.zeros(len(self.parkings), dtype=numpy.int64)
+        self.total_occupancy = numpy.zeros(len(self.parkings), dtype=numpy.int64)
+        self.mu = numpy.zeros(len(self.parkings), dtype=numpy.float64)
+        self.sigma = numpy.zeros(len(self.parkings), dtype=numpy.float64)
+
+        self.with_capacity = numpy.zeros(len(self.parkings), dtype=bool)
+        self.capacity = numpy.zeros(shape, dtype=numpy.int64)
+        self.with_subscriptions = numpy.zeros(len(self.parkings), dtype=bool)
+        self.subscriptions = numpy.zeros(shape, dtype=numpy.int64)
+
+        ## |O|, |P|, |S|
+        self.counts = numpy.zeros((3,) + shape, dtype=numpy.int64)
+        ## |O u P|, |O u S|, |O u P u S|
+        self.occupancy_projections = numpy.zeros(shape, dtype=numpy.int64)
+        self.occupancy_subscribed = numpy.zeros(shape, dtype=numpy.int64)
+        self.occupancy_all = numpy.zeros(shape, dtype=numpy.int64)
+
+        ## Availability cache
+        self.dirty = set()
+        self._cache = [dict() for _ in self.parkings]
+        self._bulk_cache = dict()
+
+    def _invalidate(self, row):
+        """ Drop the cached free places of the parking and mark it as dirty. """
+        self.dirty.add(self.parkings[row])
+        self._cache[row].clear()
+        self._bulk_cache.clear()
+
+    def clear_dirty(self):
+        """ Forget the parkings changed so far. """
+        self.dirty.clear()
+
+    def set_total_occupancy(self, pid, occupancy):
+        """ Set the total occupancy (as retrieved from SUMO) of the given parking. """
+        row = self.index[pid]
+        self.total_occupancy[row] = occupancy
+        self._invalidate(row)
+
+    def load(self, pid, parking):
+        """ Reload the row of the given parking from its ParkingMonitor dictionary. """
+        row = self.index[pid]
+        self._invalidate(row)
+        self.total_capacity[row] = parking['total_capacity']
+        self.total_occupancy[row] = parking['total_occupancy']
+        self.mu[row] = parking['uncertainty']['mu']
+        self.sigma[row] = parking['uncertainty']['sigma']
+
+        self.with_capacity[row] = bool(parking['capacity_by_class'])
+        self.with_subscriptions[row] = bool(parking['subscriptions_by_class'])
+        self.capacity[row] = 0
+        self.subscriptions[row] = 0
+        for vclass, col in self.vclass_index.items():
+            self.capacity[row, col] = parking['capacity_by_class'].get(vclass, 0)
+            occupancy = parking['occupancy_by_class'].get(vclass, set())
+            projections = parking['projections_by_class'].get(vclass, set())
+            subscribed = set()
+            if vclass in parking['subscriptions_by_class']:
+                num, subscribed = parking['subscriptions_by_class'][vclass]
+                self.subscriptions[row, col] = num
+            self.counts[OCCUPANCY, row, col] = len(occupancy)
+            self.counts[PROJECTIONS, row, col] = len(projections)
+            self.counts[SUBSCRIBED, row, col] = len(subscribed)
+            self.occupancy_projections[row, col] = len(occupancy | projections)
+            self.occupancy_subscribed[row, col] = len(occupancy | subscribed)
+            self.occupancy_all[row, col] = len(occupancy | projections | subscribed)
+
+    def update(self, pid, vclass, kind, delta, memberships):
+        """ Account for a vehicle added (delta=1) or removed (delta=-1) from one of the sets.
+
+            kind:        OCCUPANCY, PROJECTIONS or SUBSCRIBED.
+            memberships: Tuple of three booleans, the membership of the vehicle to the
+                         (occupancy, projections, subscribed) sets, 'kind' excluded.
+        """
+        row = self.index[pid]
+        col = self.vclass_index[vclass]
+        self._invalidate(row)
+        self.counts[kind, row, col] += delta
+        in_occupancy, in_projections, in_subscribed = memberships
+        if kind != SUBSCRIBED and not (in_projections if kind == OCCUPANCY else in_occupancy):
+            self.occupancy_projections[row, col] += delta
+        if kind != PROJECTIONS and not (in_subscribed if kind == OCCUPANCY else in_occupancy):
+            self.occupancy_subscribed[row, col] += delta
+        others = [in_occupancy, in_projections, in_subscribed]
+        del others[kind]
+        if not any(others):
+            self.occupancy_all[row, col] += delta
+
+    def _union(self, with_projections, with_subscriptions):
+        """ Return the array of the sizes of the unions required by the query. """
+        if with_projections and with_subscriptions:
+            return self.occupancy_all
+        if with_projections:
+            return self.occupancy_projections
+        if with_subscriptions:
+            return self.occupancy_subscribed
+        return self.counts[OCCUPANCY]
+
+    def free_places_row(self, row, with_projections=False, with_subscriptions=False):
+        """ Return the free places of a single parking, without uncertainty.
+
+            If the parking has a capacity by class, the result is a tuple indexed by vClass,
+            otherwise it is the total number of free places.
+        """
+        try:
+            return self._cache[row][(with_projections, with_subscriptions)]
+        except KeyError:
+            pass
+
+        if self.with_capacity[row]:
+            free = (self.capacity[row] -
+                    self._union(with_projections, with_subscriptions)[row])
+            if with_subscriptions and self.with_subscriptions[row]:
+                free = free - (self.subscriptions[row] - self.counts[SUBSCRIBED, row])
+            free = tuple(free.tolist())
+        else:
+            free = self.total_capacity[row] - self.total_occupancy[row]
+            if with_projections:
+                free -= self.counts[PROJECTIONS, row].sum()
+            if with_subscriptions:
+                free -= self.subscriptions[row].sum()
+            free = int(free)
+
+        self._cache[row][(with_projections, with_subscriptions)] = free
+        return free
+
+    def free_places(self, with_projections=False, with_subscriptions=False):
+        """ Return the free places of all the parkings as an array (parkings x vClasses),
+            without uncertainty. The array is shared with the cache and must not be modified.
+
+            For the parkings without capacity by class, all the columns hold the total number
+            of free places.
+        """
+        try:
+            return self._bulk_cache[(with_projections, with_subscriptions)]
+        except KeyError:
+            pass
+
+        by_class = self.capacity - self._union(with_projections, with_subscriptions)
+        if with_subscriptions:
+            by_class -= numpy.where(self.with_subscriptions[:, None],
+                                    self.subscriptions - self.counts[SUBSCRIBED], 0)
+
+        total = self.total_capacity - self.total_occupancy
+        if with_projections:
+            total -= self.counts[PROJECTIONS].sum(axis=1)
+        if with_subscriptions:
+            total -= self.subscriptions.sum(axis=1)
+
+        free = numpy.where(self.with_capacity[:, None], by_class, total[:, None])
+        self._bulk_cache[(with_projections, with_subscriptions)] = free
+        return free
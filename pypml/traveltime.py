@@ -0,0 +1,508 @@
+""" Parking travel time computation for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections
+import collections.abc
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import timeit
+
+import numpy
+
+from .backend import exceptions, get_backend
+
+## Bump it when the on-disk format changes.
+_CACHE_VERSION = 2
+
+def get_parking_access_points(parking_db):
+    """ Return the list of (parking id, edge, end position) for all the parkings. """
+    parkings = []
+    for parking in parking_db.values():
+        pid = parking['sumo']['id']
+        edge = parking['sumo']['lane'].split('_')[0]
+        end_pos = float(parking['sumo']['endPos'])
+        parkings.append((pid, edge, end_pos))
+    return parkings
+
+def compute_travel_time_rows(traci_handler, origins, parkings, blacklist, vtype='passenger',
+                             route_cache=None, route_edges=None):
+    """ Compute the travel time from each origin to all the parkings.
+
+        Returns a dict { from_pid: [(cost, to_pid), ...] } with unsorted rows. The pairs of edges
+        without a route are added to blacklist ({ from_edge: [to_edge, ...] }) and skipped,
+        with route_cache also the ones with an empty route.
+
+        traci_handler: TraCI connection (or libsumo) used for simulation.findRoute.
+        origins:       List of (parking id, edge, end position), as get_parking_access_points.
+        parkings:      List of (parking id, edge, end position), as get_parking_access_points.
+        blacklist:     collections.defaultdict(list) of the edges pairs without a route.
+        vtype:         String. vType used for the routing.
+        route_cache:   RouteCache. If set, the routes are requested to the cache, reusing only
+                       the ones computed at the current time.
+        route_edges:   collections.defaultdict(set). If set, the edges of the routes of each
+                       origin are added to route_edges[from_pid].
+    """
+    rows = collections.defaultdict(list)
+    for from_pid, from_edge, from_end_pos in origins:
+        if route_edges is not None:
+            ## known, even if empty
+            route_edges.setdefault(from_pid, set())
+        for to_pid, to_edge, to_end_pos in parkings:
+            if from_pid == to_pid:
+                continue
+            if from_edge == to_edge and to_end_pos <= from_end_pos:
+                ## parking not reachable
+                continue
+            if to_edge in blacklist[from_edge]:
+                ##  route not available
+                continue
+
+            route = None
+            if route_cache is not None:
+                route = route_cache.find_route(from_edge, to_edge, vtype, max_age=0)
+                if route is None:
+                    blacklist[from_edge].append(to_edge)
+            else:
+                try:
+                    route = traci_handler.simulation.findRoute(from_edge, to_edge, vType=vtype)
+                except exceptions.TraCIException:
+                    route = None
+                    blacklist[from_edge].append(to_edge)
+
+            cost = None
+            if route and route.edges:
+                cost = route.travelTime
+                if route_edges is not None:
+                    route_edges[from_pid].update(route.edges)
+
+            if cost:
+                rows[from_pid].append((cost, to_pid))
+    return rows
+
+def _travel_time_worker(arguments):
+    """ Compute a set of travel time rows with a dedicated SUMO instance. """
+    backend, origins, parkings, blacklist, vtype = arguments
+
+    backend = dict(backend)
+    traci_handler = get_backend(backend.pop('name'), **backend)
+    route_edges = collections.defaultdict(set)
+    try:
+        rows = compute_travel_time_rows(traci_handler, origins, parkings, blacklist, vtype,
+                                        route_edges=route_edges)
+    finally:
+        traci_handler.close()
+
+    return dict(rows), dict(blacklist), dict(route_edges)
+
+def compute_travel_time_rows_parallel(sumo_cmd, processes, parkings, blacklist,
+                                      vtype='passenger', use_libsumo=False, route_edges=None,
+                                      backend=None):
+    """ Compute the travel time between all the parkings using a pool of processes.
+
+        Each worker runs its own SUMO instance started with sumo_cmd and computes a subset of
+        the origin rows. The origins are grouped by edge, so that all the routing failures
+        relevant to an origin are found by the same worker, and the blacklists returned by the
+        workers are merged into blacklist. The workers are spawned, not forked, since the
+        parent may have a TraCI connection or libsumo open.
+
+        Returns a dict { from_pid: [(cost, to_pid), ...] } with unsorted rows.
+
+        sumo_cmd:    List of strings. SUMO command line used by every worker.
+        processes:   Int. Number of worker processes.
+        parkings:    List of (parking id, edge, end position), as get_parking_access_points.
+        blacklist:   collections.defaultdict(list) of the edges pairs without a route.
+        vtype:       String. vType used for the routing.
+        use_libsumo: Boolean. If True, the workers use libsumo instead of TraCI.
+        route_edges: collections.defaultdict(set). If set, the edges of the routes of each
+                     origin are added to route_edges[from_pid].
+        backend:     Dictionary. If set, backend of the workers, as the 'backend' option of
+                     the ParkingMonitor (e.g. {'name': 'fake', ...}), instead of sumo_cmd and
+                     use_libsumo. Only the built-in backends are available in the workers.
+    """
+    by_edge = collections.defaultdict(list)
+    for parking in parkings:
+        by_edge[parking[1]].append(parking)
+
+    chunks = [list() for _ in range(processes)]
+    for pos, edge in enumerate(sorted(by_edge, key=lambda edge: -len(by_edge[edge]))):
+        chunks[pos % processes].extend(by_edge[edge])
+
+    tasks = []
+    for pos, origins in enumerate(chunks):
+        if not origins:
+            continue
+        _blacklist = {edge: list(blacklist[edge]) for edge in {origin[1] for origin in origins}
+                      if edge in blacklist}
+        if backend is not None:
+            _backend = backend
+        elif use_libsumo:
+            _backend = {'name': 'libsumo', 'sumo_cmd': sumo_cmd}
+        else:
+            _backend = {'name': 'traci', 'sumo_cmd': sumo_cmd,
+                        'label': 'pypml_travel_time_{}'.format(pos)}
+        tasks.append((_backend, origins, parkings, collections.defaultdict(list, _blacklist),
+                      vtype))
+
+    rows = dict()
+    if not tasks:
+        return rows
+    with multiprocessing.get_context('spawn').Pool(processes=len(tasks)) as pool:
+        for _rows, _blacklist, _route_edges in pool.map(_travel_time_worker, tasks):
+            rows.update(_rows)
+            if route_edges is not None:
+                for from_pid, edges in _route_edges.items():
+                    route_edges[from_pid].update(edges)
+            for from_edge, to_edges in _blacklist.items():
+                for to_edge in to_edges:
+                    if to_edge not in blacklist[from_edge]:
+                        blacklist[from_edge].append(to_edge)
+    return rows
+
+class TravelTimeMatrix(collections.abc.Mapping):
+    """ Sorted travel time rows between parkings, stored in compressed sparse rows.
+
+        The row of the parking at index i is given by costs[offsets[i]:offsets[i+1]] and by
+        the destinations targets[offsets[i]:offsets[i+1]], as indexes in 'parkings'. As a
+        mapping, it behaves like { from_pid: [(cost, to_pid), ...] } for the parkings with at
+        least one destination, and the rows are built (and kept) only when requested.
+    """
+
+    def __init__(self, parkings, offsets, targets, costs):
+        """ Wrap the given arrays (possibly memory-mapped). """
+        self.parkings = tuple(parkings)
+        self.index = {pid: pos for pos, pid in enumerate(self.parkings)}
+        self.offsets = offsets
+        self.targets = targets
+        self.costs = costs
+        self._rows = dict()
+
+    @classmethod
+    def from_rows(cls, parkings, rows):
+        """ Build the matrix from { from_pid: [(cost, to_pid), ...] }. """
+        parkings = tuple(parkings)
+        index = {pid: pos for pos, pid in enumerate(parkings)}
+        offsets = numpy.zeros(len(parkings) + 1, dtype=numpy.int64)
+        targets = []
+        costs = []
+        for pos, pid in enumerate(parkings):
+            for cost, to_pid in sorted(rows.get(pid, [])):
+                costs.append(cost)
+                targets.append(index[to_pid])
+            offsets[pos + 1] = len(costs)
+        return cls(parkings, offsets, numpy.array(targets, dtype=numpy.int32),
+                   numpy.array(costs, dtype=numpy.float64))
+
+    @classmethod
+    def load(cls, directory):
+        """ Load (memory-mapped) a matrix saved with save(). """
+        with open(os.path.join(directory, 'parkings.json')) as fread:
+            parkings = json.load(fread)
+        return cls(parkings,
+                   numpy.load(os.path.join(directory, 'offsets.npy'), mmap_mode='r'),
+                   numpy.load(os.path.join(directory, 'targets.npy'), mmap_mode='r'),
+                   numpy.load(os.path.join(directory, 'costs.npy'), mmap_mode='r'))
+
+    def save(self, directory):
+        """ Save the matrix in the given (existing) directory. """
+        with open(os.path.join(directory, 'parkings.json'), 'w') as fwrite:
+            json.dump(self.parkings, fwrite)
+        numpy.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        numpy.save(os.path.join(directory, 'targets.npy'), self.targets)
+        numpy.save(os.path.join(directory, 'costs.npy'), self.costs)
+
+    def replace_rows(self, rows):
+        """ Return a new matrix with the rows given as { from_pid: [(cost, to_pid), ...] },
+            and the other rows copied from this one, that is not modified. """
+        offsets = numpy.zeros(len(self.parkings) + 1, dtype=numpy.int64)
+        targets = []
+        costs = []
+        for pos, pid in enumerate(self.parkings):
+            if pid in rows:
+                row = sorted(rows[pid])
+                costs.append(numpy.array([cost for cost, _ in row], dtype=numpy.float64))
+                targets.append(numpy.array([self.index[to_pid] for _, to_pid in row],
+                                           dtype=numpy.int32))
+            else:
+                start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+                costs.append(self.costs[start:end])
+                targets.append(self.targets[start:end])
+            offsets[pos + 1] = offsets[pos] + len(costs[-1])
+        return TravelTimeMatrix(self.parkings, offsets,
+                                numpy.concatenate(targets).astype(numpy.int32, copy=False),
+                                numpy.concatenate(costs).astype(numpy.float64, copy=False))
+
+    def get_row_arrays(self, pid):
+        """ Return the (costs, targets) arrays of the row of the given parking, sorted by cost.
+            They are views on the matrix and must not be modified. """
+        pos = self.index[pid]
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        return self.costs[start:end], self.targets[start:end]
+
+    def __getitem__(self, pid):
+        if pid in self._rows:
+            return self._rows[pid]
+        pos = self.index[pid]
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        if start == end:
+            raise KeyError(pid)
+        row = [(cost, self.parkings[target]) for cost, target in
+               zip(self.costs[start:end].tolist(), self.targets[start:end].tolist())]
+        self._rows[pid] = row
+        return row
+
+    def __contains__(self, pid):
+        pos = self.index.get(pid)
+        return pos is not None and self.offsets[pos] != self.offsets[pos + 1]
+
+    def __iter__(self):
+        for pos, pid in enumerate(self.parkings):
+            if self.offsets[pos] != self.offsets[pos + 1]:
+                yield pid
+
+    def __len__(self):
+        return int(numpy.count_nonzero(numpy.diff(self.offsets)))
+
+    def __bool__(self):
+        ## O(1), without counting the rows
+        return bool(self.offsets[-1])
+
+class TravelTimeRefresher():
+    """ Incremental refresh of a TravelTimeMatrix following the traffic.
+
+        Every 'period' seconds a refresh cycle samples the travel time (edge.getTraveltime) of
+        the edges used by the routes of the matrix. The origin rows with at least an edge whose
+        travel time changed by more than 'threshold' (relative to the last sample) are computed
+        again and, when all of them are done, a new matrix is published. The work is spread
+        over the calls of step(), each one running for about 'budget' seconds, and the
+        published matrix is never modified. The edges of the rows whose routes are unknown
+        (e.g. a matrix saved by an older version) are found in the background, with a lower
+        priority than the changed rows and without delaying the publication of the matrix.
+    """
+
+    def __init__(self, traci_handler, matrix, parkings, blacklist, vtype='passenger',
+                 route_cache=None, route_edges=None, period=300.0, threshold=0.2,
+                 budget=0.005):
+        """ Prepare the refresh of the matrix.
+
+            traci_handler: TraCI connection (or libsumo).
+            matrix:        TravelTimeMatrix. Current version of the matrix.
+            parkings:      List of (parking id, edge, end position), as get_parking_access_points,
+                           the same used to compute the matrix.
+            blacklist:     collections.defaultdict(list) of the edges pairs without a route.
+            vtype:         String. vType used for the routing.
+            route_cache:   RouteCache used for the routing, if any.
+            route_edges:   Dictionary. { from_pid: set of the edges of its routes }, if known.
+            period:        Float. Seconds between the beginning of two refresh cycles.
+            threshold:     Float. Relative change of the travel time of an edge that triggers
+                           the computation of the rows using it.
+            budget:        Float. Seconds of work for each call of step(), at least one edge
+                           sample or one row is processed.
+        """
+        self._traci_handler = traci_handler
+        self._parkings = parkings
+        self._origins = {parking[0]: parking for parking in parkings}
+        self._blacklist = blacklist
+        self._vtype = vtype
+        self._route_cache = route_cache
+        self._period = period
+        self._threshold = threshold
+        self._budget = budget
+
+        self.matrix = matrix
+        self.version = 0
+        self._edge_rows = collections.defaultdict(set)
+        self._baseline = dict()
+        self._cycle = None
+        self._samples = collections.deque()
+        self._dirty = collections.OrderedDict()
+        self._unseeded = collections.deque()
+        self._rows = dict()
+        self._stats = collections.Counter()
+
+        route_edges = route_edges or dict()
+        for pid in self._origins:
+            if pid in route_edges:
+                self._set_row_edges(pid, route_edges[pid])
+            else:
+                self._unseeded.append(pid)
+
+    def _set_row_edges(self, pid, edges):
+        """ Map the edges to the row using them, the new edges are sampled for reference. """
+        for edge in edges:
+            if edge not in self._edge_rows:
+                self._samples.append(edge)
+            self._edge_rows[edge].add(pid)
+
+    def _sample(self, edge):
+        """ Sample the travel time of the edge, marking its rows as dirty if it changed. """
+        travel_time = self._traci_handler.edge.getTraveltime(edge)
+        self._stats['sampled_edges'] += 1
+        baseline = self._baseline.get(edge)
+        if baseline is None:
+            self._baseline[edge] = travel_time
+            return
+        if abs(travel_time - baseline) > self._threshold * max(baseline, 1e-9):
+            self._baseline[edge] = travel_time
+            self._stats['changed_edges'] += 1
+            for pid in self._edge_rows[edge]:
+                self._dirty[pid] = True
+
+    def _compute_row(self, pid):
+        """ Compute again the row of the parking. """
+        route_edges = collections.defaultdict(set)
+        rows = compute_travel_time_rows(self._traci_handler, [self._origins[pid]],
+                                        self._parkings, self._blacklist, self._vtype,
+                                        route_cache=self._route_cache, route_edges=route_edges)
+        self._rows[pid] = rows.get(pid, [])
+        self._set_row_edges(pid, route_edges[pid])
+        self._stats['computed_rows'] += 1
+
+    def _seed_row(self, pid):
+        """ Find the edges of the routes of the row, without changing the row. """
+        route_edges = collections.defaultdict(set)
+        compute_travel_time_rows(self._traci_handler, [self._origins[pid]], self._parkings,
+                                 self._blacklist, self._vtype, route_cache=self._route_cache,
+                                 route_edges=route_edges)
+        self._set_row_edges(pid, route_edges[pid])
+        self._stats['seeded_rows'] += 1
+
+    def step(self, now):
+        """ Work on the refresh for about 'budget' seconds. Return the new matrix when it is
+            published, None otherwise.
+
+            now: Float. Current simulation time.
+        """
+        idle = not self._samples and not self._dirty and not self._rows
+        if self._cycle is None or (idle and now - self._cycle >= self._period):
+            self._cycle = now
+            self._stats['cycles'] += 1
+            if idle:
+                self._samples.extend(self._edge_rows)
+        elif idle and not self._unseeded:
+            return None
+
+        start = timeit.default_timer()
+        while self._samples or self._dirty or self._unseeded:
+            if self._samples:
+                self._sample(self._samples.popleft())
+            elif self._dirty:
+                self._compute_row(self._dirty.popitem(last=False)[0])
+            else:
+                self._seed_row(self._unseeded.popleft())
+            if timeit.default_timer() - start >= self._budget:
+                break
+        if self._samples or self._dirty:
+            return None
+
+        if self._rows:
+            self.matrix = self.matrix.replace_rows(self._rows)
+            self._rows = dict()
+            self.version += 1
+            return self.matrix
+        return None
+
+    def stats(self):
+        """ Return the statistics of the refresh as a dict: 'version' (published matrices),
+            'cycles', 'sampled_edges', 'changed_edges', 'computed_rows', 'seeded_rows' (rows
+            routed only to find their edges), the work left in the current cycle,
+            'pending_samples' and 'pending_rows', and the rows left to seed, 'pending_seeds'. """
+        stats = {key: self._stats[key] for key in ('cycles', 'sampled_edges', 'changed_edges',
+                                                   'computed_rows', 'seeded_rows')}
+        stats['version'] = self.version
+        stats['pending_samples'] = len(self._samples)
+        stats['pending_rows'] = len(self._dirty)
+        stats['pending_seeds'] = len(self._unseeded)
+        return stats
+
+def _file_digest(filename, digests):
+    """ Return the sha256 of the file, reusing the one in digests ({ path: [size, mtime_ns,
+        digest] }) when the size and the modification time of the file did not change. """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    known = digests.get(path)
+    if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+        return known[2]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fread:
+        for chunk in iter(lambda: fread.read(1 << 20), b''):
+            digest.update(chunk)
+    digests[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digests[path][2]
+
+def get_travel_time_cache_key(net_file, parking_file, blacklist, vtype='passenger',
+                              cache_dir=None):
+    """ Return the hash identifying a travel time matrix computed from the given inputs.
+
+        The files are hashed, unless cache_dir is set and it has the digest of a file with
+        the same path, size and modification time (the digests are kept in
+        cache_dir/digests.json).
+    """
+    digests = dict()
+    index = None
+    if cache_dir:
+        index = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(index) as fread:
+                digests = json.load(fread)
+        except (OSError, ValueError):
+            digests = dict()
+    known = json.dumps(digests, sort_keys=True)
+
+    digest = hashlib.sha256()
+    digest.update('pypml-travel-time-{}'.format(_CACHE_VERSION).encode())
+    for filename in (net_file, parking_file):
+        digest.update(_file_digest(filename, digests).encode())
+        digest.update(b'\0')
+    digest.update(json.dumps(sorted(blacklist)).encode())
+    digest.update(vtype.encode())
+
+    if index and json.dumps(digests, sort_keys=True) != known:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(index, os.getpid())
+        with open(tmp_file, 'w') as fwrite:
+            json.dump(digests, fwrite)
+        os.replace(tmp_file, index)
+    return digest.hexdigest()
+
+def load_travel_time_cache(directory):
+    """ Return the (matrix, edges blacklist, route edges) saved in the directory, or None if
+        missing. The route edges are { from_pid: set of the edges of its routes }. """
+    if not os.path.isfile(os.path.join(directory, 'blacklist.json')):
+        return None
+    with open(os.path.join(directory, 'blacklist.json')) as fread:
+        blacklist = json.load(fread)
+    with open(os.path.join(directory, 'route_edges.json')) as fread:
+        route_edges = {pid: set(edges) for pid, edges in json.load(fread).items()}
+    return TravelTimeMatrix.load(directory), blacklist, route_edges
+
+def save_travel_time_cache(directory, matrix, blacklist, route_edges):
+    """ Atomically save the matrix, the edges blacklist and the route edges (as returned by
+        load_travel_time_cache) in the directory. """
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent)
+    try:
+        matrix.save(tmp_dir)
+        with open(os.path.join(tmp_dir, 'route_edges.json'), 'w') as fwrite:
+            json.dump({pid: sorted(edges) for pid, edges in route_edges.items()}, fwrite)
+        ## written last, it marks the cache as complete
+        with open(os.path.join(tmp_dir, 'blacklist.json'), 'w') as fwrite:
+            json.dump(blacklist, fwrite)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp_dir, directory)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
@@ -0,0 +1,165 @@
+""" Compact vehicle records for the parking monitor.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections.abc
+import copy
+import operator
+import sys
+
+FIELDS = ('id', 'departure', 'edge', 'stops', 'history', 'vClass', 'passengers', 'arrived',
+          'stopped', 'roadside', 'current_parking_area')
+
+_EMPTY = ()
+_STOP_ID = operator.itemgetter(2)
+
+def get_stops_fingerprint(stops):
+    """ Return the fingerprint of the stops: the tuple of their stopping place IDs.
+
+        It is built in C, but it is still linear in the number of stops: TraCI (and libsumo)
+        return new stop objects at every step, so there is no cheaper key telling that the
+        stops of a vehicle did not change. Only the changed vehicles pay for the update.
+    """
+    return tuple(map(_STOP_ID, stops))
+
+def intern_stops(stops, table):
+    """ Return the stops as a tuple of shared stop tuples.
+
+        Each stop (lane, endPos, stoppingPlaceID, stopFlags, duration, until) is replaced by the
+        equal one already in table (dict), if any, and its strings are interned, so that the
+        vehicles with the same stops share the same objects.
+    """
+    interned = []
+    for stop in stops:
+        stop = tuple(stop)
+        shared = table.get(stop)
+        if shared is None:
+            shared = tuple(sys.intern(value) if isinstance(value, str) else value
+                           for value in stop)
+            table[shared] = shared
+        interned.append(shared)
+    return tuple(interned)
+
+def _encode_delta(old, new):
+    """ Return (head, start, length) such that old == head + new[start:start + length]. """
+    for cut in range(len(old)):
+        tail = old[cut:]
+        for start in range(len(new) - len(tail) + 1):
+            if new[start:start + len(tail)] == tail:
+                return (old[:cut] or _EMPTY, start, len(tail))
+    return (old, 0, 0)
+
+class VehicleRecord(collections.abc.MutableMapping):
+    """ Vehicle information, stored in slots and accessed as the dict the monitor used to use.
+
+        The keys are FIELDS, plus the parameters added with ParkingMonitor.set_vehicle_param.
+        The stops history is kept as deltas, each previous sequence of stops being encoded with
+        respect to the one that replaced it, and it is rebuilt (as a list of tuples) when
+        accessed. Deep copies are plain dicts, as the records used to be.
+
+        The fingerprint of the current stops (not a key) is kept in sync with them.
+    """
+
+    __slots__ = ('id', 'departure', 'edge', 'stops', '_history', 'vClass', 'passengers',
+                 'arrived', 'stopped', 'roadside', 'current_parking_area', '_params',
+                 'fingerprint')
+
+    def __init__(self, vehicle, departure, stops, v_class, passengers):
+        """ Initialize the record of a vehicle just departed. """
+        self.id = vehicle
+        self.departure = departure
+        self.edge = ''
+        self.stops = stops
+        self.fingerprint = get_stops_fingerprint(stops)
+        self._history = []
+        self.vClass = sys.intern(v_class)
+        self.passengers = passengers
+        self.arrived = None
+        self.stopped = False
+        self.roadside = False
+        self.current_parking_area = None
+        self._params = None
+
+    def push_stops(self, stops, fingerprint=None):
+        """ Move the current stops to the history and replace them with the given ones.
+
+            fingerprint: Tuple. Fingerprint of the new stops, if already computed.
+        """
+        self._history.append(_encode_delta(self.stops, stops))
+        self.stops = stops
+        if fingerprint is None:
+            fingerprint = get_stops_fingerprint(stops)
+        self.fingerprint = fingerprint
+
+    def get_history(self):
+        """ Return the list of the previous stops, from the oldest. """
+        history = []
+        following = self.stops
+        for head, start, length in reversed(self._history):
+            following = head + following[start:start + length]
+            history.append(following)
+        history.reverse()
+        return history
+
+    def _set_history(self, history):
+        """ Replace the history with the given list of previous stops. """
+        following = self.stops
+        deltas = []
+        for stops in reversed(history):
+            stops = tuple(stops)
+            deltas.append(_encode_delta(stops, following))
+            following = stops
+        deltas.reverse()
+        self._history = deltas
+
+    def __getitem__(self, key):
+        if key == 'history':
+            return self.get_history()
+        if key in FIELDS:
+            return getattr(self, key)
+        if self._params is None:
+            raise KeyError(key)
+        return self._params[key]
+
+    def __setitem__(self, key, value):
+        if key == 'history':
+            self._set_history(value)
+        elif key in FIELDS:
+            setattr(self, key, value)
+            if key == 'stops':
+                self.fingerprint = get_stops_fingerprint(value)
+        else:
+            if self._params is None:
+                self._params = dict()
+            self._params[key] = value
+
+    def __delitem__(self, key):
+        if key in FIELDS:
+            raise TypeError('Field {} cannot be removed.'.format(key))
+        if self._params is None:
+            raise KeyError(key)
+        del self._params[key]
+
+    def __iter__(self):
+        yield from FIELDS
+        if self._params:
+            yield from self._params
+
+    def __len__(self):
+        return len(FIELDS) + (len(self._params) if self._params else 0)
+
+    def __contains__(self, key):
+        return key in FIELDS or (self._params is not None and key in self._params)
+
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+
+    def __repr__(self):
+        return 'VehicleRecord({!r})'.format(dict(self.items()))
@@ -0,0 +1,116 @@
+""" Read-only views over the parking monitor databases.
+
+    Python Parking Monitor Library (PyPML)
+
+    Author: Lara CODECA
+
+    This program and the accompanying materials are made available under the
+    terms of the Eclipse Public License 2.0 which is available at
+    http://www.eclipse.org/legal/epl-2.0.
+"""
+
+import collections.abc
+import copy
+
+from .series import OccupancySeries
+from .vehicles import VehicleRecord
+
+def read_only(value):
+    """ Return a read-only view of the value, sharing memory with it.
+
+        Dictionaries, sets and lists (occupancy series included) are wrapped (lazily, level by level), everything else is
+        assumed to be immutable and returned as it is.
+    """
+    if isinstance(value, (dict, VehicleRecord)):
+        return DictView(value)
+    if isinstance(value, set):
+        return SetView(value)
+    if isinstance(value, (list, OccupancySeries)):
+        return ListView(value)
+    return value
+
+class DictView(collections.abc.Mapping):
+    """ Read-only view of a dict (or vehicle record). copy() returns a private and mutable deep
+        copy. """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return read_only(self._data[key])
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'DictView({!r})'.format(self._data)
+
+    def copy(self):
+        """ Return a mutable deep copy of the underlying dict. """
+        return copy.deepcopy(self._data)
+
+class SetView(collections.abc.Set):
+    """ Read-only view of a set. Set operations return new frozensets. """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return frozenset(it)
+
+    def __contains__(self, value):
+        return value in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'SetView({!r})'.format(self._data)
+
+    def copy(self):
+        """ Return a mutable copy of the underlying set. """
+        return set(self._data)
+
+class ListView(collections.abc.Sequence):
+    """ Read-only view of a list. copy() returns a private and mutable deep copy. """
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(read_only(value) for value in self._data[index])
+        return read_only(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, collections.abc.Sequence):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'ListView({!r})'.format(self._data)
+
+    def copy(self):
+        """ Return a mutable deep copy of the underlying list. """
+        return copy.deepcopy(self._data)